@@ -0,0 +1,104 @@
+# /sd/nexus/bench/alias_routing.py
+# Стоимость маршрутизации текстового сообщения в зависимости от числа алиасов:
+#   python bench/alias_routing.py --aliases 8 64 512 4096 --messages 2000
+import argparse
+import asyncio
+import json
+import os
+import random
+import sys
+import time
+from datetime import datetime
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [os.path.join(ROOT, "bot"), ROOT]
+
+from aiogram import Bot, Dispatcher, F, Router
+from aiogram.types import Chat, Message, Update, User
+
+from aliases import AliasRouter
+from bench.fake_session import FakeSession
+
+ALIASES_PER_HANDLER = 4
+LANGUAGES = ["ru", "en", "de", "uk", "kk", "tr", "es", "fr"]
+
+
+def make_aliases(count: int):
+    """Синтетические алиасы: по ALIASES_PER_HANDLER на хендлер, на разных «языках»"""
+    handlers = []
+    for h in range(max(1, count // ALIASES_PER_HANDLER)):
+        handlers.append([f"{LANGUAGES[(h + i) % len(LANGUAGES)]}-команда-{h}-{i}" for i in range(ALIASES_PER_HANDLER)])
+    return handlers
+
+
+async def _noop(message: Message):
+    return None
+
+
+def build_chained(handlers) -> Dispatcher:
+    """Как было: цепочка F.text.lower().in_([...]) в порядке регистрации"""
+    dp = Dispatcher()
+    router = Router()
+    for words in handlers:
+        router.message(F.text.lower().in_(words))(_noop)
+    router.message()(_noop)  # unknown_message_handler
+    dp.include_router(router)
+    return dp
+
+
+def build_table(handlers) -> Dispatcher:
+    dp = Dispatcher()
+    router = AliasRouter(name="bench")
+    for words in handlers:
+        router.alias(*words)(_noop)
+    router.message()(_noop)
+    router.compile_aliases()
+    dp.include_router(router)
+    return dp
+
+
+def make_updates(handlers, messages: int, miss_ratio: float):
+    user = User(id=1, is_bot=False, first_name="Bench")
+    chat = Chat(id=1, type="private")
+    rnd = random.Random(42)
+    updates = []
+    for i in range(messages):
+        if rnd.random() < miss_ratio:
+            text = f"просто текст {i}"  # Проваливается до последнего хендлера
+        else:
+            text = rnd.choice(rnd.choice(handlers)).upper()
+        message = Message(message_id=i, date=datetime.now(), chat=chat, from_user=user, text=text)
+        updates.append(Update(update_id=i, message=message))
+    return updates
+
+
+async def measure(dp: Dispatcher, bot: Bot, updates) -> float:
+    for update in updates[:100]:  # Прогрев
+        await dp.feed_update(bot, update)
+    started = time.perf_counter()
+    for update in updates:
+        await dp.feed_update(bot, update)
+    return (time.perf_counter() - started) / len(updates) * 1e6
+
+
+async def run(args) -> dict:
+    bot = Bot("42:FAKE", session=FakeSession(latency=0))
+    results = []
+    for count in args.aliases:
+        handlers = make_aliases(count)
+        updates = make_updates(handlers, args.messages, args.miss_ratio)
+        results.append({
+            "aliases": len(handlers) * ALIASES_PER_HANDLER,
+            "chained_us_per_msg": round(await measure(build_chained(handlers), bot, updates), 1),
+            "table_us_per_msg": round(await measure(build_table(handlers), bot, updates), 1),
+        })
+    await bot.session.close()
+    return {"messages": args.messages, "miss_ratio": args.miss_ratio, "results": results}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Бенчмарк маршрутизации текстовых алиасов")
+    parser.add_argument("--aliases", type=int, nargs="+", default=[8, 64, 512, 4096])
+    parser.add_argument("--messages", type=int, default=2000)
+    parser.add_argument("--miss-ratio", type=float, default=0.5, help="Доля сообщений без алиаса")
+    print(json.dumps(asyncio.run(run(parser.parse_args())), indent=2, ensure_ascii=False))
@@ -0,0 +1,69 @@
+# /sd/nexus/bench/fake_session.py
+import asyncio
+import itertools
+from collections import Counter
+from datetime import datetime
+from typing import Any, AsyncGenerator, Dict, Optional, get_origin
+
+from aiogram import Bot
+from aiogram.client.session.base import BaseSession
+from aiogram.exceptions import TelegramRetryAfter
+from aiogram.methods import TelegramMethod
+from aiogram.types import Message, MessageId, User
+
+
+class FakeSession(BaseSession):
+    """Сессия Bot API без сети: считает вызовы, имитирует задержку и ответы 429"""
+
+    def __init__(self, latency: float = 0.0, retry_after_every: int = 0, retry_after: int = 1):
+        super().__init__()
+        self.latency = latency
+        self.retry_after_every = retry_after_every  # Каждый N-й вызов получает RetryAfter
+        self.retry_after = retry_after
+        self.calls = Counter()
+        self._message_ids = itertools.count(1)
+
+    @property
+    def total_calls(self) -> int:
+        return sum(self.calls.values())
+
+    async def make_request(self, bot: Bot, method: TelegramMethod, timeout: Optional[int] = None) -> Any:
+        self.calls[type(method).__name__] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if self.retry_after_every and self.total_calls % self.retry_after_every == 0:
+            raise TelegramRetryAfter(method=method, message="Too Many Requests", retry_after=self.retry_after)
+        return self._result(bot, method)
+
+    def _result(self, bot: Bot, method: TelegramMethod) -> Any:
+        returning = method.__returning__
+        if returning is Message:
+            chat_id = getattr(method, "chat_id", 0)
+            payload: Dict[str, Any] = {
+                "message_id": next(self._message_ids),
+                "date": int(datetime.now().timestamp()),
+                "chat": {"id": chat_id, "type": "private" if chat_id > 0 else "supergroup"},
+                "text": getattr(method, "text", None),
+            }
+            return Message.model_validate(payload, context={"bot": bot})
+        if returning is MessageId:
+            return MessageId(message_id=next(self._message_ids))
+        if returning is User:
+            return User(id=bot.id, is_bot=True, first_name="Nexus")
+        if get_origin(returning) is list:
+            return []
+        return True
+
+    async def stream_content(
+            self,
+            url: str,
+            headers: Optional[Dict[str, Any]] = None,
+            timeout: int = 30,
+            chunk_size: int = 65536,
+            raise_for_status: bool = True
+    ) -> AsyncGenerator[bytes, None]:
+        return
+        yield b""
+
+    async def close(self) -> None:
+        pass
@@ -0,0 +1,54 @@
+# /sd/nexus/bench/sender_throughput.py
+# Пропускная способность SendScheduler на фейковой сессии Bot API:
+#   python bench/sender_throughput.py --messages 600 --chats 50 --latency 0.05 --retry-every 100
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [ROOT, os.path.join(ROOT, "bot")]
+
+from aiogram import Bot
+
+from bench.fake_session import FakeSession
+from sender import Priority, SendScheduler
+
+
+async def run(args) -> dict:
+    session = FakeSession(latency=args.latency, retry_after_every=args.retry_every)
+    bot = Bot("42:FAKE", session=session)
+    scheduler = SendScheduler(bot, global_rate=args.global_rate)
+    await scheduler.start()
+
+    started = time.perf_counter()
+    sends = []
+    for i in range(args.messages):
+        chat_id = (i % args.chats) + 1
+        priority = Priority.LOG if i % 5 == 0 else Priority.REPLY
+        sends.append(scheduler.send_message(chat_id, f"message {i}", priority=priority))
+    results = await asyncio.gather(*sends, return_exceptions=True)
+    elapsed = time.perf_counter() - started
+    await scheduler.stop()
+
+    return {
+        "messages": args.messages,
+        "chats": args.chats,
+        "elapsed_s": round(elapsed, 3),
+        "throughput_per_s": round(args.messages / elapsed, 1),
+        "errors": sum(isinstance(r, Exception) for r in results),
+        "api_calls": session.total_calls,
+        "scheduler": scheduler.stats(),
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Бенчмарк планировщика исходящих сообщений")
+    parser.add_argument("--messages", type=int, default=600)
+    parser.add_argument("--chats", type=int, default=50)
+    parser.add_argument("--latency", type=float, default=0.05, help="Задержка фейкового API, с")
+    parser.add_argument("--retry-every", type=int, default=0, help="Каждый N-й вызов получает 429")
+    parser.add_argument("--global-rate", type=float, default=30.0)
+    print(json.dumps(asyncio.run(run(parser.parse_args())), indent=2, ensure_ascii=False))
@@ -0,0 +1,84 @@
+# /sd/nexus/bench/startup_time.py
+# Время холодного старта и память по режимам запуска с разбором python -X importtime:
+#   python bench/startup_time.py --modes bot web models --top 15
+import argparse
+import json
+import os
+import re
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Что импортирует процесс каждого режима (без запуска цикла событий)
+MODES = {
+    "bot": (["bot", "."], "import main, sharding"),
+    "web": (["."], "import wsgi"),
+    "models": (["."], "import models.tg, models.users"),
+}
+
+# Печатается дочерним процессом после импортов: пиковый RSS в КБ
+_REPORT = "import resource, sys; print('RSS', resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, file=sys.stderr)"
+
+_IMPORTTIME = re.compile(r"import time:\s+(\d+)\s+\|\s+(\d+)\s+\|(\s*)(\S+)")
+
+
+def measure(mode: str, top: int) -> dict:
+    paths, statement = MODES[mode]
+    env = dict(os.environ)
+    env.setdefault("BOT_TOKEN", "42:FAKE")
+    env["PYTHONPATH"] = os.pathsep.join(os.path.join(ROOT, p) for p in paths)
+    env["PYTHONDONTWRITEBYTECODE"] = "1"
+    started = time.perf_counter()
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"{statement}; {_REPORT}"],
+        cwd=ROOT, env=env, capture_output=True, text=True
+    )
+    elapsed = time.perf_counter() - started
+
+    modules, rss_kb = [], None
+    for line in proc.stderr.splitlines():
+        match = _IMPORTTIME.match(line)
+        if match:
+            self_us, cumulative_us, indent, name = match.groups()
+            modules.append({"module": name, "self_ms": int(self_us) / 1000,
+                            "cumulative_ms": int(cumulative_us) / 1000, "depth": len(indent) // 2})
+        elif line.startswith("RSS "):
+            rss_kb = int(line.split()[1])
+
+    # Собственное время модулей, сложенное по пакетам верхнего уровня
+    packages = {}
+    for module in modules:
+        root = module["module"].split(".")[0]
+        packages[root] = packages.get(root, 0) + module["self_ms"]
+    return {
+        "mode": mode,
+        "ok": proc.returncode == 0,
+        "error": proc.stderr.strip().splitlines()[-1] if proc.returncode else None,
+        "wall_ms": round(elapsed * 1000, 1),
+        "import_ms": round(sum(m["self_ms"] for m in modules), 1),
+        "modules": len(modules),
+        "max_rss_mb": round(rss_kb / 1024, 1) if rss_kb else None,
+        "loaded_web_stack": any(m["module"].split(".")[0] in ("flask", "flask_appbuilder") for m in modules),
+        "top_packages_ms": dict(sorted(((k, round(v, 1)) for k, v in packages.items()),
+                                       key=lambda item: -item[1])[:top]),
+        "top_modules_self_ms": [
+            {"module": m["module"], "self_ms": round(m["self_ms"], 1)}
+            for m in sorted(modules, key=lambda m: -m["self_ms"])[:top]
+        ],
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Бенчмарк холодного старта по режимам")
+    parser.add_argument("--modes", nargs="+", choices=sorted(MODES), default=["bot", "web", "models"])
+    parser.add_argument("--top", type=int, default=10)
+    parser.add_argument("--repeat", type=int, default=3, help="Берётся лучший из N запусков")
+    args = parser.parse_args()
+
+    results = []
+    for mode in args.modes:
+        runs = [measure(mode, args.top) for _ in range(args.repeat)]
+        results.append(min(runs, key=lambda r: r["wall_ms"]))
+    print(json.dumps(results, indent=2, ensure_ascii=False))
@@ -0,0 +1,85 @@
+# /sd/nexus/bench/web_load.py
+# Нагрузка на веб под супервизором и задержка бота в это же время:
+#   python main.py --web-workers 1 &   затем   python bench/web_load.py --duration 30
+#   python main.py --web-workers 4 &   затем   python bench/web_load.py --duration 30
+# Задержка бота берётся из его /metrics (nexus_update_seconds) до и после нагрузки.
+import argparse
+import asyncio
+import json
+import re
+import time
+from typing import Dict, Optional, Tuple
+
+import aiohttp
+
+_UPDATE_SERIES = re.compile(r"^nexus_update_seconds_(sum|count)(?:\{[^}]*\})? ([0-9.eE+-]+)$", re.MULTILINE)
+
+
+async def bot_latency_totals(session: aiohttp.ClientSession, url: Optional[str]) -> Optional[Tuple[float, float]]:
+    """(сумма секунд, число апдейтов) по всем типам апдейтов"""
+    if not url:
+        return None
+    try:
+        async with session.get(url) as response:
+            text = await response.text()
+    except aiohttp.ClientError:
+        return None
+    totals: Dict[str, float] = {"sum": 0.0, "count": 0.0}
+    for kind, value in _UPDATE_SERIES.findall(text):
+        totals[kind] += float(value)
+    return totals["sum"], totals["count"]
+
+
+async def run(args) -> dict:
+    latencies = []
+    errors = 0
+    deadline = time.perf_counter() + args.duration
+    timeout = aiohttp.ClientTimeout(total=args.timeout)
+
+    async with aiohttp.ClientSession(timeout=timeout) as session:
+        bot_before = await bot_latency_totals(session, args.bot_metrics)
+
+        async def client():
+            nonlocal errors
+            while time.perf_counter() < deadline:
+                started = time.perf_counter()
+                try:
+                    async with session.get(args.url) as response:
+                        await response.read()
+                        if response.status >= 500:
+                            errors += 1
+                except (aiohttp.ClientError, asyncio.TimeoutError):
+                    errors += 1
+                latencies.append(time.perf_counter() - started)
+
+        started = time.perf_counter()
+        await asyncio.gather(*(client() for _ in range(args.concurrency)))
+        elapsed = time.perf_counter() - started
+        bot_after = await bot_latency_totals(session, args.bot_metrics)
+
+    ordered = sorted(latencies)
+    result = {
+        "url": args.url,
+        "concurrency": args.concurrency,
+        "requests": len(ordered),
+        "errors": errors,
+        "throughput_per_s": round(len(ordered) / elapsed, 1),
+        "p50_ms": round(ordered[len(ordered) // 2] * 1000, 2) if ordered else None,
+        "p95_ms": round(ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))] * 1000, 2) if ordered else None,
+    }
+    if bot_before and bot_after and bot_after[1] > bot_before[1]:
+        result["bot_updates"] = int(bot_after[1] - bot_before[1])
+        result["bot_mean_update_ms"] = round(
+            (bot_after[0] - bot_before[0]) / (bot_after[1] - bot_before[1]) * 1000, 2
+        )
+    return result
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Нагрузочный тест веба с контролем задержки бота")
+    parser.add_argument("--url", default="http://127.0.0.1:8000/")
+    parser.add_argument("--bot-metrics", default="http://127.0.0.1:9101/metrics", help="Пусто — не опрашивать бота")
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--duration", type=float, default=20.0)
+    parser.add_argument("--timeout", type=float, default=10.0)
+    print(json.dumps(asyncio.run(run(parser.parse_args())), indent=2, ensure_ascii=False))
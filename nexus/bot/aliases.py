@@ -0,0 +1,61 @@
+# /sd/tg/LeonidBot/aliases.py
+import unicodedata
+from typing import Any, Callable, Dict, Optional, Union
+
+from aiogram import Router
+from aiogram.dispatcher.event.handler import CallableObject
+from aiogram.types import Message
+
+from logger import logger
+
+# Буквы, которые пользователи пишут взаимозаменяемо
+ALIAS_FOLDS = str.maketrans({"ё": "е"})
+
+
+def normalize_alias(text: str) -> str:
+    """NFKC + casefold: одинаковый ключ для любого регистра и формы записи"""
+    return unicodedata.normalize("NFKC", text).casefold().translate(ALIAS_FOLDS)
+
+
+class AliasRouter(Router):
+    """Роутер с текстовыми алиасами команд в одной хеш-таблице вместо цепочки F.text-фильтров"""
+
+    def __init__(self, *, name: Optional[str] = None):
+        super().__init__(name=name)
+        self._aliases: Dict[str, CallableObject] = {}
+        self._alias_handler_registered = False
+
+    def alias(self, *words: str) -> Callable:
+        """Регистрирует текстовые алиасы хендлера: @router.alias("старт", "start")"""
+        def decorator(handler: Callable) -> Callable:
+            target = CallableObject(handler)
+            for word in words:
+                key = normalize_alias(word)
+                existing = self._aliases.get(key)
+                if existing is not None and existing.callback is not handler:
+                    raise ValueError(f"Алиас '{word}' уже занят хендлером {existing.callback.__name__}")
+                self._aliases[key] = target
+            if not self._alias_handler_registered:
+                # Один хендлер на все алиасы — на месте первого зарегистрированного
+                self.message.register(self._dispatch_alias, self._match_alias)
+                self._alias_handler_registered = True
+            return handler
+        return decorator
+
+    def compile_aliases(self):
+        """Замораживает таблицу алиасов при старте"""
+        self._aliases = dict(self._aliases)
+        handlers = {target.callback for target in self._aliases.values()}
+        logger.info(f"Роутер {self.name}: {len(self._aliases)} алиасов для {len(handlers)} хендлеров")
+
+    def _match_alias(self, message: Message) -> Union[bool, Dict[str, Any]]:
+        if not message.text:
+            return False
+        target = self._aliases.get(normalize_alias(message.text))
+        if target is None:
+            return False
+        return {"alias_target": target}
+
+    @staticmethod
+    async def _dispatch_alias(message: Message, alias_target: CallableObject, **kwargs) -> Any:
+        return await alias_target.call(message, **kwargs)
@@ -1,7 +1,12 @@
 # /sd/tg/LeonidBot/db.py
+from contextvars import ContextVar
+from typing import Optional
+
 from aiogram import Dispatcher, Bot
 from aiogram.fsm.storage.memory import MemoryStorage
-from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
+from fsm_storage import SQLStorage
+from sender import SendScheduler
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import sessionmaker
 
 # Load environment variables
@@ -9,19 +14,35 @@ import os
 from dotenv import load_dotenv
 load_dotenv()
 
-# Database configuration
-DB_USER = os.getenv("DB_USER")
-DB_PASSWORD = os.getenv("DB_PASSWORD")
-DB_HOST = os.getenv("DB_HOST")
-DB_NAME = os.getenv("DB_NAME")
-DATABASE_URL = f"postgresql+asyncpg://{DB_USER}:{DB_PASSWORD}@{DB_HOST}/{DB_NAME}"
+from engines import RoutingSession, get_engines
+
+# Async engine and session: движок общий с Flask (engines.py), пул в пределах DB_POOL_BUDGET
+engine = get_engines().async_
+# Чтение без записи в сессии уходит на реплики (DB_REPLICA_URLS), если они не отстают
+async_session = sessionmaker(engine, expire_on_commit=False, class_=AsyncSession, sync_session_class=RoutingSession)
 
-# Async engine and session
-engine = create_async_engine(DATABASE_URL)
-async_session = sessionmaker(engine, expire_on_commit=False, class_=AsyncSession)
+# Сессия текущего апдейта (выставляет DbSessionMiddleware)
+update_session: ContextVar[Optional[AsyncSession]] = ContextVar("update_session", default=None)
 
 # Bot
 BOT_TOKEN = os.getenv("BOT_TOKEN")
 bot = Bot(token=BOT_TOKEN)
-storage = MemoryStorage()
-dp = Dispatcher(storage=storage)
\ No newline at end of file
+# Все исходящие сообщения — через одну очередь с лимитами. Лимит на бота общий: при шардировании
+# (BOT_SHARDS выставляет супервизор) каждый воркер получает свою долю; лимиты чатов не делятся — чат в одном воркере
+sender = SendScheduler(
+    bot,
+    global_rate=float(os.getenv("SEND_GLOBAL_RATE", 30)) / max(1, int(os.getenv("BOT_SHARDS", 1))),
+    chat_rate=float(os.getenv("SEND_CHAT_RATE", 1)),
+    group_rate=float(os.getenv("SEND_GROUP_RATE", 20 / 60))
+)
+
+# FSM: memory — только для отладки, db — общая БД, sqlite — встроенная БД одного узла
+FSM_STORAGE = os.getenv("FSM_STORAGE", "db")
+if FSM_STORAGE == "memory":
+    storage = MemoryStorage()
+elif FSM_STORAGE == "sqlite":
+    storage = SQLStorage.sqlite(os.getenv("FSM_SQLITE_PATH", "fsm.sqlite3"))
+else:
+    storage = SQLStorage(engine)
+dp = Dispatcher(storage=storage)
+dp.shutdown.register(storage.close)
@@ -0,0 +1,189 @@
+# /sd/tg/LeonidBot/fsm_storage.py
+import asyncio
+import copy
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Mapping, Optional, Set
+
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, StorageKey, StateType
+from sqlalchemy import delete, select
+from sqlalchemy.ext.asyncio import AsyncEngine, create_async_engine
+
+from logger import logger
+from models import FsmRecord
+
+
+def _insert_for(dialect_name: str):
+    """INSERT с поддержкой ON CONFLICT для текущей СУБД"""
+    if dialect_name == "postgresql":
+        from sqlalchemy.dialects.postgresql import insert
+    else:
+        from sqlalchemy.dialects.sqlite import insert
+    return insert
+
+
+class _Entry:
+    __slots__ = ("state", "data", "touched")
+
+    def __init__(self, state: Optional[str] = None, data: Optional[Dict[str, Any]] = None):
+        self.state = state
+        self.data = data or {}
+        self.touched = time.monotonic()
+
+
+class SQLStorage(BaseStorage):
+    """FSM-хранилище в БД: чтение из кэша процесса, запись пачками в фоне"""
+
+    def __init__(
+            self,
+            engine: AsyncEngine,
+            max_entries: int = 10000,
+            idle_ttl: float = 3600.0,
+            flush_interval: float = 0.5,
+            flush_batch: int = 500,
+            dispose_engine: bool = False
+    ):
+        self.engine = engine
+        self.max_entries = max_entries
+        self.idle_ttl = idle_ttl
+        self.flush_interval = flush_interval
+        self.flush_batch = flush_batch
+        self._dispose_engine = dispose_engine
+        self._insert = _insert_for(engine.dialect.name)
+        self._cache: "OrderedDict[str, _Entry]" = OrderedDict()
+        self._dirty: Set[str] = set()
+        self._flushing: Set[str] = set()
+        self._table_ready = False
+        self._flusher: Optional[asyncio.Task] = None
+        self._closed = False
+
+    @classmethod
+    def sqlite(cls, path: str, **kwargs) -> "SQLStorage":
+        """Встроенный вариант для установки на одном узле"""
+        engine = create_async_engine(f"sqlite+aiosqlite:///{path}")
+        return cls(engine, dispose_engine=True, **kwargs)
+
+    # ==== BaseStorage ====
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        entry = await self._entry(key)
+        entry.state = state.state if isinstance(state, State) else state
+        self._mark_dirty(key)
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        return (await self._entry(key)).state
+
+    async def set_data(self, key: StorageKey, data: Mapping[str, Any]) -> None:
+        entry = await self._entry(key)
+        entry.data = copy.deepcopy(dict(data))
+        self._mark_dirty(key)
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        return copy.deepcopy((await self._entry(key)).data)
+
+    async def close(self) -> None:
+        if self._closed:
+            return
+        self._closed = True
+        if self._flusher is not None:
+            self._flusher.cancel()
+            await asyncio.gather(self._flusher, return_exceptions=True)
+        while self._dirty:
+            await self._flush()
+        if self._dispose_engine:
+            await self.engine.dispose()
+
+    # ==== Кэш ====
+    @staticmethod
+    def _key(key: StorageKey) -> str:
+        return ":".join(str(part) for part in (
+            key.bot_id, key.chat_id, key.user_id, key.thread_id, key.business_connection_id, key.destiny
+        ))
+
+    async def _entry(self, key: StorageKey) -> _Entry:
+        db_key = self._key(key)
+        entry = self._cache.get(db_key)
+        if entry is None:
+            loaded = await self._load(db_key)
+            # Пока шёл SELECT, запись могла появиться из другой задачи
+            entry = self._cache.get(db_key) or loaded
+            self._cache[db_key] = entry
+            self._evict()
+        self._cache.move_to_end(db_key)
+        entry.touched = time.monotonic()
+        return entry
+
+    async def _load(self, db_key: str) -> _Entry:
+        await self._ensure_table()
+        async with self.engine.connect() as conn:
+            row = (await conn.execute(
+                select(FsmRecord.state, FsmRecord.data).where(FsmRecord.key == db_key)
+            )).first()
+        return _Entry(row.state, row.data) if row else _Entry()
+
+    def _mark_dirty(self, key: StorageKey):
+        self._dirty.add(self._key(key))
+        if self._flusher is None or self._flusher.done():
+            self._flusher = asyncio.create_task(self._flush_loop())
+
+    def _evict(self, now: Optional[float] = None):
+        """Выбрасывает простаивающие и лишние записи (только уже сохранённые)"""
+        now = now or time.monotonic()
+        for db_key in list(self._cache):
+            if len(self._cache) <= self.max_entries and now - self._cache[db_key].touched < self.idle_ttl:
+                break
+            if db_key not in self._dirty and db_key not in self._flushing:
+                del self._cache[db_key]
+
+    # ==== Запись в БД ====
+    async def _ensure_table(self):
+        if self._table_ready:
+            return
+        async with self.engine.begin() as conn:
+            await conn.run_sync(FsmRecord.__table__.create, checkfirst=True)
+        self._table_ready = True
+
+    async def _flush_loop(self):
+        while self._dirty:
+            # Несколько переходов одного ключа за интервал схлопываются в одну запись
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self._flush()
+            except Exception as e:
+                logger.error(f"Ошибка записи FSM-состояний: {e}")
+            self._evict()
+
+    async def _flush(self):
+        keys = []
+        while self._dirty and len(keys) < self.flush_batch:
+            keys.append(self._dirty.pop())
+        upserts, deletes = [], []
+        for db_key in keys:
+            entry = self._cache[db_key]
+            if entry.state is None and not entry.data:
+                deletes.append(db_key)  # Диалог завершён — строка не нужна
+            else:
+                upserts.append({"key": db_key, "state": entry.state, "data": entry.data})
+
+        self._flushing.update(keys)
+        try:
+            await self._ensure_table()
+            async with self.engine.begin() as conn:
+                if deletes:
+                    await conn.execute(delete(FsmRecord).where(FsmRecord.key.in_(deletes)))
+                if upserts:
+                    stmt = self._insert(FsmRecord)
+                    stmt = stmt.on_conflict_do_update(
+                        index_elements=[FsmRecord.key],
+                        set_={
+                            "state": stmt.excluded.state,
+                            "data": stmt.excluded.data,
+                            "updated_at": stmt.excluded.updated_at,
+                        }
+                    )
+                    await conn.execute(stmt, upserts)
+        except Exception:
+            self._dirty.update(keys)
+            raise
+        finally:
+            self._flushing.difference_update(keys)
@@ -1,23 +1,24 @@
 # /sd/tg/LeonidBot/handlers/telegram.py
-import re
-
 from aiogram import Router, F
-from aiogram.filters import Command
-from aiogram.types import Message
+from aiogram.filters import Command, ChatMemberUpdatedFilter, JOIN_TRANSITION, LEAVE_TRANSITION
+from aiogram.filters.callback_data import CallbackData
+from aiogram.types import CallbackQuery, ChatMemberUpdated, InlineKeyboardButton, InlineKeyboardMarkup, Message
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
 from datetime import datetime
-from typing import Callable
+from typing import Callable, Optional
+from aliases import AliasRouter
 from decorators import role_required
 from models import GroupType, LogLevel, UserRole
-from services.telegram import UserService
+from services.telegram import UserService, log_settings_cache, role_cache
+from services.relay import relay_index
 
 # ==============================
 # РОУТЕРЫ
 # ==============================
 router = Router()
-user_router = Router()
-group_router = Router()
+user_router = AliasRouter(name="user")
+group_router = AliasRouter(name="group")
 
 # -----------------------------
 # Универсальные функции
@@ -81,12 +82,12 @@ class UpdateDataStates(StatesGroup):
 # Команды
 # -----------------------------
 @router.message(Command("start"))
-@user_router.message(F.text.lower().in_(["старт", "start", "привет", "hello"]))
+@user_router.alias("старт", "start", "привет", "hello")
 async def cmd_start(message: Message):
     await message.answer(f"Привет, {message.from_user.first_name}! Добро пожаловать в бота.")
 
 @user_router.message(Command("cancel"))
-@user_router.message(F.text.lower().in_(["cancel", "отмена", "выйти", "прервать"]))
+@user_router.alias("cancel", "отмена", "выйти", "прервать")
 async def cmd_cancel(message: Message, state: FSMContext):
     current_state = await state.get_state()
     if current_state:
@@ -96,7 +97,7 @@ async def cmd_cancel(message: Message, state: FSMContext):
         await message.answer(f"{message.from_user.first_name}, вы не находитесь в режиме ввода.")
 
 @user_router.message(Command("birthday"))
-@user_router.message(F.text.lower() == "день рождение")
+@user_router.alias("день рождение")
 async def cmd_birthday(message: Message, state: FSMContext):
     async with UserService() as user_service:
         user_db = await user_service.get_user_by_telegram_id(message.from_user.id)
@@ -115,7 +116,7 @@ async def cmd_birthday(message: Message, state: FSMContext):
             await state.set_state(UpdateDataStates.waiting_for_birthday)
 
 @user_router.message(Command("contact"))
-@user_router.message(F.text.lower().in_(["контакт", "профиль"]))
+@user_router.alias("контакт", "профиль")
 async def cmd_contact(message: Message):
     async with UserService() as user_service:
         user_db = await user_service.get_user_by_telegram_id(message.from_user.id)
@@ -145,8 +146,16 @@ async def cmd_contact(message: Message):
 # Группы
 # -----------------------------
 
+MEMBERS_PAGE_SIZE = 50
+MEMBER_NAME_LIMIT = 64  # 50 имён по 64 символа укладываются в лимит сообщения 4096
+
+class MembersPage(CallbackData, prefix="members"):
+    group_id: int
+    cursor: int  # user_id на границе текущей страницы
+    backward: bool = False
+
 @group_router.message(Command("group"))
-@group_router.message(F.text.lower().in_(["группа", "group"]))
+@group_router.alias("группа", "group")
 async def cmd_group(message: Message):
     async with UserService() as user_service:
         chat = message.chat
@@ -166,12 +175,62 @@ async def cmd_group(message: Message):
             success, response = await user_service.add_user_to_group(message.from_user.id, chat.id)
             await message.answer(response if success else f"Ошибка: {response}")
             return
-        members = await user_service.get_group_members(chat.id)
-        if members:
-            member_list = "\n".join([m.full_display_name or m.first_name for m in members])
-            await message.answer(f"Участники группы '{chat_title}':\n{member_list}")
-        else:
-            await message.answer("Группа пока пуста.")
+        text, markup = await render_members_page(user_service, group)
+        await message.answer(text, reply_markup=markup)
+
+@group_router.callback_query(MembersPage.filter())
+async def members_page_callback(callback: CallbackQuery, callback_data: MembersPage):
+    async with UserService() as user_service:
+        group = await user_service.get_group_by_telegram_id(callback_data.group_id)
+        if not group:
+            await callback.answer("Группа не найдена")
+            return
+        text, markup = await render_members_page(
+            user_service, group, callback_data.cursor, callback_data.backward
+        )
+    await callback.message.edit_text(text, reply_markup=markup)
+    await callback.answer()
+
+async def render_members_page(user_service: UserService, group, cursor: Optional[int] = None,
+                              backward: bool = False):
+    """Текст страницы участников и кнопки навигации по ключу user_id"""
+    members = await user_service.get_group_members_page(
+        group.telegram_id, cursor, MEMBERS_PAGE_SIZE + 1, backward
+    )
+    # Лишняя строка показывает, есть ли ещё страница в направлении листания
+    has_more = len(members) > MEMBERS_PAGE_SIZE
+    if has_more:
+        members = members[1:] if backward else members[:-1]
+    if not members:
+        return "Группа пока пуста.", None
+
+    has_prev = cursor is not None and (has_more or not backward)
+    has_next = has_more or (backward and cursor is not None)
+    buttons = []
+    if has_prev:
+        buttons.append(InlineKeyboardButton(
+            text="◀️", callback_data=MembersPage(group_id=group.telegram_id, cursor=members[0][0], backward=True).pack()
+        ))
+    if has_next:
+        buttons.append(InlineKeyboardButton(
+            text="▶️", callback_data=MembersPage(group_id=group.telegram_id, cursor=members[-1][0]).pack()
+        ))
+
+    member_list = "\n".join(name[:MEMBER_NAME_LIMIT] for _, name in members)
+    text = f"Участники группы '{group.title}' (всего {group.participants_count or 0}):\n{member_list}"
+    return text, InlineKeyboardMarkup(inline_keyboard=[buttons]) if buttons else None
+
+@group_router.chat_member(ChatMemberUpdatedFilter(JOIN_TRANSITION))
+async def on_member_join(event: ChatMemberUpdated):
+    async with UserService() as user_service:
+        await user_service.ensure_chat_membership(event.new_chat_member.user, event.chat)
+
+@group_router.chat_member(ChatMemberUpdatedFilter(LEAVE_TRANSITION))
+async def on_member_leave(event: ChatMemberUpdated):
+    user_id = event.old_chat_member.user.id
+    async with UserService() as user_service:
+        await user_service.remove_chat_membership(user_id, event.chat.id)
+        await user_service.remove_user_from_group(user_id, event.chat.id)
 
 # -----------------------------
 # Логирование
@@ -197,39 +256,50 @@ async def cmd_set_log_level(message: Message):
 
 @user_router.message(Command("getloglevel"))
 async def cmd_get_log_level(message: Message):
-    async with UserService() as user_service:
-        log_settings = await user_service.get_log_settings()
-        current_level = log_settings.level if log_settings else LogLevel.ERROR
-        chat_id = log_settings.chat_id if log_settings else "не задан"
-        await message.answer(f"Текущий уровень: {current_level}\nГруппа для логов: {chat_id}")
+    log_settings = await log_settings_cache.get()
+    current_level = log_settings.level if log_settings else LogLevel.ERROR
+    chat_id = log_settings.chat_id if log_settings else "не задан"
+    await message.answer(f"Текущий уровень: {current_level}\nГруппа для логов: {chat_id}")
+
+@user_router.message(Command("cachestats"))
+@role_required(UserRole.admin)
+async def cmd_cache_stats(message: Message):
+    stats = role_cache.stats()
+    await message.answer(
+        f"Кэш ролей: {stats['size']} записей\n"
+        f"Попадания: {stats['hits']}, промахи: {stats['misses']}, вытеснения: {stats['evictions']}"
+    )
 
 # Универсальный хендлер (ловит всё, что не подошло выше)
 log_chat_id = -1002662867876
 @router.message(F.chat.id != log_chat_id)
 async def unknown_message_handler(message: Message):
     try:
-        # Добавляем метаданные в текст сообщения
-        meta_text = f"||origin_chat_id:{message.chat.id}|origin_msg_id:{message.message_id}||"
-        await message.forward(log_chat_id)
-        # Отправляем метаданные как отдельное сообщение (скрытое)
-        from db import bot
-        await bot.send_message(log_chat_id, meta_text, parse_mode=None)
+        from db import sender
+        from sender import Priority
+        forwarded = await sender.forward_message(log_chat_id, message.chat.id, message.message_id, priority=Priority.RELAY)
+        # Запоминаем, откуда пришло сообщение, чтобы доставить ответ поддержки
+        await relay_index.remember(log_chat_id, forwarded.message_id, message.chat.id, message.message_id)
     except Exception as e:
         print(f"Ошибка логирования: {e}")
 
 @router.message(F.chat.id == log_chat_id)
 async def handle_admin_reply(message: Message):
-    from db import bot
+    from db import sender
     from aiogram.exceptions import TelegramAPIError
+    from aiogram.types import ReplyParameters
     from logger import logger
     if message.reply_to_message:
-        # Ищем метаданные в тексте ответа или в reply_to_message
-        meta_match = re.search(r"\|\|origin_chat_id:(\d+)\|origin_msg_id:(\d+)\|\|", message.reply_to_message.text)
-        if meta_match:
-            origin_chat_id = int(meta_match.group(1))
-            origin_msg_id = int(meta_match.group(2))
-            # Отправляем ответ пользователю
+        origin = await relay_index.resolve(message.chat.id, message.reply_to_message.message_id)
+        if origin:
+            origin_chat_id, origin_msg_id = origin
+            # Копируем ответ пользователю (текст, фото, голосовые — любой тип сообщения)
             try:
-                await bot.send_message(origin_chat_id, f"{message.text}")
+                await sender.copy_message(
+                    origin_chat_id,
+                    message.chat.id,
+                    message.message_id,
+                    reply_parameters=ReplyParameters(message_id=origin_msg_id, allow_sending_without_reply=True)
+                )
             except TelegramAPIError as e:
-                logger.error(f"Не удалось отправить ответ пользователю: {e}")
\ No newline at end of file
+                logger.error(f"Не удалось отправить ответ пользователю: {e}")
@@ -1,7 +1,9 @@
 # /sd/tg/LeonidBot/logger.py
+import asyncio
+from collections import Counter
 from datetime import datetime
 
-from aiogram import BaseMiddleware, Bot
+from aiogram import BaseMiddleware
 from aiogram.types import Update, Message, CallbackQuery
 from aiogram.exceptions import TelegramAPIError
 from sqlalchemy.exc import SQLAlchemyError
@@ -9,6 +11,8 @@ from typing import Callable, Dict, Any, Optional
 import logging
 import os
 from models import LogLevel
+from metrics import metrics
+from sender import Priority
 
 # Настройка базового логгера (только консоль)
 logging.basicConfig(
@@ -18,15 +22,182 @@ logging.basicConfig(
 )
 logger = logging.getLogger("LeonidBot")
 
+# Порядок уровней (значения LogLevel — строки, сравнивать их напрямую нельзя)
+LEVEL_PRIORITY = {LogLevel.DEBUG: 0, LogLevel.INFO: 1, LogLevel.ERROR: 2}
+
 def escape_markdown_v2(text: str) -> str:
     """Экранирует специальные символы MarkdownV2"""
     escape_chars = r'_*[]()~`>#+-=|{}.!'
     return ''.join(f'\\{c}' if c in escape_chars else c for c in text)
 
+# ------------------------------
+# Фоновая отправка логов в Telegram
+# ------------------------------
+class TelegramLogSink:
+    """Очередь логов: записи копятся в памяти и уходят в Telegram пачками"""
+    MAX_MESSAGE_LENGTH = 4096  # Лимит Telegram на длину сообщения
+    MAX_CHUNK_LENGTH = MAX_MESSAGE_LENGTH // 2  # После экранирования текст вырастает максимум вдвое
+    _STOP = None  # Маркер остановки в очереди
+
+    def __init__(
+            self,
+            sender,
+            chat_id: int = 0,
+            max_queue: int = 1000,
+            flush_interval: float = 2.0,
+            debug_sample_rate: int = 10
+    ):
+        self.sender = sender  # SendScheduler: лимиты Telegram и приоритеты
+        self.default_chat_id = chat_id
+        self.flush_interval = flush_interval
+        self.debug_sample_rate = max(1, debug_sample_rate)  # Под нагрузкой пропускаем 1 из N DEBUG-записей (≤ 1 — без выборки)
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=max_queue)
+        self.high_watermark = max_queue // 2
+        self.dropped = Counter()  # Потерянные записи по уровням (с последней отправки)
+        self.dropped_total = Counter()
+        self.sent_messages = 0
+        self._debug_seen = 0
+        self._worker: Optional[asyncio.Task] = None
+
+    async def start(self):
+        """Запускает фоновую задачу отправки"""
+        if self._worker is None or self._worker.done():
+            self._worker = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Останавливает отправку, дописав то, что осталось в очереди"""
+        if self._worker is None:
+            return
+        if not self._worker.done():
+            # Маркер в конец очереди вместо cancel: воркер отправляет всё до него, включая текущую пачку
+            await self.queue.put(self._STOP)
+            await self._worker
+        self._worker = None
+        batch = []
+        while not self.queue.empty():
+            record = self.queue.get_nowait()
+            if record is not self._STOP:
+                batch.append(record)
+        if batch:
+            await self._send(batch)
+
+    def emit(self, level: LogLevel, message: str):
+        """Ставит запись в очередь, не дожидаясь отправки"""
+        if LEVEL_PRIORITY[level] < LEVEL_PRIORITY[self._current_level()]:
+            return
+        if level == LogLevel.DEBUG and self.debug_sample_rate > 1 and self.queue.qsize() >= self.high_watermark:
+            self._debug_seen += 1
+            if self._debug_seen % self.debug_sample_rate:
+                self._drop(level)
+                return
+        try:
+            self.queue.put_nowait((level, message, datetime.now()))
+        except asyncio.QueueFull:
+            self._drop(level)
+
+    def stats(self) -> Dict[str, Any]:
+        """Состояние очереди для мониторинга"""
+        return {
+            "queued": self.queue.qsize(),
+            "sent_messages": self.sent_messages,
+            "dropped": {lvl.name: count for lvl, count in self.dropped_total.items()},
+        }
+
+    @staticmethod
+    def _current_level() -> LogLevel:
+        """Уровень из снимка кэша настроек, без обращения к БД: /setloglevel действует сразу"""
+        from services.telegram import log_settings_cache
+        snapshot = log_settings_cache.peek()
+        return snapshot.level if snapshot else LogLevel.DEBUG
+
+    def _drop(self, level: LogLevel):
+        self.dropped[level] += 1
+        self.dropped_total[level] += 1
+
+    async def _run(self):
+        """Собирает записи в пачку и отправляет по размеру или по таймеру"""
+        loop = asyncio.get_running_loop()
+        while True:
+            record = await self.queue.get()
+            if record is self._STOP:
+                return
+            batch = [record]
+            size = len(record[1])
+            deadline = loop.time() + self.flush_interval
+            while size < self.MAX_MESSAGE_LENGTH:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    record = await asyncio.wait_for(self.queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+                if record is self._STOP:
+                    await self._send(batch)
+                    return
+                batch.append(record)
+                size += len(record[1])
+            await self._send(batch)
+
+    async def _send(self, batch):
+        try:
+            await self._flush(batch)
+        except Exception as e:
+            logger.critical(f"Критическая ошибка отправки лога в Telegram: {e}")
+
+    async def _load_settings(self):
+        """Берёт настройки логирования из кэша процесса"""
+        from services.telegram import log_settings_cache
+        settings = await log_settings_cache.get()
+        if settings:
+            return settings.level, settings.chat_id
+        return LogLevel.DEBUG, self.default_chat_id
+
+    async def _flush(self, batch):
+        current_level, chat_id = await self._load_settings()
+        if not chat_id:
+            return
+
+        lines = []
+        if self.dropped:
+            details = ", ".join(f"{lvl.name}: {count}" for lvl, count in self.dropped.items())
+            lines.append(f"[WARNING] Пропущено записей: {sum(self.dropped.values())} ({details})")
+            logger.warning(lines[0])
+            self.dropped.clear()
+        for level, message, created_at in batch:
+            if LEVEL_PRIORITY[level] < LEVEL_PRIORITY[current_level]:
+                continue
+            lines.append(f"[{created_at.strftime('%H:%M:%S')}] [{level.name}] {message}")
+
+        for text in self._chunk(lines):
+            await self.sender.send_message(
+                chat_id,
+                text,
+                priority=Priority.LOG,
+                parse_mode="MarkdownV2"
+            )
+            self.sent_messages += 1
+
+    def _chunk(self, lines):
+        """Склеивает строки в сообщения не длиннее лимита Telegram"""
+        current, length = [], 0
+        for line in lines:
+            for start in range(0, max(len(line), 1), self.MAX_CHUNK_LENGTH):
+                escaped = escape_markdown_v2(line[start:start + self.MAX_CHUNK_LENGTH])
+                if current and length + len(escaped) + 1 > self.MAX_MESSAGE_LENGTH:
+                    yield "\n".join(current)
+                    current, length = [], 0
+                current.append(escaped)
+                length += len(escaped) + 1
+        if current:
+            yield "\n".join(current)
+
 class LoggerMiddleware(BaseMiddleware):
-    def __init__(self, bot: Bot):
-        self.bot = bot
+    def __init__(self, sender, sink: Optional[TelegramLogSink] = None):
+        self.sender = sender
+        self.bot = sender.bot
         self.admin_chat_id = int(os.getenv("ADMIN_CHAT_ID", 0))
+        self.sink = sink or TelegramLogSink(sender, chat_id=self.admin_chat_id)
 
     async def __call__(
             self,
@@ -42,14 +213,24 @@ class LoggerMiddleware(BaseMiddleware):
             return await handler(event, data)
 
         except TelegramAPIError as e:
+            self._mark_failed(data)
             await self._handle_telegram_error(event, e)
 
         except SQLAlchemyError as e:
+            self._mark_failed(data)
             await self._handle_database_error(event, e)
 
         except Exception as e:
+            self._mark_failed(data)
             await self._handle_unexpected_error(event, e)
 
+    @staticmethod
+    def _mark_failed(data: Dict[str, Any]):
+        """Ошибка не уходит выше: DbSessionMiddleware откатит сессию апдейта по этому признаку"""
+        stats = data.get("db_stats")
+        if stats is not None:
+            stats.handler_failed = True
+
     async def _log_event(self, event: Update):
         """Логирование события с детализацией"""
         try:
@@ -76,6 +257,7 @@ class LoggerMiddleware(BaseMiddleware):
 
     async def _handle_telegram_error(self, event: Update, error: TelegramAPIError):
         """Обработка Telegram API ошибок"""
+        metrics.inc("nexus_errors_total", kind="telegram", error=type(error).__name__)
         await self._log(
             LogLevel.ERROR,
             f"[Telegram API ошибка]: {error}",
@@ -89,6 +271,7 @@ class LoggerMiddleware(BaseMiddleware):
 
     async def _handle_database_error(self, event: Update, error: SQLAlchemyError):
         """Обработка ошибок базы данных"""
+        metrics.inc("nexus_errors_total", kind="database", error=type(error).__name__)
         await self._log(
             LogLevel.ERROR,
             f"[База данных ошибка]: {error}",
@@ -102,6 +285,7 @@ class LoggerMiddleware(BaseMiddleware):
 
     async def _handle_unexpected_error(self, event: Update, error: Exception):
         """Обработка неожиданных ошибок"""
+        metrics.inc("nexus_errors_total", kind="unexpected", error=type(error).__name__)
         await self._log(
             LogLevel.ERROR,
             f"[Неизвестная ошибка]: {error}",
@@ -129,42 +313,15 @@ class LoggerMiddleware(BaseMiddleware):
         elif level == LogLevel.ERROR:
             logger.error(message, exc_info=exc_info)
 
-        # Отправляем в Telegram только если уровень соответствует настройкам
-        try:
-            from services.telegram import UserService
-            async with UserService() as user_service:
-                settings = await user_service.get_log_settings()
-                current_level = settings.level if settings else LogLevel.DEBUG
-                chat_id = settings.chat_id if settings else self.admin_chat_id
-
-                # Проверяем, нужно ли отправлять лог
-                if level.value < current_level.value:
-                    return
-
-                # Формируем сообщение
-                formatted_message = (
-                    f"[{level.name}] "
-                    f"{message}\n"
-                    f"Timestamp: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}"
-                )
-                # Экранируем специальные символы MarkdownV2
-                escaped_message = escape_markdown_v2(formatted_message)
-                # Отправляем в Telegram
-                if chat_id:
-                    await self.bot.send_message(
-                        chat_id=chat_id,
-                        text=escaped_message,
-                        parse_mode="MarkdownV2"
-                    )
-        except Exception as e:
-            logger.critical(f"Критическая ошибка отправки лога в Telegram: {e}")
+        # Отправка в Telegram идёт в фоне через очередь
+        self.sink.emit(level, message)
 
     async def _send_error_message(self, event: Update, text: str):
         """Отправка сообщения об ошибке пользователю"""
         chat_id = self._extract_chat_id(event)
         if chat_id:
             try:
-                await self.bot.send_message(chat_id, text)
+                await self.sender.send_message(chat_id, text, priority=Priority.REPLY)
             except TelegramAPIError as e:
                 logger.warning(f"Не удалось отправить сообщение пользователю {chat_id}: {e}")
 
@@ -1,18 +1,168 @@
 # /sd/tg/LeonidBot/main.py
-from db import bot, dp
+from db import bot, dp, engine, sender
 from handlers.telegram import user_router, group_router, router
-from logger import LoggerMiddleware
+from logger import LoggerMiddleware, TelegramLogSink
+from engines import get_engines, pool_status
+from metrics import (
+    ApiMetricsMiddleware, HandlerMetricsMiddleware, MetricsServer, UpdateMetricsMiddleware, instrument_engine,
+    metrics
+)
+from sender import SchedulerRequestMiddleware
+from session import DbSessionMiddleware
+from services.cache import invalidation_bus
+from services.relay import relay_index
+from services.counters import counter_reconciler
 import asyncio
+import os
+import signal
+from typing import Optional
 
+_configured = False
+
+
+async def on_startup():
+    # Кэши процессов синхронизируются через LISTEN/NOTIFY
+    await invalidation_bus.listen(engine)
+
+async def on_shutdown():
+    await invalidation_bus.close()
+
+def setup_dispatcher(metrics_port: Optional[int] = None, background_jobs: bool = True):
+    """Регистрирует мидлвари и роутеры (один раз на процесс).
+    background_jobs — фоновые задачи по всей базе (очистка связок поддержки, сверка счётчиков): при шардировании
+    их запускает только воркер 0, иначе N процессов делают одну и ту же работу одновременно"""
+    global _configured
+    if _configured:
+        return dp
+    _configured = True
+
+    # Метрики: /metrics на локальном порту (0 — выключено)
+    if metrics_port is None:
+        metrics_port = int(os.getenv("METRICS_PORT", 9101))
+    if metrics_port:
+        metrics_server = MetricsServer(os.getenv("METRICS_HOST", "127.0.0.1"), metrics_port)
+        dp.startup.register(metrics_server.start)
+        dp.shutdown.register(metrics_server.stop)
+    instrument_engine(engine)
+    # Отставание реплик проверяется из цикла бота; без проверки реплика не используется
+    dp.startup.register(get_engines().replicas.start)
+    dp.shutdown.register(get_engines().replicas.stop)
+    # Пулы процесса: бот и (если запущен в этом же процессе) Flask
+    for pool_name, pool_engine in (("bot", engine), ("web", get_engines().sync)):
+        for key in ("checked_out", "overflow", "waiters", "wait_seconds_total", "timeouts"):
+            metrics.gauge(
+                f"nexus_db_pool_{key}",
+                lambda pool_engine=pool_engine, key=key: pool_status(pool_engine).get(key, 0),
+                pool=pool_name
+            )
+    # Ответы хендлеров (message.answer и т.п.) — через ту же очередь с лимитами, что логи и пересылка;
+    # мидлварь очереди внешняя, поэтому метрики API меряют сам вызов, без ожидания в очереди
+    bot.session.middleware(SchedulerRequestMiddleware(sender))
+    bot.session.middleware(ApiMetricsMiddleware())
+
+    dp.startup.register(on_startup)
+    dp.shutdown.register(on_shutdown)
+
+    # Общая очередь логов для всех мидлварей
+    log_sink = TelegramLogSink(sender, chat_id=int(os.getenv("ADMIN_CHAT_ID", 0)))
+    dp.startup.register(log_sink.start)
+    dp.shutdown.register(log_sink.stop)
+
+    if background_jobs:
+        # Очистка устаревших связок «поддержка -> пользователь»
+        dp.startup.register(relay_index.start)
+        dp.shutdown.register(relay_index.stop)
+
+        # Периодическая сверка счётчиков участников
+        dp.startup.register(counter_reconciler.start)
+        dp.shutdown.register(counter_reconciler.stop)
+
+    # Очередь исходящих останавливается после логов, чтобы дослать их остаток
+    dp.startup.register(sender.start)
+    dp.shutdown.register(sender.stop)
 
-async def main():
     # Регистрация мидлвари
-    dp.message.middleware(LoggerMiddleware(bot))
-    dp.callback_query.middleware(LoggerMiddleware(bot))
+    dp.update.outer_middleware(UpdateMetricsMiddleware())
+    dp.update.outer_middleware(DbSessionMiddleware())
+    dp.message.middleware(LoggerMiddleware(sender, log_sink))
+    dp.callback_query.middleware(LoggerMiddleware(sender, log_sink))
+    for observer in (dp.message, dp.callback_query, dp.chat_member):
+        observer.middleware(HandlerMetricsMiddleware())
+    # Таблицы текстовых алиасов собираются один раз до приёма апдейтов
+    user_router.compile_aliases()
+    group_router.compile_aliases()
     dp.include_router(user_router)
     dp.include_router(group_router)
     dp.include_router(router)
-    await dp.start_polling(bot)
+    return dp
+
+async def run_bot():
+    """Long polling"""
+    setup_dispatcher()
+    # chat_member не приходит по умолчанию — запрашиваем все используемые типы
+    await dp.start_polling(bot, allowed_updates=dp.resolve_used_update_types())
+
+async def run_webhook(host: str = "0.0.0.0", port: int = 8080, path: str = "/webhook"):
+    """Приём апдейтов через webhook с ограниченной параллельностью"""
+    from aiohttp import web
+    from aiogram.webhook.aiohttp_server import setup_application
+    from webhook import ChatOrderedExecutor, create_webhook_app
+
+    setup_dispatcher()
+    executor = ChatOrderedExecutor(
+        lambda payload: dp.feed_raw_update(bot, payload),
+        concurrency=int(os.getenv("WEBHOOK_CONCURRENCY", 32)),
+        max_pending=int(os.getenv("WEBHOOK_MAX_PENDING", 1000))
+    )
+    secret_token = os.getenv("WEBHOOK_SECRET")
+    app = create_webhook_app(executor, path=path, secret_token=secret_token)
+    setup_application(app, dp, bot=bot)
+
+    webhook_url = os.getenv("WEBHOOK_URL")
+    if webhook_url:
+        await bot.set_webhook(
+            f"{webhook_url.rstrip('/')}{path}",
+            secret_token=secret_token,
+            allowed_updates=dp.resolve_used_update_types()
+        )
+
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    executor.start()
+    try:
+        await _wait_for_stop_signal()
+    finally:
+        await executor.stop()
+        await runner.cleanup()
+
+async def run_sharded(workers: int):
+    """Супервизор: long polling здесь, обработка в N процессах по id чата"""
+    from sharding import ShardSupervisor
+
+    supervisor = ShardSupervisor(
+        workers,
+        concurrency=int(os.getenv("WORKER_CONCURRENCY", 16)),
+        allowed_updates=setup_dispatcher().resolve_used_update_types()
+    )
+    task = asyncio.create_task(supervisor.run(bot))
+    stop = asyncio.create_task(_wait_for_stop_signal())
+    try:
+        await asyncio.wait({task, stop}, return_when=asyncio.FIRST_COMPLETED)
+        # По сигналу run() отменяется и в finally досылает воркерам остаток и ждёт их
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+    finally:
+        stop.cancel()
+        await bot.session.close()
+
+async def _wait_for_stop_signal():
+    """Ждёт SIGTERM/SIGINT (мягкая остановка от супервизора процессов)"""
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(sig, stop.set)
+    await stop.wait()
 
 if __name__ == "__main__":
-    asyncio.run(main())
\ No newline at end of file
+    asyncio.run(run_bot())
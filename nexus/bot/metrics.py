@@ -0,0 +1,204 @@
+# /sd/tg/LeonidBot/metrics.py
+import bisect
+import time
+from typing import Any, Awaitable, Callable, Dict, Tuple
+
+from aiogram import BaseMiddleware
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.types import Update
+
+# Границы бакетов в секундах: от 1 мс до 10 с
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+LabelKey = Tuple[Tuple[str, str], ...]
+
+
+class Histogram:
+    """Накопительная гистограмма в формате Prometheus"""
+    __slots__ = ("buckets", "counts", "sum", "count")
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # Последний — +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class MetricsRegistry:
+    """Счётчики и гистограммы процесса; запись — словарь и bisect, без блокировок (один event loop)"""
+
+    def __init__(self):
+        self._histograms: Dict[str, Dict[LabelKey, Histogram]] = {}
+        self._counters: Dict[str, Dict[LabelKey, float]] = {}
+        self._gauges: Dict[str, Dict[LabelKey, Callable[[], float]]] = {}
+        self._help: Dict[str, str] = {}
+
+    def describe(self, name: str, text: str):
+        self._help[name] = text
+
+    def observe(self, name: str, value: float, **labels: str):
+        series = self._histograms.setdefault(name, {})
+        key = tuple(labels.items())
+        histogram = series.get(key)
+        if histogram is None:
+            histogram = series[key] = Histogram()
+        histogram.observe(value)
+
+    def inc(self, name: str, amount: float = 1, **labels: str):
+        series = self._counters.setdefault(name, {})
+        key = tuple(labels.items())
+        series[key] = series.get(key, 0) + amount
+
+    def gauge(self, name: str, callback: Callable[[], float], **labels: str):
+        """Значение, которое считывается в момент экспозиции"""
+        self._gauges.setdefault(name, {})[tuple(labels.items())] = callback
+
+    def render(self) -> str:
+        """Текстовый формат экспозиции Prometheus"""
+        lines = []
+        for name, series in self._gauges.items():
+            self._header(lines, name, "gauge")
+            for key, callback in series.items():
+                lines.append(f"{name}{_labels(key)} {callback()}")
+        for name, series in self._counters.items():
+            self._header(lines, name, "counter")
+            for key, value in series.items():
+                lines.append(f"{name}{_labels(key)} {value}")
+        for name, series in self._histograms.items():
+            self._header(lines, name, "histogram")
+            for key, histogram in series.items():
+                cumulative = 0
+                for bound, count in zip(histogram.buckets + (float("inf"),), histogram.counts):
+                    cumulative += count
+                    le = "+Inf" if bound == float("inf") else repr(bound)
+                    lines.append(f"{name}_bucket{_labels(key + (('le', le),))} {cumulative}")
+                lines.append(f"{name}_sum{_labels(key)} {histogram.sum}")
+                lines.append(f"{name}_count{_labels(key)} {histogram.count}")
+        return "\n".join(lines) + "\n"
+
+    def _header(self, lines, name: str, kind: str):
+        if name in self._help:
+            lines.append(f"# HELP {name} {self._help[name]}")
+        lines.append(f"# TYPE {name} {kind}")
+
+
+def _labels(key: LabelKey) -> str:
+    if not key:
+        return ""
+    return "{" + ",".join(f'{label}="{_escape(value)}"' for label, value in key) + "}"
+
+
+def _escape(value: Any) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+metrics = MetricsRegistry()
+metrics.describe("nexus_update_seconds", "Полная обработка апдейта, включая мидлвари")
+metrics.describe("nexus_handler_seconds", "Время хендлера по роутеру и имени")
+metrics.describe("nexus_db_query_seconds", "Время SQL-запросов")
+metrics.describe("nexus_telegram_api_seconds", "Время вызовов Bot API по методу")
+metrics.describe("nexus_send_queue_seconds", "Ожидание в очереди исходящих по приоритету")
+metrics.describe("nexus_db_pool_checked_out", "Выданные подключения пула")
+metrics.describe("nexus_db_pool_waiters", "Ожидающие свободного подключения")
+metrics.describe("nexus_db_pool_wait_seconds_total", "Суммарное ожидание подключения")
+metrics.describe("nexus_errors_total", "Ошибки хендлеров по классам (как их разбирает LoggerMiddleware)")
+metrics.describe("nexus_telegram_api_errors_total", "Ошибки вызовов Bot API, включая повторяемые")
+
+
+# ------------------------------
+# Источники данных
+# ------------------------------
+class UpdateMetricsMiddleware(BaseMiddleware):
+    """Внешняя мидлварь: полное время апдейта (разница с хендлером — накладные расходы мидлварей)"""
+
+    async def __call__(self, handler: Callable[[Update, Dict[str, Any]], Awaitable[Any]],
+                       event: Update, data: Dict[str, Any]) -> Any:
+        started = time.perf_counter()
+        try:
+            return await handler(event, data)
+        finally:
+            metrics.observe("nexus_update_seconds", time.perf_counter() - started, type=event.event_type)
+
+
+class HandlerMetricsMiddleware(BaseMiddleware):
+    """Внутренняя мидлварь: время конкретного хендлера"""
+
+    async def __call__(self, handler: Callable[[Any, Dict[str, Any]], Awaitable[Any]],
+                       event: Any, data: Dict[str, Any]) -> Any:
+        started = time.perf_counter()
+        try:
+            return await handler(event, data)
+        finally:
+            # Для текстовых алиасов настоящий хендлер — цель из таблицы AliasRouter
+            target = data.get("alias_target") or data.get("handler")
+            metrics.observe(
+                "nexus_handler_seconds",
+                time.perf_counter() - started,
+                router=data["event_router"].name if "event_router" in data else "",
+                handler=target.callback.__name__ if target else ""
+            )
+
+
+class ApiMetricsMiddleware(BaseRequestMiddleware):
+    """Мидлварь сессии Bot API: время каждого вызова по методу"""
+
+    async def __call__(self, make_request, bot, method):
+        started = time.perf_counter()
+        try:
+            return await make_request(bot, method)
+        except Exception as e:
+            metrics.inc("nexus_telegram_api_errors_total", method=type(method).__name__, error=type(e).__name__)
+            raise
+        finally:
+            metrics.observe("nexus_telegram_api_seconds", time.perf_counter() - started, method=type(method).__name__)
+
+
+def instrument_engine(engine):
+    """Время SQL-запросов через события движка"""
+    from sqlalchemy import event
+
+    sync_engine = getattr(engine, "sync_engine", engine)
+
+    @event.listens_for(sync_engine, "before_cursor_execute")
+    def _start(conn, cursor, statement, parameters, context, executemany):
+        context._metrics_started = time.perf_counter()
+
+    @event.listens_for(sync_engine, "after_cursor_execute")
+    def _stop(conn, cursor, statement, parameters, context, executemany):
+        metrics.observe("nexus_db_query_seconds", time.perf_counter() - context._metrics_started)
+
+
+# ------------------------------
+# Эндпоинт /metrics
+# ------------------------------
+class MetricsServer:
+    """Маленький HTTP-сервер с /metrics рядом с ботом"""
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 9101):
+        self.host = host
+        self.port = port
+        self._runner = None
+
+    async def start(self):
+        from aiohttp import web
+
+        app = web.Application()
+        app.router.add_get("/metrics", self._handle)
+        self._runner = web.AppRunner(app)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, self.host, self.port).start()
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+    @staticmethod
+    async def _handle(request):
+        from aiohttp import web
+        return web.Response(text=metrics.render(), content_type="text/plain", charset="utf-8")
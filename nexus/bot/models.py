@@ -1,5 +1,5 @@
 # /sd/tg/LeonidBot/models.py
-from sqlalchemy import Column, Integer, BigInteger, String, Date, Boolean, DateTime, Enum, ForeignKey
+from sqlalchemy import Column, Integer, BigInteger, String, Date, Boolean, DateTime, Enum, ForeignKey, JSON
 from base import Base
 from datetime import datetime
 from enum import IntEnum, Enum as PyEnum
@@ -74,11 +74,28 @@ class UserGroup(Base): # Связь пользователь-группа (мн
     __tablename__ = 'user_group'
     
     user_id = Column(BigInteger, ForeignKey("users.telegram_id"), primary_key=True)
-    group_id = Column(BigInteger, ForeignKey("groups.telegram_id"), primary_key=True)
+    group_id = Column(BigInteger, ForeignKey("groups.telegram_id"), primary_key=True, index=True)  # Для пересчёта участников
     is_owner = Column(Boolean, default=False)
     is_moderator = Column(Boolean, default=False)
     joined_at = Column(DateTime, default=datetime.utcnow)
 
+class FsmRecord(Base): # Состояние FSM-диалога (ключ StorageKey aiogram)
+    __tablename__ = 'fsm_storage'
+
+    key = Column(String(255), primary_key=True)
+    state = Column(String(255))
+    data = Column(JSON)
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+class SupportRelay(Base): # Пересланное в чат поддержки сообщение -> исходное сообщение пользователя
+    __tablename__ = 'support_relay'
+
+    relay_chat_id = Column(BigInteger, primary_key=True)  # Чат поддержки
+    relay_msg_id = Column(Integer, primary_key=True)  # ID пересланного сообщения
+    origin_chat_id = Column(BigInteger, nullable=False)
+    origin_msg_id = Column(Integer, nullable=False)
+    created_at = Column(DateTime, default=datetime.utcnow, index=True)  # Для очистки по сроку хранения
+
 # Модели для логера:
 class LogLevel(PyEnum):
     DEBUG = "DEBUG"
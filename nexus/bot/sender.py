@@ -0,0 +1,271 @@
+# /sd/tg/LeonidBot/sender.py
+import asyncio
+import contextvars
+import itertools
+import logging
+import time
+from collections import deque
+from enum import IntEnum
+from typing import Any, Awaitable, Callable, Deque, Dict, Optional
+
+from aiogram import Bot
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.exceptions import TelegramRetryAfter
+
+from metrics import metrics
+
+# Не импортируем logger.py: он сам зависит от планировщика
+logger = logging.getLogger("LeonidBot")
+
+
+class Priority(IntEnum):
+    """Классы приоритета исходящих сообщений (меньше — раньше)"""
+    REPLY = 0  # Ответы пользователям
+    RELAY = 1  # Пересылка в чат поддержки
+    LOG = 2    # Логи в чат администраторов
+
+
+class TokenBucket:
+    """Ведро токенов: rate сообщений в секунду, всплеск до capacity"""
+    __slots__ = ("rate", "capacity", "tokens", "updated", "blocked_until")
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0  # RetryAfter от Telegram
+
+    def delay(self, now: float) -> float:
+        """Сколько ждать до следующего токена"""
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if now < self.blocked_until:
+            return self.blocked_until - now
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def consume(self):
+        self.tokens -= 1
+
+    def is_idle(self, now: float) -> bool:
+        return now >= self.blocked_until and self.delay(now) == 0 and self.tokens >= self.capacity
+
+
+# Вызов уже прошёл очередь планировщика: мидлварь сессии пропускает его к API как есть
+_dispatching: contextvars.ContextVar[bool] = contextvars.ContextVar("send_dispatching", default=False)
+
+
+class _Job:
+    __slots__ = ("chat_id", "call", "future", "enqueued_at", "attempts")
+
+    def __init__(self, chat_id: int, call: Callable[[], Awaitable[Any]], future: asyncio.Future):
+        self.chat_id = chat_id
+        self.call = call
+        self.future = future
+        self.enqueued_at = time.monotonic()
+        self.attempts = 0
+
+
+class SendScheduler:
+    """Единая очередь исходящих сообщений с учётом лимитов Telegram"""
+
+    def __init__(
+            self,
+            bot: Bot,
+            global_rate: float = 30.0,
+            chat_rate: float = 1.0,
+            chat_burst: float = 3.0,
+            group_rate: float = 20 / 60,
+            group_burst: float = 3.0,
+            max_retries: int = 3
+    ):
+        self.bot = bot  # Один Bot — одна HTTP-сессия на процесс
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.group_rate = group_rate
+        self.group_burst = group_burst
+        self.max_retries = max_retries
+        self._global = TokenBucket(global_rate, global_rate)
+        self._chats: Dict[int, TokenBucket] = {}
+        self._groups: Dict[int, TokenBucket] = {}
+        self._queue: asyncio.PriorityQueue = asyncio.PriorityQueue()
+        self._seq = itertools.count()
+        self._worker: Optional[asyncio.Task] = None
+        self._deferred = 0
+        self.in_flight = 0
+        self.sent = 0
+        self.retried = 0
+        self.failed = 0
+        self._latency: Dict[Priority, Deque[float]] = {p: deque(maxlen=1000) for p in Priority}
+
+    async def start(self):
+        if self._worker is None or self._worker.done():
+            self._worker = asyncio.create_task(self._run())
+
+    async def stop(self, drain_timeout: float = 10.0):
+        """Досылает очередь (в пределах drain_timeout) и останавливается"""
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + drain_timeout
+        while (self._queue.qsize() or self._deferred or self.in_flight) and loop.time() < deadline:
+            await asyncio.sleep(0.05)
+        if self._worker is not None:
+            self._worker.cancel()
+            await asyncio.gather(self._worker, return_exceptions=True)
+            self._worker = None
+
+    # ==== Отправка ====
+    def submit_nowait(self, chat_id: int, call: Callable[[], Awaitable[Any]],
+                      priority: Priority = Priority.REPLY) -> asyncio.Future:
+        """Ставит вызов Bot API в очередь и сразу возвращает future с результатом"""
+        future = asyncio.get_running_loop().create_future()
+        self._put(priority, next(self._seq), _Job(chat_id, call, future))
+        return future
+
+    async def submit(self, chat_id: int, call: Callable[[], Awaitable[Any]],
+                     priority: Priority = Priority.REPLY) -> Any:
+        return await self.submit_nowait(chat_id, call, priority)
+
+    async def send_message(self, chat_id: int, text: str, priority: Priority = Priority.REPLY, **kwargs) -> Any:
+        return await self.submit(chat_id, lambda: self.bot.send_message(chat_id, text, **kwargs), priority)
+
+    async def forward_message(self, chat_id: int, from_chat_id: int, message_id: int,
+                              priority: Priority = Priority.RELAY) -> Any:
+        return await self.submit(
+            chat_id, lambda: self.bot.forward_message(chat_id, from_chat_id, message_id), priority
+        )
+
+    async def copy_message(self, chat_id: int, from_chat_id: int, message_id: int,
+                           priority: Priority = Priority.REPLY, **kwargs) -> Any:
+        return await self.submit(
+            chat_id, lambda: self.bot.copy_message(chat_id, from_chat_id, message_id, **kwargs), priority
+        )
+
+    def stats(self) -> Dict[str, Any]:
+        latency = {}
+        for priority, samples in self._latency.items():
+            if samples:
+                ordered = sorted(samples)
+                latency[priority.name] = {
+                    "avg": sum(ordered) / len(ordered),
+                    "p95": ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))],
+                    "max": ordered[-1],
+                }
+        return {
+            "queued": self._queue.qsize() + self._deferred,
+            "in_flight": self.in_flight,
+            "sent": self.sent,
+            "retried": self.retried,
+            "failed": self.failed,
+            "queue_latency": latency,
+        }
+
+    # ==== Планировщик ====
+    def _put(self, priority: int, seq: int, job: _Job):
+        self._queue.put_nowait((priority, seq, job))
+
+    def _buckets(self, chat_id: int):
+        chat = self._chats.get(chat_id)
+        if chat is None:
+            chat = self._chats[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+        if chat_id >= 0:
+            return chat, None
+        group = self._groups.get(chat_id)
+        if group is None:
+            group = self._groups[chat_id] = TokenBucket(self.group_rate, self.group_burst)
+        return chat, group
+
+    def _defer(self, delay: float, priority: int, seq: int, job: _Job):
+        """Возвращает задание в очередь позже с тем же местом в порядке"""
+        self._deferred += 1
+
+        def requeue():
+            self._deferred -= 1
+            self._put(priority, seq, job)
+
+        asyncio.get_running_loop().call_later(delay, requeue)
+
+    async def _run(self):
+        dispatched = 0
+        while True:
+            priority, seq, job = await self._queue.get()
+            if job.future.cancelled():
+                continue
+            now = time.monotonic()
+            chat, group = self._buckets(job.chat_id)
+            chat_delay = max(chat.delay(now), group.delay(now) if group else 0.0)
+            if chat_delay > 0:
+                # Этот чат упёрся в лимит — не задерживаем остальные
+                self._defer(chat_delay, priority, seq, job)
+                continue
+            global_delay = self._global.delay(now)
+            if global_delay > 0:
+                await asyncio.sleep(global_delay)
+                self._global.delay(time.monotonic())
+            self._global.consume()
+            chat.consume()
+            if group:
+                group.consume()
+            waited = time.monotonic() - job.enqueued_at
+            self._latency[Priority(priority)].append(waited)
+            metrics.observe("nexus_send_queue_seconds", waited, priority=Priority(priority).name)
+            self.in_flight += 1
+            asyncio.create_task(self._execute(priority, seq, job))
+
+            dispatched += 1
+            if dispatched % 1000 == 0:
+                self._prune()
+
+    async def _execute(self, priority: int, seq: int, job: _Job):
+        _dispatching.set(True)  # Своя задача — свой контекст
+        try:
+            result = await job.call()
+        except TelegramRetryAfter as e:
+            job.attempts += 1
+            if job.attempts > self.max_retries:
+                self.failed += 1
+                if not job.future.done():
+                    job.future.set_exception(e)
+                return
+            self.retried += 1
+            chat, group = self._buckets(job.chat_id)
+            chat.blocked_until = time.monotonic() + e.retry_after
+            logger.warning(f"RetryAfter {e.retry_after}с для чата {job.chat_id}, попытка {job.attempts}")
+            self._defer(e.retry_after, priority, seq, job)
+        except Exception as e:
+            self.failed += 1
+            if not job.future.done():
+                job.future.set_exception(e)
+        else:
+            self.sent += 1
+            if not job.future.done():
+                job.future.set_result(result)
+        finally:
+            self.in_flight -= 1
+
+    def _prune(self):
+        """Удаляет вёдра чатов, которые давно ничего не отправляли"""
+        now = time.monotonic()
+        for buckets in (self._chats, self._groups):
+            for chat_id in [c for c, bucket in buckets.items() if bucket.is_idle(now)]:
+                del buckets[chat_id]
+
+
+class SchedulerRequestMiddleware(BaseRequestMiddleware):
+    """Мидлварь сессии Bot API: всё, что отправляет сообщения (message.answer, bot.send_photo, ...), идёт
+    через очередь SendScheduler с приоритетом REPLY. Вызовы самого планировщика проходят напрямую"""
+
+    def __init__(self, scheduler: SendScheduler):
+        self.scheduler = scheduler
+
+    @staticmethod
+    def _is_send(method) -> bool:
+        name = type(method).__name__
+        return name.startswith(("Send", "Forward", "Copy")) and name != "SendChatAction"
+
+    async def __call__(self, make_request, bot, method):
+        chat_id = getattr(method, "chat_id", None)
+        if _dispatching.get() or not isinstance(chat_id, int) or not self._is_send(method):
+            return await make_request(bot, method)
+        return await self.scheduler.submit(chat_id, lambda: make_request(bot, method), Priority.REPLY)
@@ -0,0 +1,74 @@
+# /sd/tg/LeonidBot/session.py
+from contextvars import ContextVar
+from typing import Callable, Dict, Any, Optional
+
+from aiogram import BaseMiddleware
+from aiogram.types import Update
+from sqlalchemy import event
+
+from db import engine, async_session, update_session
+from logger import logger
+from profiler import sql_profiler
+
+
+class UpdateDbStats:
+    """Счётчики работы с БД в рамках одного апдейта и признак того, что хендлер упал"""
+    __slots__ = ("queries", "checkouts", "handler_failed")
+
+    def __init__(self):
+        self.queries = 0
+        self.checkouts = 0
+        self.handler_failed = False
+
+
+_update_stats: ContextVar[Optional[UpdateDbStats]] = ContextVar("update_db_stats", default=None)
+
+
+@event.listens_for(engine.sync_engine, "before_cursor_execute")
+def _count_query(conn, cursor, statement, parameters, context, executemany):
+    stats = _update_stats.get()
+    if stats is not None:
+        stats.queries += 1
+
+
+@event.listens_for(engine.sync_engine.pool, "checkout")
+def _count_checkout(dbapi_connection, connection_record, connection_proxy):
+    stats = _update_stats.get()
+    if stats is not None:
+        stats.checkouts += 1
+
+
+class DbSessionMiddleware(BaseMiddleware):
+    """Одна сессия БД на апдейт: мидлвари, декораторы и хендлер коммитят вместе"""
+
+    async def __call__(
+            self,
+            handler: Callable[[Update, Dict[str, Any]], Any],
+            event: Update,
+            data: Dict[str, Any]
+    ) -> Any:
+        stats = UpdateDbStats()
+        stats_token = _update_stats.set(stats)
+        profile_token = sql_profiler.begin(f"update {event.update_id}")
+        async with async_session() as session:
+            session_token = update_session.set(session)
+            data["session"] = session
+            data["db_stats"] = stats
+            try:
+                result = await handler(event, data)
+                # LoggerMiddleware глотает ошибки хендлеров: их частичные записи не коммитим
+                if stats.handler_failed:
+                    await session.rollback()
+                else:
+                    await session.commit()
+                return result
+            except Exception:
+                await session.rollback()
+                raise
+            finally:
+                update_session.reset(session_token)
+                _update_stats.reset(stats_token)
+                sql_profiler.end(profile_token)
+                logger.debug(
+                    f"[DB] Апдейт {event.update_id}: запросов {stats.queries}, подключений {stats.checkouts}"
+                )
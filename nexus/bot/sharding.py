@@ -0,0 +1,250 @@
+# /sd/tg/LeonidBot/sharding.py
+import asyncio
+import bisect
+import hashlib
+import multiprocessing
+import os
+import queue
+import threading
+import time
+from typing import Any, Dict, List, Optional
+
+from aiogram.exceptions import TelegramRetryAfter
+
+from logger import logger
+from webhook import extract_chat_id
+
+
+class HashRing:
+    """Консистентное хеширование: чат всегда попадает на один и тот же воркер"""
+
+    def __init__(self, replicas: int = 64):
+        self.replicas = replicas  # Виртуальных слотов на воркер
+        self._hashes: List[int] = []
+        self._slots: Dict[int, int] = {}  # hash -> номер воркера
+
+    @staticmethod
+    def _hash(value: str) -> int:
+        # Встроенный hash() рандомизирован между процессами — нужен стабильный
+        return int.from_bytes(hashlib.md5(value.encode()).digest()[:8], "big")
+
+    def add(self, node: int):
+        for replica in range(self.replicas):
+            slot = self._hash(f"{node}:{replica}")
+            self._slots[slot] = node
+            bisect.insort(self._hashes, slot)
+
+    def remove(self, node: int):
+        """Слоты воркера переходят к соседям по кольцу"""
+        for replica in range(self.replicas):
+            slot = self._hash(f"{node}:{replica}")
+            if self._slots.pop(slot, None) is not None:
+                self._hashes.remove(slot)
+
+    def get(self, key: Any) -> Optional[int]:
+        if not self._hashes:
+            return None
+        index = bisect.bisect(self._hashes, self._hash(str(key))) % len(self._hashes)
+        return self._slots[self._hashes[index]]
+
+    def nodes(self) -> List[int]:
+        return sorted(set(self._slots.values()))
+
+
+class WorkerInbox:
+    """Канал супервизор → воркер с номером index; переживает перезапуск воркера.
+    Pipe, а не multiprocessing.Queue: процесс, умерший внутри Queue.get, оставляет её блокировку чтения занятой,
+    а непрочитанные апдейты в трубе достаются новому процессу. Пишет свой поток, чтобы полный буфер трубы
+    не останавливал цикл супервизора"""
+
+    def __init__(self, ctx, index: int):
+        self.reader, self._writer = ctx.Pipe(duplex=False)
+        self._buffer: queue.Queue = queue.Queue()
+        self._feeder = threading.Thread(target=self._feed, name=f"nexus-inbox-{index}", daemon=True)
+        self._feeder.start()
+
+    def put(self, payload: Optional[Dict[str, Any]]):
+        self._buffer.put(payload)
+
+    def _feed(self):
+        while True:
+            self._writer.send(self._buffer.get())
+
+
+# ------------------------------
+# Воркер
+# ------------------------------
+def worker_main(index: int, inbox, stats_queue, concurrency: int, stats_interval: float, shards: int = 1):
+    """Точка входа процесса-воркера"""
+    # До импорта db: общий лимит отправки делится между воркерами
+    os.environ["BOT_SHARDS"] = str(shards)
+    asyncio.run(_worker_loop(index, inbox, stats_queue, concurrency, stats_interval))
+
+
+async def _worker_loop(index: int, inbox, stats_queue, concurrency: int, stats_interval: float):
+    from db import bot
+    from main import setup_dispatcher
+    from webhook import ChatOrderedExecutor
+
+    # У каждого воркера свой /metrics: METRICS_PORT + 1 + номер
+    base_port = int(os.getenv("METRICS_PORT", 9101))
+    dp = setup_dispatcher(metrics_port=base_port + 1 + index if base_port else 0, background_jobs=index == 0)
+    executor = ChatOrderedExecutor(lambda payload: dp.feed_raw_update(bot, payload), concurrency=concurrency)
+    loop = asyncio.get_running_loop()
+
+    async def report():
+        while True:
+            stats_queue.put({"worker": index, "pid": os.getpid(), "time": time.time(), **executor.stats()})
+            await asyncio.sleep(stats_interval)
+
+    await dp.emit_startup(bot=bot)
+    executor.start()
+    reporter = asyncio.create_task(report())
+    try:
+        while True:
+            payload = await loop.run_in_executor(None, inbox.recv)
+            if payload is None:  # Сигнал остановки от супервизора
+                break
+            # Long polling апдейт повторно не пришлёт: ждём место в очереди, а не отбрасываем
+            while not await executor.submit(payload):
+                logger.warning(f"Воркер {index}: очередь заполнена, апдейт {payload.get('update_id')} ждёт места")
+    finally:
+        reporter.cancel()
+        await executor.stop()
+        await dp.emit_shutdown(bot=bot)
+        await bot.session.close()
+
+
+# ------------------------------
+# Супервизор
+# ------------------------------
+class ShardSupervisor:
+    """Получает апдейты и раздаёт их воркерам по id чата"""
+
+    def __init__(self, workers: int, concurrency: int = 16, stats_interval: float = 5.0,
+                 allowed_updates: Optional[List[str]] = None):
+        self.workers = workers
+        self.allowed_updates = allowed_updates
+        self.concurrency = concurrency
+        self.stats_interval = stats_interval
+        self.ring = HashRing()
+        self._ctx = multiprocessing.get_context("spawn")
+        self._stats_queue = self._ctx.Queue()
+        self._processes: Dict[int, Any] = {}
+        self._inboxes: Dict[int, WorkerInbox] = {}
+        self.stats: Dict[int, Dict[str, Any]] = {}  # Последний отчёт каждого воркера
+        self.routed = 0
+
+    def _spawn(self, index: int):
+        # Перезапущенный воркер читает ту же трубу: то, что ушло упавшему и не прочитано, не теряется
+        inbox = self._inboxes.get(index) or WorkerInbox(self._ctx, index)
+        process = self._ctx.Process(
+            target=worker_main,
+            args=(index, inbox.reader, self._stats_queue, self.concurrency, self.stats_interval, self.workers),
+            name=f"nexus-bot-{index}",
+            daemon=True
+        )
+        process.start()
+        self._inboxes[index] = inbox
+        self._processes[index] = process
+        logger.info(f"Воркер {index} запущен (pid {process.pid})")
+
+    def route(self, payload: Dict[str, Any]) -> bool:
+        chat_id = extract_chat_id(payload)
+        node = self.ring.get(chat_id if chat_id is not None else payload.get("update_id"))
+        if node is None:
+            return False
+        self._inboxes[node].put(payload)
+        self.routed += 1
+        return True
+
+    async def run(self, bot):
+        for index in range(self.workers):
+            self._spawn(index)
+            self.ring.add(index)
+        monitor = asyncio.create_task(self._monitor())
+        try:
+            await self._poll(bot)
+        finally:
+            monitor.cancel()
+            await self.stop()
+
+    async def stop(self, timeout: float = 15.0):
+        for inbox in self._inboxes.values():
+            inbox.put(None)
+        loop = asyncio.get_running_loop()
+        for process in self._processes.values():
+            await loop.run_in_executor(None, process.join, timeout)
+            if process.is_alive():
+                process.terminate()
+
+    async def _poll(self, bot, max_backoff: float = 60.0, route_attempts: int = 5):
+        offset = None
+        backoff = 1.0
+        while True:
+            try:
+                updates = await bot.get_updates(offset=offset, timeout=30, allowed_updates=self.allowed_updates)
+            except TelegramRetryAfter as e:
+                logger.warning(f"[SHARDS] getUpdates: RetryAfter {e.retry_after}с")
+                await asyncio.sleep(e.retry_after)
+                continue
+            except Exception as e:
+                logger.error(f"[SHARDS] getUpdates: {e}, повтор через {backoff:.0f}с")
+                await asyncio.sleep(backoff)
+                backoff = min(backoff * 2, max_backoff)
+                continue
+            backoff = 1.0
+            for update in updates:
+                offset = update.update_id + 1
+                # by_alias: воркеры и extract_chat_id ждут JSON Bot API ("from", а не "from_user")
+                payload = update.model_dump(mode="json", exclude_none=True, by_alias=True)
+                await self._route_with_retry(payload, route_attempts)
+
+    async def _route_with_retry(self, payload: Dict[str, Any], attempts: int):
+        """Сбой отправки в трубу (или пустое кольцо до старта воркеров): повторяем, потом пропускаем апдейт"""
+        delay = 0.5
+        for attempt in range(1, attempts + 1):
+            try:
+                if self.route(payload):
+                    return
+                reason = "нет живых воркеров"
+            except Exception as e:
+                reason = str(e)
+            if attempt < attempts:
+                await asyncio.sleep(delay)
+                delay *= 2
+        logger.error(f"[SHARDS] Апдейт {payload.get('update_id')} пропущен: {reason}")
+
+    async def _monitor(self):
+        """Следит за воркерами: упавший перезапускается с теми же слотами и той же трубой"""
+        last_report = time.monotonic()
+        while True:
+            await asyncio.sleep(1)
+            self._drain_stats()
+            for index, process in list(self._processes.items()):
+                if process.is_alive():
+                    continue
+                logger.error(f"Воркер {index} (pid {process.pid}) завершился с кодом {process.exitcode}")
+                # Слоты остаются за номером: чаты не переезжают к соседям и обратно (порядок апдейтов и FSM
+                # одного чата — в одном процессе), а апдейты копятся в трубе до старта замены
+                self.stats.pop(index, None)
+                self._spawn(index)
+            if time.monotonic() - last_report >= self.stats_interval:
+                last_report = time.monotonic()
+                alive = sum(process.is_alive() for process in self._processes.values())
+                processed = sum(s["processed"] for s in self.stats.values())
+                depth = sum(s["queue_depth"] for s in self.stats.values())
+                logger.info(
+                    f"[SHARDS] воркеров: {alive}/{self.workers}, "
+                    f"отправлено: {self.routed}, обработано: {processed}, в очередях: {depth}"
+                )
+
+    def _drain_stats(self):
+        while True:
+            try:
+                report = self._stats_queue.get_nowait()
+            except queue.Empty:
+                return
+            process = self._processes.get(report["worker"])
+            if process is not None and process.pid == report["pid"]:
+                self.stats[report["worker"]] = report
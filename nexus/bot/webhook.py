@@ -0,0 +1,152 @@
+# /sd/tg/LeonidBot/webhook.py
+# Локальная проверка: curl -X POST localhost:8080/webhook -H "Content-Type: application/json" -d @update.json
+import asyncio
+from collections import deque
+from typing import Any, Awaitable, Callable, Deque, Dict, List, Optional
+
+from aiohttp import web
+
+from logger import logger
+
+# Поля апдейта, в которых лежит сообщение с чатом
+MESSAGE_FIELDS = (
+    "message", "edited_message", "channel_post", "edited_channel_post",
+    "business_message", "edited_business_message",
+)
+# Поля апдейта с чатом напрямую
+CHAT_FIELDS = ("my_chat_member", "chat_member", "chat_join_request", "message_reaction")
+
+
+def extract_chat_id(payload: Dict[str, Any]) -> Optional[int]:
+    """Достаёт id чата из сырого апдейта (или id пользователя для inline/callback без сообщения)"""
+    for field in MESSAGE_FIELDS + CHAT_FIELDS:
+        body = payload.get(field)
+        if body and "chat" in body:
+            return body["chat"]["id"]
+    callback = payload.get("callback_query")
+    if callback:
+        if callback.get("message"):
+            return callback["message"]["chat"]["id"]
+        return callback["from"]["id"]
+    for body in payload.values():
+        if isinstance(body, dict) and "from" in body:
+            return body["from"]["id"]
+    return None
+
+
+class ChatOrderedExecutor:
+    """Параллельная обработка апдейтов: внутри одного чата строго по порядку"""
+
+    def __init__(
+            self,
+            handler: Callable[[Dict[str, Any]], Awaitable[Any]],
+            concurrency: int = 32,
+            max_pending: int = 1000,
+            submit_timeout: float = 5.0
+    ):
+        self.handler = handler
+        self.concurrency = concurrency
+        self.max_pending = max_pending
+        self.submit_timeout = submit_timeout
+        self._slots = asyncio.Semaphore(max_pending)  # Ограничение очереди (backpressure)
+        self._chats: Dict[Any, Deque[Dict[str, Any]]] = {}  # Чат -> ожидающие апдейты
+        self._ready: asyncio.Queue = asyncio.Queue()  # Чаты, которые можно брать в работу
+        self._workers: List[asyncio.Task] = []
+        self.pending = 0
+        self.in_flight = 0
+        self.processed = 0
+        self.errors = 0
+        self.rejected = 0
+
+    def start(self):
+        if not self._workers:
+            self._workers = [asyncio.create_task(self._worker()) for _ in range(self.concurrency)]
+
+    async def stop(self, drain_timeout: float = 10.0):
+        """Дожидается обработки очереди и останавливает воркеры"""
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + drain_timeout
+        while self.pending and loop.time() < deadline:
+            await asyncio.sleep(0.05)
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+
+    async def submit(self, payload: Dict[str, Any]) -> bool:
+        """Ставит апдейт в очередь; False, если очередь переполнена дольше submit_timeout"""
+        try:
+            await asyncio.wait_for(self._slots.acquire(), self.submit_timeout)
+        except asyncio.TimeoutError:
+            self.rejected += 1
+            return False
+
+        key = extract_chat_id(payload)
+        if key is None:
+            key = ("update", payload.get("update_id"))
+        self.pending += 1
+        queue = self._chats.get(key)
+        if queue is None:
+            # Чат свободен — сразу отдаём воркерам
+            self._chats[key] = deque([payload])
+            self._ready.put_nowait(key)
+        else:
+            # Чат уже в работе — апдейт подождёт предыдущие
+            queue.append(payload)
+        return True
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "queue_depth": self.pending - self.in_flight,
+            "in_flight": self.in_flight,
+            "active_chats": len(self._chats),
+            "processed": self.processed,
+            "errors": self.errors,
+            "rejected": self.rejected,
+        }
+
+    async def _worker(self):
+        while True:
+            key = await self._ready.get()
+            queue = self._chats[key]
+            payload = queue.popleft()
+            self.in_flight += 1
+            try:
+                await self.handler(payload)
+                self.processed += 1
+            except Exception as e:
+                self.errors += 1
+                logger.error(f"Ошибка обработки апдейта {payload.get('update_id')}: {e}", exc_info=True)
+            finally:
+                self.in_flight -= 1
+                self.pending -= 1
+                self._slots.release()
+                if queue:
+                    self._ready.put_nowait(key)
+                else:
+                    del self._chats[key]
+
+
+def create_webhook_app(
+        executor: ChatOrderedExecutor,
+        path: str = "/webhook",
+        secret_token: Optional[str] = None
+) -> web.Application:
+    """aiohttp-приложение: приём апдейтов и статистика очереди"""
+
+    async def handle_update(request: web.Request) -> web.Response:
+        if secret_token and request.headers.get("X-Telegram-Bot-Api-Secret-Token") != secret_token:
+            return web.Response(status=401)
+        payload = await request.json()
+        if not await executor.submit(payload):
+            # Telegram повторит доставку позже
+            return web.Response(status=503, text="overloaded")
+        return web.Response(text="ok")
+
+    async def handle_stats(request: web.Request) -> web.Response:
+        return web.json_response(executor.stats())
+
+    app = web.Application()
+    app.router.add_post(path, handle_update)
+    app.router.add_get(f"{path}/stats", handle_stats)
+    return app
@@ -0,0 +1,378 @@
+# /sd/nexus/engines.py
+import asyncio
+import itertools
+import logging
+import os
+import threading
+import time
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, NamedTuple, Optional
+
+from sqlalchemy import Select, create_engine, exc, text
+from sqlalchemy.engine import URL, Engine, make_url
+from sqlalchemy.ext.asyncio import AsyncEngine, create_async_engine
+from sqlalchemy.orm import Session
+from sqlalchemy.pool import AsyncAdaptedQueuePool, QueuePool
+
+from profiler import sql_profiler
+
+logger = logging.getLogger("nexus.engines")
+
+
+# ------------------------------
+# Телеметрия пула
+# ------------------------------
+class PoolTelemetry:
+    """Ожидание свободного подключения: сколько ждут сейчас и сколько ждали всего"""
+    __slots__ = ("waiting", "acquired", "waited", "wait_time", "max_wait", "timeouts")
+
+    def __init__(self):
+        self.waiting = 0
+        self.acquired = 0
+        self.waited = 0  # Получения дольше 1 мс — пул был занят
+        self.wait_time = 0.0
+        self.max_wait = 0.0
+        self.timeouts = 0
+
+
+class _TimedPoolMixin:
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.telemetry = PoolTelemetry()
+
+    def _do_get(self):
+        telemetry = self.telemetry
+        telemetry.waiting += 1
+        started = time.perf_counter()
+        try:
+            connection = super()._do_get()
+        except exc.TimeoutError:
+            telemetry.timeouts += 1
+            raise
+        finally:
+            telemetry.waiting -= 1
+        wait = time.perf_counter() - started
+        telemetry.acquired += 1
+        if wait > 0.001:
+            telemetry.waited += 1
+            telemetry.wait_time += wait
+            telemetry.max_wait = max(telemetry.max_wait, wait)
+        return connection
+
+
+class TimedQueuePool(_TimedPoolMixin, QueuePool):
+    pass
+
+
+class TimedAsyncQueuePool(_TimedPoolMixin, AsyncAdaptedQueuePool):
+    pass
+
+
+# ------------------------------
+# Конфигурация
+# ------------------------------
+@dataclass
+class DatabaseConfig:
+    url: str  # Асинхронный URL (postgresql+asyncpg://...); синхронный выводится из него
+    pool_budget: int = 20  # Подключений на процесс всего: веб + бот
+    web_share: float = 0.25  # Доля бюджета синхронного пула (Flask)
+    overflow_ratio: float = 0.5  # max_overflow от размера пула
+    pool_timeout: float = 10.0
+    pool_recycle: int = 1800
+    pool_pre_ping: bool = True
+    statement_cache_size: int = 100  # 0 — для PgBouncer в режиме transaction
+    echo: bool = False
+    replica_urls: List[str] = field(default_factory=list)  # Асинхронные URL реплик
+    replica_share: float = 0.5  # Доля бюджета каждой реплики от бюджета основной
+    max_replica_lag: float = 5.0  # Секунд; реплика с большим отставанием не используется
+
+    @classmethod
+    def from_env(cls) -> "DatabaseConfig":
+        url = os.getenv("DATABASE_URL") or URL.create(
+            "postgresql+asyncpg",
+            username=os.getenv("DB_USER"),
+            password=os.getenv("DB_PASSWORD"),
+            host=os.getenv("DB_HOST"),
+            port=int(os.getenv("DB_PORT")) if os.getenv("DB_PORT") else None,
+            database=os.getenv("DB_NAME")
+        ).render_as_string(hide_password=False)
+        return cls(
+            url=url,
+            pool_budget=int(os.getenv("DB_POOL_BUDGET", 20)),
+            web_share=float(os.getenv("DB_POOL_WEB_SHARE", 0.25)),
+            overflow_ratio=float(os.getenv("DB_POOL_OVERFLOW_RATIO", 0.5)),
+            pool_timeout=float(os.getenv("DB_POOL_TIMEOUT", 10)),
+            pool_recycle=int(os.getenv("DB_POOL_RECYCLE", 1800)),
+            pool_pre_ping=os.getenv("DB_POOL_PRE_PING", "1") != "0",
+            statement_cache_size=int(os.getenv("DB_STATEMENT_CACHE_SIZE", 100)),
+            echo=os.getenv("DB_ECHO", "0") == "1",
+            replica_urls=[url.strip() for url in os.getenv("DB_REPLICA_URLS", "").split(",") if url.strip()],
+            replica_share=float(os.getenv("DB_REPLICA_SHARE", 0.5)),
+            max_replica_lag=float(os.getenv("DB_MAX_REPLICA_LAG", 5))
+        )
+
+    def for_replica(self, url: str) -> "DatabaseConfig":
+        """Та же конфигурация для реплики: свой URL и уменьшенный бюджет"""
+        return DatabaseConfig(
+            url=url,
+            pool_budget=max(2, round(self.pool_budget * self.replica_share)),
+            web_share=self.web_share,
+            overflow_ratio=self.overflow_ratio,
+            pool_timeout=self.pool_timeout,
+            pool_recycle=self.pool_recycle,
+            pool_pre_ping=self.pool_pre_ping,
+            statement_cache_size=self.statement_cache_size,
+            echo=self.echo
+        )
+
+    @property
+    def async_url(self) -> URL:
+        return make_url(self.url)
+
+    @property
+    def sync_url(self) -> URL:
+        """Тот же сервер с синхронным драйвером"""
+        url = self.async_url
+        backend = url.get_backend_name()
+        if backend == "postgresql":
+            return url.set(drivername="postgresql+psycopg2")
+        if backend == "sqlite":
+            return url.set(drivername="sqlite")
+        return url
+
+    def pool_sizes(self, share: float) -> Dict[str, int]:
+        size = max(1, round(self.pool_budget * share))
+        return {"pool_size": size, "max_overflow": int(size * self.overflow_ratio)}
+
+
+# ------------------------------
+# Реплики
+# ------------------------------
+class Replica:
+    __slots__ = ("name", "sync", "async_", "lag", "healthy")
+
+    def __init__(self, name: str, sync: Engine, async_: AsyncEngine):
+        self.name = name
+        self.sync = sync
+        self.async_ = async_
+        self.lag: Optional[float] = None  # None — ещё не проверялась
+        self.healthy = False
+
+
+class ReplicaSet:
+    """Реплики для чтения с контролем отставания; без свежих реплик чтение идёт на основную"""
+
+    # Для Postgres-реплики: секунды с последней применённой транзакции (0, если всё применено)
+    LAG_QUERY = text(
+        "SELECT CASE WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0 "
+        "ELSE COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0) END"
+    )
+
+    def __init__(self, replicas: List[Replica], max_lag: float = 5.0):
+        self.replicas = replicas
+        self.max_lag = max_lag
+        self._cycle = itertools.count()
+        self._monitor: Optional[asyncio.Task] = None
+        self._thread_lock = threading.Lock()
+        self._thread_pid: Optional[int] = None
+
+    def pick(self, async_: bool) -> Optional[Engine]:
+        """Следующая здоровая реплика по кругу (sync Engine для Session.get_bind)"""
+        fresh = [r for r in self.replicas if r.healthy and r.lag is not None and r.lag <= self.max_lag]
+        if not fresh:
+            return None
+        replica = fresh[next(self._cycle) % len(fresh)]
+        return replica.async_.sync_engine if async_ else replica.sync
+
+    async def check(self):
+        for replica in self.replicas:
+            try:
+                async with replica.async_.connect() as conn:
+                    if replica.async_.dialect.name == "postgresql":
+                        lag = float((await conn.execute(self.LAG_QUERY)).scalar() or 0)
+                    else:
+                        # Локальная подмена (второй файл SQLite): отставания нет
+                        await conn.execute(text("SELECT 1"))
+                        lag = 0.0
+            except Exception as e:
+                self._mark_down(replica, e)
+            else:
+                self._mark_up(replica, lag)
+
+    def check_sync(self):
+        """То же через синхронные движки: для процессов без цикла событий (веб)"""
+        for replica in self.replicas:
+            try:
+                with replica.sync.connect() as conn:
+                    if replica.sync.dialect.name == "postgresql":
+                        lag = float(conn.execute(self.LAG_QUERY).scalar() or 0)
+                    else:
+                        conn.execute(text("SELECT 1"))
+                        lag = 0.0
+            except Exception as e:
+                self._mark_down(replica, e)
+            else:
+                self._mark_up(replica, lag)
+
+    @staticmethod
+    def _mark_up(replica: Replica, lag: float):
+        replica.lag = lag
+        if not replica.healthy:
+            logger.info(f"Реплика {replica.name} доступна (отставание {replica.lag:.1f} с)")
+        replica.healthy = True
+
+    @staticmethod
+    def _mark_down(replica: Replica, error: Exception):
+        if replica.healthy:
+            logger.warning(f"Реплика {replica.name} недоступна, чтение идёт на основную: {error}")
+        replica.healthy = False
+
+    def start_thread(self, interval: float = 1.0):
+        """Мониторинг в потоке-демоне текущего процесса. Веб (gunicorn) не запускает цикл событий бота,
+        поэтому RoutingSession зовёт это при первом синхронном чтении; после fork поток стартует заново"""
+        if not self.replicas:
+            return
+        with self._thread_lock:
+            if self._thread_pid == os.getpid():
+                return
+            self._thread_pid = os.getpid()
+        threading.Thread(target=self._thread_loop, args=(interval,), name="replica-monitor", daemon=True).start()
+
+    def _thread_loop(self, interval: float):
+        while True:
+            self.check_sync()
+            time.sleep(interval)
+
+    async def start(self, interval: float = 1.0):
+        if self.replicas and (self._monitor is None or self._monitor.done()):
+            await self.check()
+            self._monitor = asyncio.create_task(self._monitor_loop(interval))
+
+    async def stop(self):
+        if self._monitor is not None:
+            self._monitor.cancel()
+            await asyncio.gather(self._monitor, return_exceptions=True)
+            self._monitor = None
+
+    async def _monitor_loop(self, interval: float):
+        while True:
+            await asyncio.sleep(interval)
+            await self.check()
+
+
+PRIMARY = "use_primary"  # Ключ в Session.info: дальше только основная БД
+
+
+class RoutingSession(Session):
+    """Чтение — на реплику, запись и всё после первой записи в сессии — на основную"""
+
+    def get_bind(self, mapper=None, clause=None, **kwargs):
+        primary = super().get_bind(mapper, clause, **kwargs)
+        replicas = get_engines().replicas
+        if not replicas.replicas or self.info.get(PRIMARY):
+            return primary
+        if self._flushing or not _is_plain_read(clause):
+            # Read-your-writes: после записи сессия больше не уходит на реплику
+            self.info[PRIMARY] = True
+            return primary
+        engines = get_engines()
+        if primary is engines.async_.sync_engine:
+            return replicas.pick(async_=True) or primary
+        if primary is engines.sync:
+            replicas.start_thread()
+            return replicas.pick(async_=False) or primary
+        return primary
+
+
+def _is_plain_read(clause) -> bool:
+    # SELECT без FOR UPDATE и без CTE: CTE у нас бывают изменяющими (INSERT ... RETURNING)
+    return (
+        isinstance(clause, Select)
+        and clause._for_update_arg is None
+        and not clause._independent_ctes
+    )
+
+
+def use_primary(session):
+    """Закрепляет сессию (sync или async) за основной БД: чтение сразу после записи в другом процессе"""
+    getattr(session, "sync_session", session).info[PRIMARY] = True
+
+
+# ------------------------------
+# Фабрика
+# ------------------------------
+class Engines(NamedTuple):
+    sync: Engine
+    async_: AsyncEngine
+    replicas: ReplicaSet
+
+
+def _pool_options(config: DatabaseConfig, url: URL, share: float, poolclass) -> Dict[str, Any]:
+    options: Dict[str, Any] = {"echo": config.echo}
+    if url.get_backend_name() == "sqlite":
+        return options  # Пулом SQLite управляет диалект
+    options.update(
+        poolclass=poolclass,
+        pool_timeout=config.pool_timeout,
+        pool_recycle=config.pool_recycle,
+        pool_pre_ping=config.pool_pre_ping,
+        **config.pool_sizes(share)
+    )
+    return options
+
+
+def _build_pair(config: DatabaseConfig):
+    async_url = config.async_url
+    async_options = _pool_options(config, async_url, 1 - config.web_share, TimedAsyncQueuePool)
+    if async_url.get_driver_name() == "asyncpg":
+        async_url = async_url.update_query_dict({"prepared_statement_cache_size": str(config.statement_cache_size)})
+        async_options["connect_args"] = {"statement_cache_size": config.statement_cache_size}
+
+    sync_engine = create_engine(
+        config.sync_url, **_pool_options(config, config.sync_url, config.web_share, TimedQueuePool)
+    )
+    async_engine = create_async_engine(async_url, **async_options)
+    sql_profiler.instrument(sync_engine)
+    sql_profiler.instrument(async_engine)
+    return sync_engine, async_engine
+
+
+def build_engines(config: DatabaseConfig) -> Engines:
+    """Пара движков на один сервер; вместе они не превышают pool_budget (+ overflow)"""
+    sync_engine, async_engine = _build_pair(config)
+    replicas = []
+    for url in config.replica_urls:
+        replica_config = config.for_replica(url)
+        name = replica_config.async_url.render_as_string(hide_password=True)
+        replicas.append(Replica(name, *_build_pair(replica_config)))
+    return Engines(sync_engine, async_engine, ReplicaSet(replicas, config.max_replica_lag))
+
+
+_engines: Optional[Engines] = None
+
+
+def get_engines() -> Engines:
+    """Движки процесса: Flask и бот в одном процессе делят один бюджет подключений"""
+    global _engines
+    if _engines is None:
+        _engines = build_engines(DatabaseConfig.from_env())
+    return _engines
+
+
+def pool_status(engine) -> Dict[str, Any]:
+    """Текущее состояние пула для мониторинга"""
+    pool = getattr(engine, "sync_engine", engine).pool
+    status: Dict[str, Any] = {"class": type(pool).__name__}
+    if isinstance(pool, QueuePool):
+        status.update(size=pool.size(), checked_out=pool.checkedout(), overflow=pool.overflow())
+    telemetry: Optional[PoolTelemetry] = getattr(pool, "telemetry", None)
+    if telemetry is not None:
+        status.update(
+            waiters=telemetry.waiting,
+            acquired=telemetry.acquired,
+            waited=telemetry.waited,
+            wait_seconds_total=round(telemetry.wait_time, 6),
+            max_wait_seconds=round(telemetry.max_wait, 6),
+            timeouts=telemetry.timeouts,
+        )
+    return status
@@ -1,33 +1,107 @@
 # /sd/nexus/main.py
 import argparse
-import threading
 import asyncio
-from web.app import app
-from bot.main import run_bot
+import json
+import logging
+import os
+import threading
+
+# Веб-стек и бот импортируются только в том режиме, где они нужны
 
 def start_flask():
+    from wsgi import app
+
     app.run(host="0.0.0.0", port=8000)
 
-def start_bot():
-    asyncio.run(run_bot())
+def start_bot(workers: int = 1):
+    from bot.main import run_bot, run_sharded
+
+    if workers > 1:
+        asyncio.run(run_sharded(workers))
+    else:
+        asyncio.run(run_bot())
+
+def start_webhook(port: int):
+    from bot.main import run_webhook
+
+    asyncio.run(run_webhook(port=port))
+
+def apply_template_cohort(template_id: str, path: str, chunk_size: int, concurrency: int):
+    """Файл JSONL: {"user_id": "...", "parameters": {...}} на строку; отчёт — JSON в stdout"""
+    from uuid import UUID
+    from services.planning import CohortApplier
+
+    with open(path, encoding="utf-8") as f:
+        rows = [json.loads(line) for line in f if line.strip()]
+    assignments = [(row.get("user_id"), row.get("parameters")) for row in rows]
+    applier = CohortApplier(chunk_size=chunk_size, concurrency=concurrency or None)
+    report = asyncio.run(applier.apply(UUID(template_id), assignments))
+    print(json.dumps(report.to_dict(), indent=2, ensure_ascii=False))
+    return report
+
+def rebuild_hierarchy(chunk_size: int):
+    from db import AsyncSessionLocal
+    from services.hierarchy import rebuild_all
+
+    rows = asyncio.run(rebuild_all(AsyncSessionLocal, chunk_size=chunk_size))
+    print(f"Замыкание иерархии пересчитано: {rows} строк")
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Запуск компонентов Nexus")
     parser.add_argument("--flask", action="store_true", help="Запустить только Flask")
     parser.add_argument("--bot", action="store_true", help="Запустить только бота")
+    parser.add_argument("--webhook", action="store_true", help="Запустить бота в режиме webhook")
+    parser.add_argument("--webhook-port", type=int, default=8080, help="Порт webhook-сервера")
+    parser.add_argument("--workers", type=int, default=1, help="Число процессов-воркеров бота (шардирование по чатам)")
+    parser.add_argument("--dev", action="store_true", help="Flask dev-сервер в потоке рядом с ботом (для отладки)")
+    parser.add_argument("--web-workers", type=int, default=int(os.getenv("WEB_WORKERS", 2 * (os.cpu_count() or 1) + 1)),
+                        help="Воркеров gunicorn в режиме супервизора (0 — без веба)")
+    parser.add_argument("--web-bind", default=os.getenv("WEB_BIND", "0.0.0.0:8000"), help="Адрес веб-сервера")
+    parser.add_argument("--graceful-timeout", type=float, default=30.0, help="Сколько ждать завершения при остановке, с")
+    parser.add_argument("--apply-template", metavar="TEMPLATE_ID", help="Применить шаблон к пользователям из --cohort")
+    parser.add_argument("--cohort", metavar="FILE", help="JSONL: user_id и parameters на строку")
+    parser.add_argument("--rebuild-hierarchy", action="store_true",
+                        help="Пересчитать таблицу замыкания иерархии (до включения GRAPH_USE_CLOSURE)")
+    parser.add_argument("--chunk-size", type=int, default=100, help="Пользователей в одной транзакции")
+    parser.add_argument("--concurrency", type=int, default=0, help="Параллельных транзакций (0 — по размеру пула)")
     args = parser.parse_args()
 
-    # Запуск всех модулей без флагов
-    if not args.flask and not args.bot:
+    # Разовая команда: применение шаблона к группе пользователей
+    if args.apply_template:
+        if not args.cohort:
+            parser.error("--apply-template требует --cohort")
+        logging.basicConfig(level=logging.INFO, format="[%(asctime)s] [%(levelname)s] %(message)s")
+        report = apply_template_cohort(args.apply_template, args.cohort, args.chunk_size, args.concurrency)
+        raise SystemExit(1 if report.error or report.failed else 0)
+
+    elif args.rebuild_hierarchy:
+        logging.basicConfig(level=logging.INFO, format="[%(asctime)s] [%(levelname)s] %(message)s")
+        rebuild_hierarchy(args.chunk_size)
+
+    # Без флагов: веб и бот в отдельных процессах под супервизором
+    elif not args.flask and not args.bot and not args.webhook and not args.dev:
+        from supervisor import build_supervisor
+
+        logging.basicConfig(level=logging.INFO, format="[%(asctime)s] [%(levelname)s] %(message)s")
+        print(f"Запуск супервизора: веб-воркеров {args.web_workers}, воркеров бота {args.workers}...")
+        build_supervisor(args.web_workers, args.web_bind, args.workers, args.graceful_timeout).run()
+
+    # Отладка: всё в одном процессе
+    elif args.dev:
         print("Запуск Flask и Telegram-бота...")
+        # Flask-AppBuilder загружается первым: модели должны попасть в его Base
+        from web.app import app  # noqa: F401
         flask_thread = threading.Thread(target=start_flask, daemon=True)
         flask_thread.start()
-        asyncio.run(run_bot())
+        start_bot()
 
     # Запуск отдельных модулей
     elif args.flask:
         print("Запуск Flask...")
         start_flask()
+    elif args.webhook:
+        print(f"Запуск Telegram-бота (webhook, порт {args.webhook_port})...")
+        start_webhook(args.webhook_port)
     elif args.bot:
-        print("Запуск Telegram-бота...")
-        start_bot()
\ No newline at end of file
+        print(f"Запуск Telegram-бота (воркеров: {args.workers})...")
+        start_bot(args.workers)
@@ -0,0 +1,16 @@
+# /sd/nexus/models/__init__.py
+import importlib
+
+# Модули моделей загружаются при первом обращении к их классам (from models import TelegramProfile),
+# а не при импорте пакета
+_SUBMODULES = ("tg", "users")
+
+
+def __getattr__(name: str):
+    if name.startswith("__"):
+        raise AttributeError(name)
+    for submodule in _SUBMODULES:
+        module = importlib.import_module(f"{__name__}.{submodule}")
+        if hasattr(module, name):
+            return getattr(module, name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
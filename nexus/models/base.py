@@ -1,3 +1,26 @@
-from flask_appbuilder import Model
-from sqlalchemy import Column, Integer, String, ForeignKey
-from sqlalchemy.orm import relationship
\ No newline at end of file
+# /sd/nexus/models/base.py
+import sys
+
+from sqlalchemy import Boolean, Column, DateTime, Integer, String
+from sqlalchemy.orm import declarative_base
+
+# Веб-процесс уже загрузил Flask-AppBuilder — модели регистрируются в его Base рядом с ab_user.
+# Процессу бота весь веб-стек не нужен: хватает своей Base и таблицы ab_user для внешних ключей.
+if "flask_appbuilder" in sys.modules:
+    from flask_appbuilder.models.sqla import Base
+    from flask_appbuilder.security.sqla.models import User
+else:
+    Base = declarative_base()
+
+    class User(Base):
+        """Колонки ab_user, которые нужны моделям бота (таблицу создаёт и ведёт Flask-AppBuilder)"""
+        __tablename__ = "ab_user"
+
+        id = Column(Integer, primary_key=True)
+        first_name = Column(String(64), nullable=False)
+        last_name = Column(String(64), nullable=False)
+        username = Column(String(64), unique=True, nullable=False)
+        email = Column(String(320), unique=True, nullable=False)
+        active = Column(Boolean)
+        created_on = Column(DateTime)
+        changed_on = Column(DateTime)
@@ -20,6 +20,16 @@ OCR: Relationship с link_type = 'temporal'.
 Безопасность и производительность :
 Индексы на user_id, type, link_type ускоряют выборку.
 Полиморфизм через __mapper_args__ упрощает работу с сущностями.'''
+from datetime import datetime
+from enum import Enum as PyEnum
+
+from sqlalchemy import (event, inspect, Column, Integer, String, Text, DateTime, Boolean, Float, Numeric, ForeignKey,
+                        CheckConstraint, UniqueConstraint, Index, Enum, text)
+from sqlalchemy import Enum as SQLAlchemyEnum
+from sqlalchemy.dialects.postgresql import UUID, JSONB, ARRAY
+from sqlalchemy.orm import relationship
+
+from models.base import Base
 
 # Базовая модель для всех сущностей:
 class Entity(Base):
@@ -29,6 +39,7 @@ class Entity(Base):
     user_id = Column(UUID(as_uuid=True), ForeignKey("users.id"), nullable=False)  # Владелец
     title = Column(String(255), nullable=False)  # Название
     description = Column(Text)  # Описание
+    type = Column(String(50), nullable=False, index=True)  # area, project, task, habit, resource, ...
     status = Column(Enum('active', 'completed', 'archived', name='entity_status'), default='active')
     priority = Column(Integer, CheckConstraint('priority BETWEEN 1 AND 5'))  # Приоритет (1-5)
     due_date = Column(DateTime)  # Срок выполнения
@@ -130,6 +141,17 @@ class Relationship(Base):
     # Уникальность: один источник → одна цель → один тип связи
     __table_args__ = (UniqueConstraint('source_id', 'target_id', 'link_type'),)
 
+# Замыкание иерархии (PARA): все пары предок → потомок по связям link_type = 'hierarchy'
+class HierarchyClosure(Base):
+    __tablename__ = 'hierarchy_closure'
+
+    ancestor_id = Column(UUID(as_uuid=True), ForeignKey("entities.id", ondelete="CASCADE"), primary_key=True)
+    descendant_id = Column(UUID(as_uuid=True), ForeignKey("entities.id", ondelete="CASCADE"), primary_key=True)
+    depth = Column(Integer, nullable=False)  # Кратчайшее расстояние (1 — прямой потомок)
+    path_count = Column(Integer, nullable=False, default=1)  # Число разных путей: пара удаляется, когда их 0
+
+    __table_args__ = (Index('ix_hierarchy_closure_descendant', 'descendant_id', 'depth'),)
+
 # Модель триггер-действие (например, Достижения и Награды)
 class TriggerType(PyEnum):
     """Типы триггеров"""
@@ -245,6 +267,13 @@ class Template(Entity):
     habits = relationship("Habit", secondary="relationships", back_populates="templates")
     rewards = relationship("Resource", secondary="relationships", back_populates="templates")
 
+@event.listens_for(Template, "before_update")
+def _touch_template(mapper, connection, target):
+    # Правка только колонок templates не обновляет entities; updated_at — часть ключа кэша планов шаблона
+    state = inspect(target)
+    if state.attrs.blueprint_data.history.has_changes() or state.attrs.parameters.history.has_changes():
+        target.updated_at = datetime.utcnow()
+
 class TemplateInstance(Base):
     __tablename__ = 'template_instances'
 
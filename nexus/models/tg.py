@@ -1,12 +1,11 @@
 # /sd/nexus/models/tg.py
 from sqlalchemy import Column, Integer, BigInteger, String, Date, Boolean, DateTime, Enum, ForeignKey
-from flask_appbuilder.models.sqla import Base
+from models.base import Base, User
 from datetime import datetime
 from enum import IntEnum, Enum as PyEnum
 from sqlalchemy.orm import relationship
 from sqlalchemy.dialects.postgresql import JSONB
 from sqlalchemy import UniqueConstraint
-from flask_appbuilder.security.sqla.models import User
 
 __mapper_args__ = {"confirm_deleted_rows": False}
 
@@ -135,7 +134,7 @@ class ChatMember(Base):
 
     # Связь профиль-чат
     profile_id = Column(BigInteger, ForeignKey("telegram_profiles.id"), primary_key=True)
-    chat_id = Column(BigInteger, ForeignKey("telegram_chats.id"), primary_key=True)
+    chat_id = Column(BigInteger, ForeignKey("telegram_chats.id"), primary_key=True, index=True)  # Для пересчёта участников
 
     # Роль и права
     role = Column(Enum(TelegramUserRole), default=TelegramUserRole.member)
@@ -3,12 +3,10 @@ from sqlalchemy import (Column, Integer, BigInteger, String, Date, Boolean, Date
                         Enum, ForeignKey, Numeric, UniqueConstraint, CheckConstraint)
 from sqlalchemy.dialects.postgresql import ARRAY, JSONB
 from sqlalchemy.orm import relationship
-from flask_appbuilder.models.sqla import Base
+from models.base import Base, User
 from datetime import datetime
 from enum import IntEnum, Enum as PyEnum
 
-from flask_appbuilder.security.sqla.models import User
-
 class UserRole(IntEnum):  # Числовая иерархия ролей
     ban = 0  # Запрещает доступ к боту
     single = 1  # Только личные данные
@@ -0,0 +1,208 @@
+# /sd/nexus/profiler.py
+import logging
+import os
+import random
+import re
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Dict, List, Optional
+
+logger = logging.getLogger("nexus.profiler")
+
+# Раскрытые IN-списки и VALUES-пачки сворачиваются, чтобы форма не зависела от числа параметров
+_BIND = r"(?:%\(\w+\)s|%s|\$\d+|\?|:\w+)"
+_BIND_LIST = re.compile(rf"\(\s*{_BIND}(?:\s*,\s*{_BIND})+\s*\)")
+_SPACES = re.compile(r"\s+")
+
+
+def statement_shape(statement: str) -> str:
+    return _SPACES.sub(" ", _BIND_LIST.sub("(…)", statement)).strip()
+
+
+def parameter_shape(parameters: Any, executemany: bool = False) -> str:
+    """Типы параметров без значений: в логах не должно быть пользовательских данных"""
+    if executemany and isinstance(parameters, (list, tuple)) and parameters:
+        return f"{len(parameters)} x {parameter_shape(parameters[0])}"
+    if isinstance(parameters, dict):
+        return "{" + ", ".join(f"{k}: {type(v).__name__}" for k, v in parameters.items()) + "}"
+    if isinstance(parameters, (list, tuple)):
+        return "(" + ", ".join(type(v).__name__ for v in parameters) + ")"
+    return type(parameters).__name__
+
+
+class _ShapeStats:
+    __slots__ = ("count", "total", "slowest", "params")
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.slowest = 0.0
+        self.params = ""
+
+
+class QueryProfile:
+    """Запросы одного апдейта или веб-запроса, сгруппированные по форме"""
+
+    def __init__(self, label: str, max_shapes: int):
+        self.label = label
+        self.max_shapes = max_shapes
+        self.started = time.perf_counter()
+        self.queries = 0
+        self.db_time = 0.0
+        self.shapes: Dict[str, _ShapeStats] = {}
+        self.overflow = 0  # Запросы сверх max_shapes считаются, но не группируются
+
+    def record(self, shape: str, params: str, duration: float):
+        self.queries += 1
+        self.db_time += duration
+        stats = self.shapes.get(shape)
+        if stats is None:
+            if len(self.shapes) >= self.max_shapes:
+                self.overflow += 1
+                return
+            stats = self.shapes[shape] = _ShapeStats()
+        stats.count += 1
+        stats.total += duration
+        if duration >= stats.slowest:
+            stats.slowest = duration
+            stats.params = params
+
+    def repeated(self, threshold: int) -> List[tuple]:
+        return sorted(
+            ((shape, s) for shape, s in self.shapes.items() if s.count >= threshold),
+            key=lambda item: -item[1].count
+        )
+
+
+_current_profile: ContextVar[Optional[QueryProfile]] = ContextVar("sql_profile", default=None)
+
+
+class SQLProfiler:
+    """Профилировщик SQL на событиях SQLAlchemy: привязка к апдейту/запросу, поиск N+1, медленные запросы.
+
+    Включается через SQL_PROFILE=on (каждый запрос) или SQL_PROFILE=sample
+    (доля SQL_PROFILE_RATE); выключенный не вешает обработчики на движки.
+    """
+
+    def __init__(
+            self,
+            mode: str = "off",
+            sample_rate: float = 0.01,
+            slow_ms: float = 100.0,
+            n_plus_one: int = 5,
+            max_shapes: int = 200,
+            top: int = 3
+    ):
+        self.mode = mode
+        self.sample_rate = sample_rate if mode == "sample" else 1.0
+        self.slow = slow_ms / 1000
+        self.n_plus_one = n_plus_one
+        self.max_shapes = max_shapes  # Ограничение памяти на один профиль
+        self.top = top
+        self._shape_cache: Dict[str, str] = {}
+
+    @classmethod
+    def from_env(cls) -> "SQLProfiler":
+        return cls(
+            mode=os.getenv("SQL_PROFILE", "off"),
+            sample_rate=float(os.getenv("SQL_PROFILE_RATE", 0.01)),
+            slow_ms=float(os.getenv("SQL_PROFILE_SLOW_MS", 100)),
+            n_plus_one=int(os.getenv("SQL_PROFILE_N_PLUS_ONE", 5))
+        )
+
+    @property
+    def enabled(self) -> bool:
+        return self.mode in ("on", "sample")
+
+    def instrument(self, engine):
+        """Подключает профилировщик к синхронному или асинхронному движку"""
+        if not self.enabled:
+            return
+        from sqlalchemy import event
+
+        sync_engine = getattr(engine, "sync_engine", engine)
+        event.listen(sync_engine, "before_cursor_execute", self._before)
+        event.listen(sync_engine, "after_cursor_execute", self._after)
+
+    # ==== Границы профиля ====
+    def begin(self, label: str):
+        """Открывает профиль (с учётом выборки); возвращает токен для end()"""
+        if not self.enabled or (self.sample_rate < 1.0 and random.random() >= self.sample_rate):
+            return None
+        return _current_profile.set(QueryProfile(label, self.max_shapes))
+
+    def end(self, token):
+        if token is None:
+            return
+        profile = _current_profile.get()
+        _current_profile.reset(token)
+        if profile is not None:
+            self.report(profile)
+
+    @contextmanager
+    def scope(self, label: str):
+        token = self.begin(label)
+        try:
+            yield
+        finally:
+            self.end(token)
+
+    def init_flask(self, app):
+        """Профиль на каждый веб-запрос"""
+        if not self.enabled:
+            return
+        from flask import g, request
+
+        @app.before_request
+        def _begin_profile():
+            g.sql_profile_token = self.begin(f"{request.method} {request.path}")
+
+        @app.teardown_request
+        def _end_profile(exc):
+            self.end(g.pop("sql_profile_token", None))
+
+    # ==== События движка ====
+    def _before(self, conn, cursor, statement, parameters, context, executemany):
+        if _current_profile.get() is not None:
+            context._profiler_started = time.perf_counter()
+
+    def _after(self, conn, cursor, statement, parameters, context, executemany):
+        profile = _current_profile.get()
+        started = getattr(context, "_profiler_started", None)
+        if profile is None or started is None:
+            return
+        duration = time.perf_counter() - started
+        shape = self._shape_cache.get(statement)
+        if shape is None:
+            if len(self._shape_cache) >= 10 * self.max_shapes:
+                self._shape_cache.clear()
+            shape = self._shape_cache[statement] = statement_shape(statement)
+        params = parameter_shape(parameters, executemany)
+        profile.record(shape, params, duration)
+        if duration >= self.slow:
+            logger.warning(f"[SQL] {profile.label}: медленный запрос {duration * 1000:.1f} мс: {shape} {params}")
+
+    # ==== Отчёт ====
+    def report(self, profile: QueryProfile):
+        if not profile.queries:
+            return
+        elapsed = time.perf_counter() - profile.started
+        lines = [
+            f"[SQL] {profile.label}: {profile.queries} запросов, {len(profile.shapes)} форм, "
+            f"БД {profile.db_time * 1000:.1f} мс из {elapsed * 1000:.1f} мс"
+        ]
+        if profile.overflow:
+            lines.append(f"  ещё {profile.overflow} запросов вне лимита форм")
+        for shape, stats in profile.repeated(self.n_plus_one):
+            lines.append(f"  N+1: {stats.count} x {stats.total * 1000:.1f} мс: {shape}")
+        slowest = sorted(profile.shapes.items(), key=lambda item: -item[1].slowest)[:self.top]
+        for shape, stats in slowest:
+            lines.append(f"  {stats.slowest * 1000:.1f} мс: {shape} {stats.params}")
+        if profile.repeated(self.n_plus_one):
+            logger.warning("\n".join(lines))
+        else:
+            logger.info("\n".join(lines))
+
+
+sql_profiler = SQLProfiler.from_env()
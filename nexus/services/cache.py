@@ -0,0 +1,157 @@
+# /sd/nexus/services/cache.py
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Hashable, List, Optional
+
+from sqlalchemy import event, func, select
+from sqlalchemy.orm import Session
+
+from engines import use_primary
+from logger import logger
+
+MISSING = object()  # Маркер отсутствия значения (None тоже можно кэшировать)
+
+
+# ------------------------------
+# LRU-кэш с временем жизни записей
+# ------------------------------
+class TTLCache:
+    """LRU-кэш с ограничением по размеру и TTL, считает попадания и вытеснения"""
+
+    def __init__(self, maxsize: int = 1024, ttl: Optional[float] = None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data: OrderedDict = OrderedDict()  # key -> (expires_at, value)
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        item = self._data.get(key)
+        if item is None:
+            self.misses += 1
+            return default
+        expires_at, value = item
+        if expires_at is not None and expires_at <= time.monotonic():
+            del self._data[key]
+            self.evictions += 1
+            self.misses += 1
+            return default
+        self._data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def set(self, key: Hashable, value: Any, ttl: Optional[float] = None):
+        ttl = self.ttl if ttl is None else ttl
+        expires_at = time.monotonic() + ttl if ttl is not None else None
+        self._data[key] = (expires_at, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+            self.evictions += 1
+
+    def invalidate(self, key: Hashable):
+        self._data.pop(key, None)
+
+    def clear(self):
+        self._data.clear()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "size": len(self._data),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+
+# ------------------------------
+# Обновление кэшей после фиксации транзакции
+# ------------------------------
+_AFTER_COMMIT = "after_commit_callbacks"
+
+
+def after_commit(session, callback: Callable[[], None]):
+    """Вызывает callback после commit сессии (sync или async); при откате он отбрасывается"""
+    sync_session = getattr(session, "sync_session", session)
+    sync_session.info.setdefault(_AFTER_COMMIT, []).append(callback)
+
+
+@event.listens_for(Session, "after_commit")
+def _run_after_commit(session):
+    for callback in session.info.pop(_AFTER_COMMIT, ()):
+        try:
+            callback()
+        except Exception as e:
+            logger.error(f"Ошибка обновления кэша после commit: {e}")
+
+
+@event.listens_for(Session, "after_transaction_end")
+def _drop_after_commit(session, transaction):
+    # Внешняя транзакция закончилась без commit (откат, close) — отложенные обновления не нужны
+    if transaction.parent is None:
+        session.info.pop(_AFTER_COMMIT, None)
+
+
+# ------------------------------
+# Инвалидация кэшей между процессами
+# ------------------------------
+class InvalidationBus:
+    """Рассылка событий инвалидации: в памяти или через Postgres LISTEN/NOTIFY"""
+
+    def __init__(self):
+        self._handlers: Dict[str, List[Callable[[str], None]]] = {}
+        self._connection = None  # AsyncConnection, удерживаемая под LISTEN
+        self._driver = None  # asyncpg.Connection
+        self._server_pid = None
+
+    def subscribe(self, channel: str, handler: Callable[[str], None]):
+        """Подписка на канал; handler получает payload строкой"""
+        self._handlers.setdefault(channel, []).append(handler)
+
+    async def listen(self, engine):
+        """Переключает шину на LISTEN/NOTIFY (только для PostgreSQL)"""
+        if engine.dialect.name != "postgresql" or self._driver is not None:
+            return
+        self._connection = await engine.connect()
+        raw = await self._connection.get_raw_connection()
+        self._driver = raw.driver_connection
+        self._server_pid = self._driver.get_server_pid()
+        for channel in self._handlers:
+            await self._driver.add_listener(channel, self._on_notify)
+        logger.info(f"Инвалидация кэшей через LISTEN/NOTIFY: {', '.join(self._handlers)}")
+
+    async def publish(self, session, channel: str, payload: str = ""):
+        """Публикует событие; для Postgres NOTIFY уйдёт подписчикам после commit"""
+        if self._driver is None:
+            # Без LISTEN/NOTIFY — так же, как доставил бы Postgres: только после commit
+            after_commit(session, lambda: self._dispatch(channel, payload))
+            return
+        # SELECT pg_notify(...) выглядит как чтение, но NOTIFY на реплике не дойдёт до слушателей основной
+        use_primary(session)
+        await session.execute(select(func.pg_notify(channel, payload)))
+
+    async def close(self):
+        if self._connection is not None:
+            await self._connection.close()
+        self._connection = None
+        self._driver = None
+
+    def _on_notify(self, connection, pid, channel, payload):
+        # Свой процесс уже обновил кэш при записи
+        if pid == self._server_pid:
+            return
+        self._dispatch(channel, payload)
+
+    def _dispatch(self, channel: str, payload: str):
+        for handler in self._handlers.get(channel, []):
+            try:
+                handler(payload)
+            except Exception as e:
+                logger.error(f"Ошибка обработки инвалидации {channel}: {e}")
+
+
+invalidation_bus = InvalidationBus()
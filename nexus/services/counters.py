@@ -0,0 +1,60 @@
+# /sd/nexus/services/counters.py
+import asyncio
+import os
+from typing import Optional
+
+from db import async_session
+from logger import logger
+from services.telegram import UserService
+
+
+class CounterReconciler:
+    """Фоновая сверка participants_count с таблицами членства (пачками, каждая в своей транзакции)"""
+
+    def __init__(self, interval: float = 3600.0, chunk_size: int = 500, pause: float = 0.1):
+        self.interval = interval
+        self.chunk_size = chunk_size
+        self.pause = pause  # Между пачками, чтобы не занимать БД подряд
+        self._task: Optional[asyncio.Task] = None
+
+    async def reconcile(self) -> int:
+        """Проходит все группы и чаты по ключу; возвращает число исправленных счётчиков"""
+        fixed = 0
+        for method in (UserService.reconcile_group_counts, UserService.reconcile_chat_counts):
+            after = None
+            while True:
+                # Короткая транзакция на пачку: блокировки строк держатся миллисекунды
+                async with async_session() as session:
+                    after, changed = await method(UserService(session), after, self.chunk_size)
+                    await session.commit()
+                fixed += changed
+                if after is None:
+                    break
+                await asyncio.sleep(self.pause)
+        return fixed
+
+    async def start(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._loop())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def _loop(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                fixed = await self.reconcile()
+                if fixed:
+                    logger.warning(f"Исправлено расхождений в счётчиках участников: {fixed}")
+            except Exception as e:
+                logger.error(f"Ошибка сверки счётчиков участников: {e}")
+
+
+counter_reconciler = CounterReconciler(
+    interval=float(os.getenv("COUNTER_RECONCILE_INTERVAL", 3600)),
+    chunk_size=int(os.getenv("COUNTER_RECONCILE_CHUNK", 500))
+)
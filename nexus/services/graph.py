@@ -0,0 +1,458 @@
+# /sd/nexus/services/graph.py
+import math
+import os
+from array import array
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+from uuid import UUID
+
+from sqlalchemy import and_, delete, func, literal, select, union_all
+from sqlalchemy.dialects.postgresql import ARRAY, UUID as PG_UUID, array as pg_array, insert as pg_insert
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from models.planning import Entity, HierarchyClosure, Relationship
+from services.cache import TTLCache, invalidation_bus
+
+_relationships = Relationship.__table__
+_entities = Entity.__table__
+
+# Связь source → target: обход "вниз" идёт по направлению ребра, "вверх" — против него
+OUT, IN, BOTH = "out", "in", "both"
+LINK_TYPES: Tuple[str, ...] = tuple(_relationships.c.link_type.type.enums)
+_KIND = {name: code for code, name in enumerate(LINK_TYPES)}
+
+MAX_DEPTH = int(os.getenv("GRAPH_MAX_DEPTH", 32))
+PATH_MAX_DEPTH = int(os.getenv("GRAPH_PATH_MAX_DEPTH", 8))
+# Обход только по hierarchy — из таблицы замыкания. Включать после python main.py --rebuild-hierarchy
+# и только если связи hierarchy пишутся лишь через GraphService: иначе замыкание пустое или расходится со связями
+USE_CLOSURE = os.getenv("GRAPH_USE_CLOSURE", "0") != "0"
+
+
+# ------------------------------
+# Рекурсивные CTE
+# ------------------------------
+def _edges(
+        direction: str,
+        link_types: Optional[Sequence[str]],
+        min_weight: Optional[float],
+        table,
+        user_id: Optional[UUID] = None,
+        entities=_entities
+):
+    """Рёбра как (near, far) в направлении обхода, с фильтрами по типу, весу и владельцу обеих сторон"""
+
+    def oriented(near, far):
+        query = select(near.label("near"), far.label("far"))
+        if user_id is not None:
+            # Обход не выходит в чужой граф: и source, и target — сущности пользователя
+            source, target = entities.alias("source_entity"), entities.alias("target_entity")
+            query = (
+                query.join_from(table, source, source.c.id == table.c.source_id)
+                .join(target, target.c.id == table.c.target_id)
+                .where(source.c.user_id == user_id, target.c.user_id == user_id)
+            )
+        if link_types:
+            query = query.where(table.c.link_type.in_(link_types))
+        if min_weight is not None:
+            query = query.where(table.c.weight >= min_weight)
+        return query
+
+    source, target = table.c.source_id, table.c.target_id
+    if direction == OUT:
+        return oriented(source, target).subquery("edges")
+    if direction == IN:
+        return oriented(target, source).subquery("edges")
+    return union_all(oriented(source, target), oriented(target, source)).subquery("edges")
+
+
+def walk_query(
+        start_ids: Sequence[UUID],
+        direction: str = OUT,
+        link_types: Optional[Sequence[str]] = None,
+        min_weight: Optional[float] = None,
+        max_depth: int = MAX_DEPTH,
+        user_id: Optional[UUID] = None,
+        table=_relationships,
+        entities=_entities
+):
+    """(node_id, depth) всех узлов, достижимых из start_ids; depth — кратчайшее число рёбер.
+    UNION отбрасывает повторные (узел, глубина), а max_depth ограничивает итерации — на циклах обход конечен
+    и не растёт экспоненциально, как при UNION ALL с путями. С user_id — только связи между его сущностями."""
+    edges = _edges(direction, link_types, min_weight, table, user_id, entities)
+    seed = select(edges.c.far.label("node_id"), literal(1).label("depth")).where(edges.c.near.in_(start_ids))
+    walk = seed.cte("walk", recursive=True)
+    step = (
+        select(edges.c.far, walk.c.depth + 1)
+        .select_from(edges)
+        .join(walk, edges.c.near == walk.c.node_id)
+        .where(walk.c.depth < max_depth)
+    )
+    walk = walk.union(step)
+    return (
+        select(walk.c.node_id, func.min(walk.c.depth).label("depth"))
+        .where(walk.c.node_id.notin_(start_ids))
+        .group_by(walk.c.node_id)
+    )
+
+
+def path_query(
+        source_id: UUID,
+        target_id: UUID,
+        direction: str = OUT,
+        link_types: Optional[Sequence[str]] = None,
+        min_weight: Optional[float] = None,
+        max_depth: int = PATH_MAX_DEPTH,
+        user_id: Optional[UUID] = None,
+        table=_relationships,
+        entities=_entities
+):
+    """Кратчайший путь source → target списком id. Вперёд — тот же BFS, что в walk_query (UNION по
+    (узел, глубина), работа не больше узлов × max_depth); назад от target — только по рёбрам, где глубина
+    растёт на единицу, то есть по кратчайшим путям. Простые пути целиком не перебираются."""
+    uuid_type = PG_UUID(as_uuid=True)
+    path_type = ARRAY(uuid_type)
+    edges = _edges(direction, link_types, min_weight, table, user_id, entities)
+
+    seed = (
+        select(edges.c.far.label("node_id"), literal(1).label("depth"))
+        .where(edges.c.near == source_id, edges.c.far != source_id)
+    )
+    walk = seed.cte("path_walk", recursive=True)
+    step = (
+        select(edges.c.far, walk.c.depth + 1)
+        .select_from(edges)
+        .join(walk, edges.c.near == walk.c.node_id)
+        .where(walk.c.depth < max_depth, walk.c.node_id != target_id, edges.c.far != source_id)
+    )
+    walk = walk.union(step)
+    levels = select(walk.c.node_id, func.min(walk.c.depth).label("depth")).group_by(walk.c.node_id).cte("levels")
+
+    # Обратный проход: предшественник узла глубины d — узел глубины d - 1
+    back = (
+        select(levels.c.node_id, levels.c.depth, pg_array([levels.c.node_id], type_=uuid_type).label("path"))
+        .where(levels.c.node_id == target_id)
+        .cte("path_back", recursive=True)
+    )
+    previous = levels.alias("previous")
+    back_step = (
+        select(edges.c.near, back.c.depth - 1, func.array_prepend(edges.c.near, back.c.path, type_=path_type))
+        .select_from(edges)
+        .join(back, edges.c.far == back.c.node_id)
+        .join(previous, and_(previous.c.node_id == edges.c.near, previous.c.depth == back.c.depth - 1))
+        .where(back.c.depth > 1)
+    )
+    back = back.union_all(back_step)
+    return (
+        select(func.array_prepend(literal(source_id, uuid_type), back.c.path, type_=path_type).label("path"))
+        .select_from(back)
+        .join(edges, and_(edges.c.near == source_id, edges.c.far == back.c.node_id))
+        .where(back.c.depth == 1)
+        .limit(1)
+    )
+
+
+# ------------------------------
+# CSR-кэш графа пользователя
+# ------------------------------
+class _CSR:
+    """Рёбра узла i — позиции indptr[i]:indptr[i + 1] в indices/kinds/weights"""
+    __slots__ = ("indptr", "indices", "kinds", "weights")
+
+    def __init__(self, size: int, edges: List[Tuple[int, int, int, float]]):
+        counts = [0] * (size + 1)
+        for near, _, _, _ in edges:
+            counts[near + 1] += 1
+        for i in range(size):
+            counts[i + 1] += counts[i]
+        self.indptr = array("l", counts)
+        self.indices = array("l", bytes(self.indptr.itemsize * len(edges)))
+        self.kinds = array("b", bytes(len(edges)))
+        self.weights = array("d", bytes(8 * len(edges)))
+        cursor = counts[:-1]
+        for near, far, kind, weight in edges:
+            position = cursor[near]
+            cursor[near] += 1
+            self.indices[position] = far
+            self.kinds[position] = kind
+            self.weights[position] = weight
+
+
+class AdjacencyGraph:
+    """Граф связей в памяти: исходящие и входящие рёбра в CSR, обход — BFS с теми же фильтрами, что у CTE"""
+
+    def __init__(self, edges: Iterable[Tuple[UUID, UUID, Optional[str], Optional[float]]]):
+        self.ids: List[UUID] = []
+        self.index: Dict[UUID, int] = {}
+        forward, backward = [], []
+        for source_id, target_id, link_type, weight in edges:
+            source, target = self._node(source_id), self._node(target_id)
+            kind = _KIND.get(link_type, -1)
+            weight = math.nan if weight is None else weight  # NULL не проходит фильтр по весу, как в SQL
+            forward.append((source, target, kind, weight))
+            backward.append((target, source, kind, weight))
+        self.edge_count = len(forward)
+        self.out = _CSR(len(self.ids), forward)
+        self.inc = _CSR(len(self.ids), backward)
+
+    def _node(self, entity_id: UUID) -> int:
+        node = self.index.get(entity_id)
+        if node is None:
+            node = self.index[entity_id] = len(self.ids)
+            self.ids.append(entity_id)
+        return node
+
+    def walk(
+            self,
+            start_ids: Iterable[UUID],
+            direction: str = OUT,
+            link_types: Optional[Sequence[str]] = None,
+            min_weight: Optional[float] = None,
+            max_depth: int = MAX_DEPTH
+    ) -> Dict[UUID, int]:
+        starts = [self.index[entity_id] for entity_id in start_ids if entity_id in self.index]
+        _, depth = self._bfs(starts, direction, link_types, min_weight, max_depth)
+        return {self.ids[node]: level for node, level in depth.items() if level}
+
+    def path(
+            self,
+            source_id: UUID,
+            target_id: UUID,
+            direction: str = OUT,
+            link_types: Optional[Sequence[str]] = None,
+            min_weight: Optional[float] = None,
+            max_depth: int = PATH_MAX_DEPTH
+    ) -> Optional[List[UUID]]:
+        source, target = self.index.get(source_id), self.index.get(target_id)
+        if source is None or target is None or source == target:
+            return None
+        parent, _ = self._bfs([source], direction, link_types, min_weight, max_depth, target)
+        if target not in parent:
+            return None
+        path = [target]
+        while path[-1] != source:
+            path.append(parent[path[-1]])
+        return [self.ids[node] for node in reversed(path)]
+
+    def _bfs(self, starts, direction, link_types, min_weight, max_depth, target=None):
+        kinds = None if not link_types else {_KIND[name] for name in link_types}
+        csrs = {OUT: (self.out,), IN: (self.inc,)}.get(direction, (self.out, self.inc))
+        parent = dict.fromkeys(starts, -1)
+        depth = dict.fromkeys(starts, 0)
+        frontier, level = list(starts), 0
+        while frontier and level < max_depth:
+            level += 1
+            next_frontier = []
+            for node in frontier:
+                for csr in csrs:
+                    indices, edge_kinds, weights = csr.indices, csr.kinds, csr.weights
+                    for position in range(csr.indptr[node], csr.indptr[node + 1]):
+                        if kinds is not None and edge_kinds[position] not in kinds:
+                            continue
+                        if min_weight is not None and not weights[position] >= min_weight:
+                            continue
+                        far = indices[position]
+                        if far in parent:
+                            continue
+                        parent[far] = node
+                        depth[far] = level
+                        if far == target:
+                            return parent, depth
+                        next_frontier.append(far)
+            frontier = next_frontier
+        return parent, depth
+
+
+GRAPH_CACHE_CHANNEL = "nexus_relationships"
+adjacency_cache = TTLCache(
+    maxsize=int(os.getenv("GRAPH_CACHE_SIZE", 64)),
+    ttl=float(os.getenv("GRAPH_CACHE_TTL", 600))
+)
+
+
+def _on_links_changed(payload: str):
+    for user_id in filter(None, payload.split(",")):
+        adjacency_cache.invalidate(UUID(user_id))
+
+
+invalidation_bus.subscribe(GRAPH_CACHE_CHANNEL, _on_links_changed)
+
+
+async def invalidate_links(session: AsyncSession, user_ids: Iterable[UUID]):
+    """Сбрасывает CSR-кэш пользователей во всех процессах (NOTIFY уходит после commit)"""
+    user_ids = list(dict.fromkeys(user_ids))
+    for user_id in user_ids:
+        adjacency_cache.invalidate(user_id)
+    # Payload NOTIFY ограничен 8000 байт: по 100 id на сообщение
+    for i in range(0, len(user_ids), 100):
+        payload = ",".join(str(user_id) for user_id in user_ids[i:i + 100])
+        await invalidation_bus.publish(session, GRAPH_CACHE_CHANNEL, payload)
+
+
+# ------------------------------
+# Сервис
+# ------------------------------
+class GraphService:
+    """Обход связей: рекурсивные CTE в БД или, при cached=True, BFS по CSR-кэшу графа пользователя.
+    use_closure (по умолчанию GRAPH_USE_CLOSURE) — обход иерархии по таблице замыкания"""
+
+    def __init__(self, session: AsyncSession, cached: bool = False, use_closure: Optional[bool] = None):
+        self.session = session
+        self.cached = cached
+        self.use_closure = USE_CLOSURE if use_closure is None else use_closure
+
+    async def descendants(
+            self,
+            user_id: UUID,
+            entity_id: UUID,
+            link_types: Optional[Sequence[str]] = None,
+            min_weight: Optional[float] = None,
+            max_depth: int = MAX_DEPTH
+    ) -> Dict[UUID, int]:
+        """Всё, что ниже entity_id (по направлению связей): {id: глубина}"""
+        return await self._walk(user_id, [entity_id], OUT, link_types, min_weight, max_depth)
+
+    async def ancestors(
+            self,
+            user_id: UUID,
+            entity_id: UUID,
+            link_types: Optional[Sequence[str]] = None,
+            min_weight: Optional[float] = None,
+            max_depth: int = MAX_DEPTH
+    ) -> Dict[UUID, int]:
+        """Всё, что выше entity_id (против направления связей): {id: глубина}"""
+        return await self._walk(user_id, [entity_id], IN, link_types, min_weight, max_depth)
+
+    async def neighbourhood(
+            self,
+            user_id: UUID,
+            entity_id: UUID,
+            hops: int = 1,
+            link_types: Optional[Sequence[str]] = None,
+            min_weight: Optional[float] = None
+    ) -> Dict[UUID, int]:
+        """Окрестность в hops шагов без учёта направления: {id: расстояние}"""
+        return await self._walk(user_id, [entity_id], BOTH, link_types, min_weight, hops)
+
+    async def path(
+            self,
+            user_id: UUID,
+            source_id: UUID,
+            target_id: UUID,
+            link_types: Optional[Sequence[str]] = None,
+            min_weight: Optional[float] = None,
+            max_depth: int = PATH_MAX_DEPTH,
+            directed: bool = True
+    ) -> Optional[List[UUID]]:
+        """Кратчайший путь списком id (включая концы) или None"""
+        direction = OUT if directed else BOTH
+        if self.cached:
+            graph = await self.adjacency(user_id)
+            return graph.path(source_id, target_id, direction, link_types, min_weight, max_depth)
+        result = await self.session.execute(
+            path_query(source_id, target_id, direction, link_types, min_weight, max_depth, user_id)
+        )
+        path = result.scalar()
+        return list(path) if path else None
+
+    async def adjacency(self, user_id: UUID) -> AdjacencyGraph:
+        """CSR-граф пользователя из кэша; при промахе — одна выборка всех его связей"""
+        graph = adjacency_cache.get(user_id)
+        if graph is None:
+            source, target = _entities.alias("source_entity"), _entities.alias("target_entity")
+            result = await self.session.execute(
+                select(
+                    _relationships.c.source_id,
+                    _relationships.c.target_id,
+                    _relationships.c.link_type,
+                    _relationships.c.weight,
+                )
+                .join(source, source.c.id == _relationships.c.source_id)
+                .join(target, target.c.id == _relationships.c.target_id)
+                .where(source.c.user_id == user_id, target.c.user_id == user_id)
+            )
+            graph = AdjacencyGraph(result.tuples())
+            adjacency_cache.set(user_id, graph)
+        return graph
+
+    async def add_link(
+            self,
+            user_id: UUID,
+            source_id: UUID,
+            target_id: UUID,
+            link_type: str = "reference",
+            weight: float = 0.5
+    ):
+        """Создаёт связь или обновляет тип и вес существующей (одна связь на пару).
+        Связи hierarchy ведут таблицу замыкания; цикл в иерархии — HierarchyCycleError"""
+        from services.hierarchy import HIERARCHY, HierarchyService
+
+        hierarchy = HierarchyService(self.session)
+        # Блокировка до чтения прежнего типа: иначе параллельная правка той же пары меняет его после чтения
+        await hierarchy.lock(user_id)
+        previous = await self.session.scalar(
+            select(_relationships.c.link_type)
+            .where(_relationships.c.source_id == source_id, _relationships.c.target_id == target_id)
+            .with_for_update()
+        )
+        if link_type == HIERARCHY and previous != HIERARCHY:
+            # До записи связи: проверка на цикл идёт по замыканию
+            await hierarchy.link_added(user_id, source_id, target_id)
+        statement = pg_insert(_relationships).values(
+            source_id=source_id, target_id=target_id, link_type=link_type, weight=weight
+        )
+        await self.session.execute(statement.on_conflict_do_update(
+            index_elements=[_relationships.c.source_id, _relationships.c.target_id],
+            set_={"link_type": statement.excluded.link_type, "weight": statement.excluded.weight}
+        ))
+        if previous == HIERARCHY and link_type != HIERARCHY:
+            await hierarchy.link_removed(user_id, source_id, target_id)
+        await invalidate_links(self.session, [user_id])
+
+    async def remove_link(self, user_id: UUID, source_id: UUID, target_id: UUID) -> bool:
+        from services.hierarchy import HIERARCHY, HierarchyService
+
+        hierarchy = HierarchyService(self.session)
+        # Та же очередность, что в add_link: сначала блокировка пользователя, потом строка связи
+        await hierarchy.lock(user_id)
+        result = await self.session.execute(
+            delete(_relationships)
+            .where(and_(_relationships.c.source_id == source_id, _relationships.c.target_id == target_id))
+            .returning(_relationships.c.link_type)
+        )
+        link_type = result.scalar()
+        if link_type is None:
+            return False
+        if link_type == HIERARCHY:
+            await hierarchy.link_removed(user_id, source_id, target_id)
+        await invalidate_links(self.session, [user_id])
+        return True
+
+    async def _walk(self, user_id, start_ids, direction, link_types, min_weight, max_depth) -> Dict[UUID, int]:
+        if self.cached:
+            graph = await self.adjacency(user_id)
+            return graph.walk(start_ids, direction, link_types, min_weight, max_depth)
+        if self.use_closure and list(link_types or ()) == ["hierarchy"] and min_weight is None and direction != BOTH:
+            # Только иерархия: готовые пары из таблицы замыкания вместо рекурсии
+            return await self._closure_walk(user_id, start_ids, direction, max_depth)
+        result = await self.session.execute(
+            walk_query(start_ids, direction, link_types, min_weight, max_depth, user_id)
+        )
+        return dict(result.tuples())
+
+    async def _closure_walk(self, user_id, start_ids, direction, max_depth) -> Dict[UUID, int]:
+        closure = HierarchyClosure.__table__
+        near, far = (
+            (closure.c.ancestor_id, closure.c.descendant_id) if direction == OUT
+            else (closure.c.descendant_id, closure.c.ancestor_id)
+        )
+        result = await self.session.execute(
+            select(far, func.min(closure.c.depth))
+            .join(_entities, _entities.c.id == far)
+            .where(
+                near.in_(start_ids),
+                far.notin_(start_ids),
+                closure.c.depth <= max_depth,
+                _entities.c.user_id == user_id,
+            )
+            .group_by(far)
+        )
+        return dict(result.tuples())
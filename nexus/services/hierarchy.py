@@ -0,0 +1,213 @@
+# /sd/nexus/services/hierarchy.py
+import asyncio
+from typing import Dict, Iterable, List, Optional, Sequence
+from uuid import UUID
+
+from sqlalchemy import and_, delete, distinct, exists, func, literal, select, true, union_all, update
+from sqlalchemy.dialects.postgresql import UUID as PG_UUID, insert as pg_insert
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from engines import use_primary
+from logger import logger
+from models.planning import Entity, HierarchyClosure, Relationship
+from services.graph import MAX_DEPTH, OUT, walk_query
+
+HIERARCHY = "hierarchy"
+
+_closure = HierarchyClosure.__table__
+_entities = Entity.__table__
+_relationships = Relationship.__table__
+_COLUMNS = ["ancestor_id", "descendant_id", "depth", "path_count"]
+
+
+class HierarchyCycleError(ValueError):
+    """Связь сделала бы сущность собственным предком"""
+
+
+def _with_self(node_id: UUID, own, other, name: str):
+    """Узел (глубина 0, один путь) вместе со всеми его предками (own=descendant_id) или потомками"""
+    return union_all(
+        select(
+            literal(node_id, PG_UUID(as_uuid=True)).label("node_id"),
+            literal(0).label("depth"),
+            literal(1).label("paths"),
+        ),
+        select(other.label("node_id"), _closure.c.depth, _closure.c.path_count).where(own == node_id),
+    ).subquery(name)
+
+
+def _crossing(source_id: UUID, target_id: UUID):
+    """Пары (предок, потомок), пути между которыми проходят через связь source → target"""
+    up = _with_self(source_id, _closure.c.descendant_id, _closure.c.ancestor_id, "up")
+    down = _with_self(target_id, _closure.c.ancestor_id, _closure.c.descendant_id, "down")
+    return up, down, (
+        select(
+            up.c.node_id.label("ancestor_id"),
+            down.c.node_id.label("descendant_id"),
+            (up.c.depth + 1 + down.c.depth).label("depth"),
+            (up.c.paths * down.c.paths).label("path_count"),
+        )
+        .select_from(up.join(down, true()))
+    )
+
+
+class HierarchyService:
+    """Таблица замыкания для связей hierarchy: поддержка при изменении связей, поддеревья и сводки одним JOIN"""
+
+    def __init__(self, session: AsyncSession):
+        self.session = session
+
+    async def lock(self, user_id: UUID):
+        """Правки связей и иерархии одного пользователя идут по очереди (до конца транзакции).
+        Замыкание читается и пишется на основной БД"""
+        use_primary(self.session)
+        await self.session.execute(select(func.pg_advisory_xact_lock(func.hashtext(f"hierarchy:{user_id}"))))
+
+    async def link_added(self, user_id: UUID, source_id: UUID, target_id: UUID):
+        """Новая связь hierarchy: все предки source получают всех потомков target (вызывать до записи связи)"""
+        await self.lock(user_id)
+        if source_id == target_id or await self.is_ancestor(target_id, source_id):
+            raise HierarchyCycleError(f"{target_id} уже выше {source_id} в иерархии")
+        _, _, rows = _crossing(source_id, target_id)
+        statement = pg_insert(_closure).from_select(_COLUMNS, rows)
+        await self.session.execute(statement.on_conflict_do_update(
+            index_elements=[_closure.c.ancestor_id, _closure.c.descendant_id],
+            set_={
+                "depth": func.least(_closure.c.depth, statement.excluded.depth),
+                "path_count": _closure.c.path_count + statement.excluded.path_count,
+            }
+        ))
+
+    async def link_removed(self, user_id: UUID, source_id: UUID, target_id: UUID):
+        """Удалённая связь hierarchy (вызывать после удаления связи): минус пути через неё, пересчёт глубин"""
+        await self.lock(user_id)
+        up, down, rows = _crossing(source_id, target_id)
+        removed = rows.subquery("removed")
+        ancestors = list((await self.session.execute(select(up.c.node_id))).scalars())
+        in_scope = and_(
+            _closure.c.ancestor_id.in_(select(up.c.node_id)),
+            _closure.c.descendant_id.in_(select(down.c.node_id)),
+        )
+        await self.session.execute(
+            update(_closure)
+            .where(
+                _closure.c.ancestor_id == removed.c.ancestor_id,
+                _closure.c.descendant_id == removed.c.descendant_id,
+            )
+            .values(path_count=_closure.c.path_count - removed.c.path_count)
+        )
+        await self.session.execute(delete(_closure).where(in_scope, _closure.c.path_count <= 0))
+
+        # Оставшиеся пары могли потерять кратчайший путь: глубина заново по связям от каждого предка
+        for ancestor_id in ancestors:
+            shortest = walk_query([ancestor_id], OUT, [HIERARCHY], user_id=user_id).subquery("shortest")
+            await self.session.execute(
+                update(_closure)
+                .where(
+                    _closure.c.ancestor_id == ancestor_id,
+                    _closure.c.descendant_id == shortest.c.node_id,
+                    _closure.c.descendant_id.in_(select(down.c.node_id)),
+                    _closure.c.depth != shortest.c.depth,
+                )
+                .values(depth=shortest.c.depth)
+            )
+
+    async def is_ancestor(self, ancestor_id: UUID, descendant_id: UUID) -> bool:
+        return bool(await self.session.scalar(select(exists().where(
+            _closure.c.ancestor_id == ancestor_id, _closure.c.descendant_id == descendant_id
+        ))))
+
+    async def subtree(
+            self,
+            ancestor_id: UUID,
+            types: Optional[Sequence[str]] = None,
+            max_depth: Optional[int] = None
+    ) -> List:
+        """Все сущности под ancestor_id, включая вложенные проекты: один JOIN по первичному ключу замыкания.
+        Например, все задачи области: subtree(area_id, types=["task"])"""
+        query = (
+            select(_entities, _closure.c.depth)
+            .join(_closure, _closure.c.descendant_id == _entities.c.id)
+            .where(_closure.c.ancestor_id == ancestor_id)
+            .order_by(_closure.c.depth, _entities.c.created_at)
+        )
+        if types:
+            query = query.where(_entities.c.type.in_(types))
+        if max_depth is not None:
+            query = query.where(_closure.c.depth <= max_depth)
+        return (await self.session.execute(query)).all()
+
+    async def rollups(self, ancestor_ids: Iterable[UUID]) -> Dict[UUID, Dict[str, Dict[str, int]]]:
+        """Сводка для дашборда одним запросом на все корни: {корень: {тип: {статус: число}}}"""
+        ancestor_ids = list(ancestor_ids)
+        result = {ancestor_id: {} for ancestor_id in ancestor_ids}
+        if not ancestor_ids:
+            return result
+        rows = await self.session.execute(
+            select(_closure.c.ancestor_id, _entities.c.type, _entities.c.status, func.count())
+            .join(_entities, _entities.c.id == _closure.c.descendant_id)
+            .where(_closure.c.ancestor_id.in_(ancestor_ids))
+            .group_by(_closure.c.ancestor_id, _entities.c.type, _entities.c.status)
+        )
+        for ancestor_id, kind, status, count in rows:
+            result[ancestor_id].setdefault(kind, {})[status] = count
+        return result
+
+    async def rebuild(self, user_ids: Optional[Sequence[UUID]] = None, max_depth: int = MAX_DEPTH) -> int:
+        """Пересчёт замыкания с нуля (для всех или для сущностей указанных пользователей); число строк"""
+        use_primary(self.session)
+        rel = _relationships
+        seed = (
+            select(rel.c.source_id.label("ancestor_id"), rel.c.target_id.label("descendant_id"), literal(1).label("depth"))
+            .where(rel.c.link_type == HIERARCHY)
+        )
+        owned = None
+        if user_ids is not None:
+            # Связи этих пользователей не меняются, пока их замыкание пересчитывается
+            for user_id in sorted(user_ids):
+                await self.lock(user_id)
+            owned = select(_entities.c.id).where(_entities.c.user_id.in_(user_ids))
+            seed = seed.where(rel.c.source_id.in_(owned))
+        # UNION ALL перечисляет каждый путь: count(*) по паре и есть path_count
+        walk = seed.cte("walk", recursive=True)
+        step = (
+            select(walk.c.ancestor_id, rel.c.target_id, walk.c.depth + 1)
+            .select_from(walk)
+            .join(rel, and_(rel.c.source_id == walk.c.descendant_id, rel.c.link_type == HIERARCHY))
+            .where(walk.c.depth < max_depth, rel.c.target_id != walk.c.ancestor_id)
+        )
+        walk = walk.union_all(step)
+        rows = (
+            select(walk.c.ancestor_id, walk.c.descendant_id, func.min(walk.c.depth), func.count())
+            .group_by(walk.c.ancestor_id, walk.c.descendant_id)
+        )
+
+        clear = delete(_closure)
+        if owned is not None:
+            clear = clear.where(_closure.c.ancestor_id.in_(owned))
+        await self.session.execute(clear)
+        result = await self.session.execute(pg_insert(_closure).from_select(_COLUMNS, rows))
+        return result.rowcount
+
+
+async def rebuild_all(session_factory, chunk_size: int = 500, pause: float = 0.1) -> int:
+    """Бэкфилл замыкания по пользователям пачками, каждая пачка — своя транзакция"""
+    async with session_factory() as session:
+        use_primary(session)
+        result = await session.execute(
+            select(distinct(_entities.c.user_id))
+            .join(_relationships, _relationships.c.source_id == _entities.c.id)
+            .where(_relationships.c.link_type == HIERARCHY)
+            .order_by(_entities.c.user_id)
+        )
+        user_ids = list(result.scalars())
+
+    total = 0
+    for i in range(0, len(user_ids), chunk_size):
+        chunk = user_ids[i:i + chunk_size]
+        async with session_factory() as session:
+            total += await HierarchyService(session).rebuild(chunk)
+            await session.commit()
+        logger.info(f"Замыкание иерархии: {min(i + chunk_size, len(user_ids))} из {len(user_ids)} пользователей")
+        await asyncio.sleep(pause)
+    return total
@@ -1,154 +1,548 @@
-class TemplateService:
+# /sd/nexus/services/planning.py
+import asyncio
+import os
+import re
+import uuid
+from collections import deque
+from typing import Any, Dict, Iterable, List, NamedTuple, Optional, Tuple
+from uuid import UUID
+
+from sqlalchemy import func, insert, select
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import sessionmaker
+
+from engines import RoutingSession, get_engines, use_primary
+from logger import logger
+from models.planning import (ActionType, Entity, Habit, Project, Relationship, Resource, Task, Template,
+                             TemplateInstance, TriggerAction, TriggerType)
+from services.cache import MISSING, TTLCache
+from services.graph import invalidate_links
+
+# Шаблоны применяются через Core: граф собирается в памяти с UUID на стороне клиента
+# и пишется несколькими многострочными INSERT в одной транзакции, без unit of work по объекту.
+_entities = Entity.__table__
+_templates = Template.__table__
+
+_session_factory = None
+
+
+def _async_session() -> AsyncSession:
+    global _session_factory
+    if _session_factory is None:
+        _session_factory = sessionmaker(
+            get_engines().async_, class_=AsyncSession, expire_on_commit=False, sync_session_class=RoutingSession
+        )
+    return _session_factory()
+
+
+# ------------------------------
+# Компиляция шаблонов в план подстановки
+# ------------------------------
+_PLACEHOLDER = re.compile(r"\{(\w+)\}")
+
+
+class TemplateParameterError(ValueError):
+    """Параметры пользователя не прошли проверку по схеме шаблона"""
+
+
+class TemplateBlueprintError(ValueError):
+    """Шаблон (после подстановки параметров) описывает то, чего нет: например, неизвестный тип триггера"""
+
+
+def _trigger_type(value) -> TriggerType:
+    try:
+        return TriggerType(value)
+    except ValueError:
+        allowed = ", ".join(item.value for item in TriggerType)
+        raise TemplateBlueprintError(f"неизвестный тип триггера {value!r} (допустимы: {allowed})") from None
+
+
+def _to_int(value) -> int:
+    if isinstance(value, bool):
+        raise ValueError(value)
+    number = float(value) if isinstance(value, str) else value
+    if number != int(number):
+        raise ValueError(value)
+    return int(number)
+
+
+def _to_float(value) -> float:
+    if isinstance(value, bool):
+        raise ValueError(value)
+    return float(value)
+
+
+def _to_bool(value) -> bool:
+    if isinstance(value, (bool, int)):
+        return bool(value)
+    text = str(value).strip().lower()
+    if text in ("1", "true", "yes", "on", "да"):
+        return True
+    if text in ("0", "false", "no", "off", "нет"):
+        return False
+    raise ValueError(value)
+
+
+_COERCE = {"int": _to_int, "float": _to_float, "bool": _to_bool, "str": str}
+
+
+class ParameterSpec(NamedTuple):
+    name: str
+    type: str
+    default: Any = MISSING
+
+
+def parse_schema(parameters: Optional[dict]) -> Dict[str, ParameterSpec]:
+    """Схема из Template.parameters: значение по умолчанию ({"target_weight_loss": 50})
+    или явное описание ({"target_weight_loss": {"type": "int", "default": 50}})"""
+    schema = {}
+    for name, value in (parameters or {}).items():
+        if isinstance(value, dict) and "type" in value:
+            schema[name] = ParameterSpec(name, value["type"], value.get("default", MISSING))
+        else:
+            kind = type(value).__name__
+            schema[name] = ParameterSpec(name, kind if kind in _COERCE else "str", value)
+    return schema
+
+
+def _render(value) -> str:
+    return format(value, "g") if isinstance(value, float) else str(value)
+
+
+class BlueprintPlan:
+    """Шаблон, разобранный один раз: пути к плейсхолдерам и схема параметров.
+    Подстановка копирует только контейнеры на путях к плейсхолдерам, остальное дерево общее с планом —
+    результат только для чтения."""
+
+    def __init__(self, blueprint: dict, parameters: Optional[dict] = None):
+        self.blueprint = blueprint
+        self.schema = parse_schema(parameters)
+        # (путь, имя параметра для "{name}" целиком, строка для встроенных плейсхолдеров)
+        self.slots: List[Tuple[tuple, Optional[str], Optional[str]]] = []
+        self._compile()
+
+    def _compile(self):
+        stack = [((), self.blueprint)]
+        while stack:
+            path, node = stack.pop()
+            if isinstance(node, dict):
+                stack.extend((path + (key,), value) for key, value in node.items())
+            elif isinstance(node, list):
+                stack.extend((path + (index,), value) for index, value in enumerate(node))
+            elif isinstance(node, str) and path:
+                whole = _PLACEHOLDER.fullmatch(node)
+                names = [whole.group(1)] if whole else _PLACEHOLDER.findall(node)
+                if not names:
+                    continue
+                self.slots.append((path, whole.group(1), None) if whole else (path, None, node))
+                for name in names:
+                    # Плейсхолдер без описания в схеме — обязательная строка
+                    self.schema.setdefault(name, ParameterSpec(name, "str"))
+
+    def validate(self, parameters: Optional[dict]) -> Dict[str, Any]:
+        """Значения всех параметров схемы, приведённые к типам; TemplateParameterError со всеми ошибками сразу"""
+        parameters = parameters or {}
+        errors = [f"{name}: неизвестный параметр" for name in parameters if name not in self.schema]
+        values = {}
+        for spec in self.schema.values():
+            value = parameters.get(spec.name, spec.default)
+            if value is MISSING:
+                errors.append(f"{spec.name}: не задан")
+                continue
+            try:
+                values[spec.name] = _COERCE[spec.type](value)
+            except (KeyError, TypeError, ValueError, OverflowError):
+                errors.append(f"{spec.name}: ожидается {spec.type}, получено {value!r}")
+        if errors:
+            raise TemplateParameterError("; ".join(errors))
+        return values
+
+    def render(self, values: Dict[str, Any]) -> dict:
+        """Подстановка уже проверенных значений; стоимость — по числу плейсхолдеров"""
+        if not self.slots:
+            return self.blueprint
+        root = dict(self.blueprint)
+        copies = {(): root}
+        for path, name, text in self.slots:
+            if name is not None:
+                value = values[name]
+            else:
+                value = _PLACEHOLDER.sub(lambda match: _render(values[match.group(1)]), text)
+            self._writable(path[:-1], copies)[path[-1]] = value
+        return root
+
+    def _writable(self, path: tuple, copies: dict):
+        node = copies.get(path)
+        if node is None:
+            parent = self._writable(path[:-1], copies)
+            original = parent[path[-1]]
+            node = dict(original) if isinstance(original, dict) else list(original)
+            parent[path[-1]] = node
+            copies[path] = node
+        return node
+
+
+# Планы по (id шаблона, updated_at): правка шаблона меняет ключ, старая версия уходит по LRU
+_plans = TTLCache(maxsize=int(os.getenv("TEMPLATE_PLAN_CACHE_SIZE", "256")))
+
+
+def get_plan(template) -> BlueprintPlan:
+    """template — строка TemplateService.get_template"""
+    key = (template.id, template.updated_at)
+    plan = _plans.get(key)
+    if plan is None:
+        plan = BlueprintPlan(template.blueprint_data, template.parameters)
+        _plans.set(key, plan)
+    return plan
+
+
+class TemplateGraph:
+    """Строки для вставки, сгруппированные по таблицам в порядке внешних ключей"""
+
     def __init__(self):
-        self.session = db_session
+        self.entities: List[Dict[str, Any]] = []
+        self.projects: List[Dict[str, Any]] = []
+        self.tasks: List[Dict[str, Any]] = []
+        self.habits: List[Dict[str, Any]] = []
+        self.resources: List[Dict[str, Any]] = []
+        self.triggers: List[Dict[str, Any]] = []
+        self.relationships: List[Dict[str, Any]] = []
+        self.instances: List[Dict[str, Any]] = []
+
+    def add_entity(self, user_id: UUID, kind: str, title: str, description: Optional[str]) -> UUID:
+        entity_id = uuid.uuid4()
+        self.entities.append({
+            "id": entity_id,
+            "user_id": user_id,
+            "type": kind,
+            "title": title,
+            "description": description,
+            "status": "active",
+        })
+        return entity_id
+
+    def link(self, source_id: UUID, target_id: UUID, link_type: str = "dependency"):
+        self.relationships.append({"source_id": source_id, "target_id": target_id, "link_type": link_type})
+
+    def add_instance(self, template_id: UUID, user_id: UUID, parameters: Dict[str, Any]):
+        self.instances.append({
+            "id": uuid.uuid4(), "template_id": template_id, "user_id": user_id, "parameters": parameters
+        })
+
+    def extend(self, other: "TemplateGraph"):
+        for name, rows in vars(other).items():
+            getattr(self, name).extend(rows)
+
+    def inserts(self):
+        return (
+            (_entities, self.entities),
+            (Project.__table__, self.projects),
+            (Task.__table__, self.tasks),
+            (Habit.__table__, self.habits),
+            (Resource.__table__, self.resources),
+            (TriggerAction.__table__, self.triggers),
+            (Relationship.__table__, self.relationships),
+            (TemplateInstance.__table__, self.instances),
+        )
+
+    @property
+    def summary(self) -> str:
+        return f"Создано: {len(self.tasks)} задач, {len(self.habits)} привычек, {len(self.resources)} наград"
+
+
+def build_template_graph(blueprint: dict, user_id: UUID, graph: Optional[TemplateGraph] = None) -> TemplateGraph:
+    """Собирает граф сущностей шаблона в памяти (или дописывает в graph); в базу ничего не пишет"""
+    graph = graph if graph is not None else TemplateGraph()
+
+    # Область "Здоровье"
+    area = blueprint.get("area", {})
+    area_id = graph.add_entity(
+        user_id, "area",
+        area.get("title", "Здоровье"),
+        area.get("description", "Сфера жизни: здоровье, спорт, питание"),
+    )
+
+    # Проект "Сбросить N кг", связанный с областью
+    project = blueprint.get("project", {})
+    project_id = graph.add_entity(
+        user_id, "project",
+        project.get("title", "Сбросить 50 кг"),
+        project.get("description", "Цель: похудеть на 50 кг"),
+    )
+    graph.projects.append({
+        "id": project_id,
+        "kpi_target": project.get("kpi_target", {"target_weight_loss": 50}),
+        "kpi_current": {"current_weight_loss": 0},
+    })
+    graph.link(area_id, project_id)
+
+    # Ключевые результаты (-10кг, -20кг и т.д.)
+    for task_data in blueprint.get("tasks", []):
+        task_id = graph.add_entity(
+            user_id, "task",
+            task_data.get("title", "Сбросить 10кг"),
+            task_data.get("description", "Контрольная точка"),
+        )
+        graph.tasks.append({"id": task_id, "project_id": project_id})
+        graph.link(task_id, project_id)
+
+    # Привычки (тренировка, питание, вода); награды ищут их по названию только среди созданных здесь
+    habits_by_title: Dict[str, UUID] = {}
+    for habit_data in blueprint.get("habits", []):
+        title = habit_data.get("title", "Ежедневная тренировка")
+        habit_id = graph.add_entity(user_id, "habit", title, habit_data.get("description", "30 минут кардио"))
+        graph.habits.append({
+            "id": habit_id,
+            "area_id": area_id,
+            "target_metric": habit_data.get("target_metric", {"daily_calories_burned": 500}),
+            "current_metric": {"today": 0, "streak": 0},
+        })
+        graph.link(habit_id, project_id)
+        habits_by_title.setdefault(title, habit_id)
+
+    # Награды и триггеры
+    for reward_data in blueprint.get("rewards", []):
+        reward_id = graph.add_entity(
+            user_id, "resource",
+            reward_data.get("title", "Стакан кофе"),
+            reward_data.get("description", "Награда за 5 дней тренировок"),
+        )
+        graph.resources.append({"id": reward_id})
+
+        trigger = reward_data.get("trigger", {})
+        # trigger_actions не входит в entities, поэтому привычка хранится в entity_id, а не в Relationship
+        graph.triggers.append({
+            "id": uuid.uuid4(),
+            "user_id": user_id,
+            "title": trigger.get("title", "Награда за 5 дней тренировок"),
+            "trigger_type": _trigger_type(trigger.get("type", TriggerType.HABIT_STREAK.value)),
+            "action_type": ActionType.UNLOCK_REWARD,
+            "condition": trigger.get("condition", {"streak": 5}),
+            "action_params": {"reward": str(reward_id)},
+            "is_active": True,
+            "entity_id": habits_by_title.get(trigger.get("habit_title", "Ежедневная тренировка")),
+            "reward_id": reward_id,
+        })
+
+    return graph
+
+
+class TemplateService:
+    """Применение шаблонов; без переданной сессии открывает свою и фиксирует её при выходе"""
+
+    def __init__(self, session: Optional[AsyncSession] = None):
+        self.session = session
+        self._owns_session = session is None
 
     async def __aenter__(self):
+        if self.session is None:
+            self.session = _async_session()
         return self
 
     async def __aexit__(self, exc_type, exc_val, exc_tb):
+        if not self._owns_session:
+            return
         if exc_type:
-            self.session.rollback()
+            await self.session.rollback()
         else:
-            self.session.commit()
-        self.session.close()
+            await self.session.commit()
+        await self.session.close()
+        self.session = None
+
+    async def get_template(self, template_id: UUID):
+        """Строка шаблона: id, is_active, blueprint_data, parameters, updated_at"""
+        result = await self.session.execute(
+            select(
+                _templates.c.id,
+                _templates.c.is_active,
+                _templates.c.blueprint_data,
+                _templates.c.parameters,
+                _entities.c.updated_at,
+            )
+            .join_from(_templates, _entities, _templates.c.id == _entities.c.id)
+            .where(_templates.c.id == template_id)
+        )
+        return result.first()
 
-    async def apply_template(self, template_id: UUID, user_id: UUID, parameters: dict):
+    async def apply_template(self, template_id: UUID, user_id: UUID, parameters: dict) -> Tuple[bool, str]:
         """Применение шаблона пользователем"""
-        template = self.session.query(Template).filter_by(id=template_id).first()
+        template = await self.get_template(template_id)
         if not template or not template.is_active:
             return False, "Шаблон не найден или не активен"
 
-        # Подстановка параметров в шаблон
-        blueprint = template.blueprint_data
-        substituted_blueprint = self.substitute_parameters(blueprint, parameters)
-
-        # Создание области "Здоровье"
-        area = substituted_blueprint.get("area", {})
-        health_area = Entity(
-            id=uuid.uuid4(),
-            user_id=user_id,
-            title=area.get("title", "Здоровье"),
-            description=area.get("description", "Сфера жизни: здоровье, спорт, питание"),
-            type="area"
-        )
-        self.session.add(health_area)
-
-        # Создание проекта "Сбросить N кг"
-        project = substituted_blueprint.get("project", {})
-        weight_loss_project = Project(
-            id=uuid.uuid4(),
-            user_id=user_id,
-            title=project.get("title", "Сбросить 50 кг"),
-            description=project.get("description", "Цель: похудеть на 50 кг"),
-            kpi_target=project.get("kpi_target", {"target_weight_loss": 50}),
-            kpi_current={"current_weight_loss": 0}
-        )
-        self.session.add(weight_loss_project)
+        # Проверка параметров, подстановка и сборка графа — до первой записи в базу
+        plan = get_plan(template)
+        try:
+            values = plan.validate(parameters)
+        except TemplateParameterError as e:
+            return False, f"Неверные параметры шаблона: {e}"
+        try:
+            graph = build_template_graph(plan.render(values), user_id)
+        except TemplateBlueprintError as e:
+            return False, f"Ошибка в шаблоне: {e}"
+        graph.add_instance(template_id, user_id, values)
+        await self.write_graph(graph)
+        return True, graph.summary
 
-        # Связь проекта с областью через Relationship
-        relationship_area_project = Relationship(
-            source_id=health_area.id,
-            target_id=weight_loss_project.id,
-            link_type="dependency"
-        )
-        self.session.add(relationship_area_project)
-
-        # Создание ключевых результатов (-10кг, -20кг и т.д.)
-        tasks = substituted_blueprint.get("tasks", [])
-        for task_data in tasks:
-            task = Task(
-                id=uuid.uuid4(),
-                user_id=user_id,
-                title=task_data.get("title", "Сбросить 10кг"),
-                description=task_data.get("description", "Контрольная точка"),
-                type="task",
-                status="active",
-                project_id=weight_loss_project.id
-            )
-            self.session.add(task)
+    async def write_graph(self, graph: TemplateGraph):
+        """Один многострочный INSERT на таблицу (insertmanyvalues); транзакция — у сессии"""
+        for table, rows in graph.inserts():
+            if rows:
+                await self.session.execute(insert(table), rows)
+        if graph.relationships:
+            await invalidate_links(self.session, {row["user_id"] for row in graph.entities})
 
-            # Связь задачи с проектом
-            relationship_task_project = Relationship(
-                source_id=task.id,
-                target_id=weight_loss_project.id,
-                link_type="dependency"
-            )
-            self.session.add(relationship_task_project)
-
-        # Создание привычек (тренеровка, питание, вода)
-        habits = substituted_blueprint.get("habits", [])
-        for habit_data in habits:
-            habit = Habit(
-                id=uuid.uuid4(),
-                user_id=user_id,
-                title=habit_data.get("title", "Ежедневная тренировка"),
-                description=habit_data.get("description", "30 минут кардио"),
-                type="habit",
-                area_id=health_area.id,
-                target_metric=habit_data.get("target_metric", {"daily_calories_burned": 500}),
-                current_metric={"today": 0, "streak": 0}
-            )
-            self.session.add(habit)
 
-            # Связь привычки с проектом
-            relationship_habit_project = Relationship(
-                source_id=habit.id,
-                target_id=weight_loss_project.id,
-                link_type="dependency"
-            )
-            self.session.add(relationship_habit_project)
-
-        # Создание наград и триггеров
-        rewards = substituted_blueprint.get("rewards", [])
-        for reward_data in rewards:
-            # Создание награды
-            reward = Resource(
-                id=uuid.uuid4(),
-                user_id=user_id,
-                title=reward_data.get("title", "Стакан кофе"),
-                description=reward_data.get("description", "Награда за 5 дней тренировок"),
-                type="resource"
-            )
-            self.session.add(reward)
-
-            # Создание триггера
-            trigger = TriggerAction(
-                id=uuid.uuid4(),
-                user_id=user_id,
-                title=reward_data.get("trigger", {}).get("title", "Награда за 5 дней тренировок"),
-                trigger_type=reward_data.get("trigger", {}).get("type", "habit_streak"),
-                action_type="unlock_reward",
-                condition=reward_data.get("trigger", {}).get("condition", {"streak": 5}),
-                action_params={"reward": reward.id},
-                is_active=True
-            )
-            self.session.add(trigger)
-
-            # Связь триггера с привычкой
-            habit = self.session.query(Habit).filter_by(title=reward_data.get("trigger", {}).get("habit_title", "Ежедневная тренировка")).first()
-            if habit:
-                relationship_trigger_habit = Relationship(
-                    source_id=trigger.id,
-                    target_id=habit.id,
-                    link_type="dependency"
+# ------------------------------
+# Применение шаблона к группе пользователей
+# ------------------------------
+class CohortReport:
+    """Итог применения к группе: применено, пропущено (уже было), ошибки по пользователям"""
+
+    def __init__(self, total: int = 0):
+        self.total = total
+        self.applied = 0
+        self.skipped = 0
+        self.failed: Dict[str, str] = {}
+        self.error: Optional[str] = None  # Ошибка уровня шаблона: никому не применён
+
+    def fail(self, user_id, reason: str):
+        self.failed[str(user_id)] = reason
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "total": self.total,
+            "applied": self.applied,
+            "skipped": self.skipped,
+            "failed": self.failed,
+            "error": self.error,
+        }
+
+
+class CohortApplier:
+    """Шаблон для тысяч пользователей: пачки в отдельных транзакциях, параллельно по соединениям пула.
+    Прогресс — сами строки TemplateInstance: повторный запуск пропускает тех, кому шаблон уже применён."""
+
+    def __init__(self, chunk_size: int = 100, concurrency: Optional[int] = None, session_factory=None):
+        self.chunk_size = chunk_size
+        # По умолчанию — постоянная часть асинхронного пула: больше соединений всё равно не получить без overflow
+        self.concurrency = concurrency or get_engines().async_.pool.size()
+        self.session_factory = session_factory or _async_session
+
+    async def apply(self, template_id: UUID, assignments: Iterable[Tuple[Any, Optional[dict]]]) -> CohortReport:
+        """assignments — пары (user_id, параметры пользователя)"""
+        assignments = list(assignments)
+        report = CohortReport(len(assignments))
+        async with self.session_factory() as session:
+            # Транзакция этой сессии держит блокировку шаблона весь прогон: параллельный запуск того же шаблона
+            # ждёт и потом пропускает уже применённых, а не применяет шаблон им второй раз
+            use_primary(session)
+            await session.execute(select(func.pg_advisory_xact_lock(func.hashtext(f"template-cohort:{template_id}"))))
+            template = await TemplateService(session).get_template(template_id)
+            if not template or not template.is_active:
+                report.error = "Шаблон не найден или не активен"
+                return report
+            await self._apply_all(template_id, get_plan(template), assignments, report)
+        return report
+
+    async def _apply_all(self, template_id: UUID, plan: BlueprintPlan, assignments, report: CohortReport):
+        # Все параметры проверяются до первой транзакции
+        prepared: List[Tuple[UUID, Dict[str, Any]]] = []
+        seen = set()
+        for raw_user_id, parameters in assignments:
+            try:
+                user_id = raw_user_id if isinstance(raw_user_id, UUID) else UUID(str(raw_user_id))
+            except ValueError:
+                report.fail(raw_user_id, "некорректный user_id")
+                continue
+            if user_id in seen:
+                report.fail(user_id, "повторяется в списке")
+                continue
+            seen.add(user_id)
+            try:
+                prepared.append((user_id, plan.validate(parameters)))
+            except TemplateParameterError as e:
+                report.fail(user_id, f"Неверные параметры шаблона: {e}")
+
+        chunks = deque(prepared[i:i + self.chunk_size] for i in range(0, len(prepared), self.chunk_size))
+
+        async def worker():
+            while chunks:
+                await self._apply_chunk(template_id, plan, chunks.popleft(), report)
+                logger.info(
+                    f"Шаблон {template_id}: применено {report.applied}, пропущено {report.skipped}, "
+                    f"ошибок {len(report.failed)} из {report.total}"
                 )
-                self.session.add(relationship_trigger_habit)
-
-        # Сохранение всех изменений
-        self.session.commit()
-
-        return True, f"Создано: {len(tasks)} задач, {len(habits)} привычек, {len(rewards)} наград"
-
-    def substitute_parameters(self, blueprint: dict, parameters: dict):
-        """Подстановка пользовательских параметров в шаблон (например, target_weight_loss = 50)"""
-        # Рекурсивная замена {target_weight_loss} на значение из parameters
-        return substitute_dict_values(blueprint, parameters)
-
-def substitute_dict_values(data: dict, params: dict):
-    """Рекурсивная замена параметров в JSON-структуре"""
-    if isinstance(data, dict):
-        return {k: substitute_dict_values(v, params) for k, v in data.items()}
-    elif isinstance(data, str) and data.startswith("{") and data.endswith("}"):
-        param_name = data[1:-1]  # Удаление {}
-        return params.get(param_name, data)  # Замена на значение из parameters
-    return data
\ No newline at end of file
+
+        results = await asyncio.gather(
+            *(worker() for _ in range(min(self.concurrency, len(chunks)))), return_exceptions=True
+        )
+        errors = [result for result in results if isinstance(result, BaseException)]
+        if errors:
+            # Упавший воркер не должен молча оставить пачки без отчёта
+            logger.error(f"Шаблон {template_id}: воркеров упало {len(errors)}: {errors[0]!r}")
+            while chunks:
+                for user_id, _ in chunks.popleft():
+                    report.fail(user_id, f"не обработан: {errors[0]}")
+
+    async def _apply_chunk(self, template_id: UUID, plan: BlueprintPlan, chunk, report: CohortReport):
+        remaining = chunk  # Ещё не учтённые в отчёте
+        try:
+            async with self.session_factory() as session:
+                # Проверка прогресса не должна попасть на отстающую реплику
+                use_primary(session)
+                done = await self._applied_users(session, template_id, [user_id for user_id, _ in chunk])
+                pending = [(user_id, values) for user_id, values in chunk if user_id not in done]
+                report.skipped += len(chunk) - len(pending)
+                remaining = pending
+                if not pending:
+                    return
+
+                graph = TemplateGraph()
+                built = []
+                for user_id, values in pending:
+                    # Граф пользователя собирается отдельно: ошибка шаблона на его параметрах не задевает пачку
+                    try:
+                        user_graph = build_template_graph(plan.render(values), user_id)
+                    except TemplateBlueprintError as e:
+                        report.fail(user_id, f"Ошибка в шаблоне: {e}")
+                        continue
+                    graph.extend(user_graph)
+                    graph.add_instance(template_id, user_id, values)
+                    built.append((user_id, values))
+                pending = remaining = built
+                if not pending:
+                    return
+                try:
+                    await TemplateService(session).write_graph(graph)
+                    await session.commit()
+                    report.applied += len(pending)
+                    return
+                except SQLAlchemyError as e:
+                    await session.rollback()
+                    if len(pending) == 1:
+                        report.fail(pending[0][0], str(e.orig if getattr(e, "orig", None) else e))
+                        return
+                    logger.warning(
+                        f"Шаблон {template_id}: пачка из {len(pending)} откатилась ({e}), применяю по одному"
+                    )
+        except Exception as e:
+            # Соединение, проверка прогресса, откат: пачка уходит в ошибки, остальные пачки продолжают
+            logger.error(f"Шаблон {template_id}: пачка из {len(remaining)} не применена: {e}")
+            for user_id, _ in remaining:
+                report.fail(user_id, str(e))
+            return
+
+        # Откатившаяся пачка — по одному пользователю, чтобы ошибка досталась только виновным
+        for item in pending:
+            await self._apply_chunk(template_id, plan, [item], report)
+
+    @staticmethod
+    async def _applied_users(session: AsyncSession, template_id: UUID, user_ids: List[UUID]) -> set:
+        instances = TemplateInstance.__table__
+        result = await session.execute(
+            select(instances.c.user_id)
+            .where(instances.c.template_id == template_id, instances.c.user_id.in_(user_ids))
+        )
+        return set(result.scalars())
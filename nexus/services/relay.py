@@ -0,0 +1,67 @@
+# /sd/nexus/services/relay.py
+import asyncio
+import os
+from datetime import datetime, timedelta
+from typing import Optional, Tuple
+
+from db import async_session
+from logger import logger
+from services.cache import TTLCache
+from services.telegram import UserService
+
+
+class RelayIndex:
+    """Связь «пересланное в поддержку сообщение -> исходное»: LRU в памяти поверх таблицы support_relay"""
+
+    def __init__(self, cache_size: int = 10000, retention: timedelta = timedelta(days=30)):
+        self.retention = retention
+        self._cache = TTLCache(maxsize=cache_size, ttl=retention.total_seconds())
+        self._purger: Optional[asyncio.Task] = None
+
+    async def remember(self, relay_chat_id: int, relay_msg_id: int, origin_chat_id: int, origin_msg_id: int):
+        self._cache.set((relay_chat_id, relay_msg_id), (origin_chat_id, origin_msg_id))
+        async with UserService() as user_service:
+            await user_service.save_relay(relay_chat_id, relay_msg_id, origin_chat_id, origin_msg_id)
+
+    async def resolve(self, relay_chat_id: int, relay_msg_id: int) -> Optional[Tuple[int, int]]:
+        key = (relay_chat_id, relay_msg_id)
+        origin = self._cache.get(key)
+        if origin is None:
+            async with UserService() as user_service:
+                origin = await user_service.get_relay_origin(relay_chat_id, relay_msg_id)
+            if origin:
+                self._cache.set(key, origin)
+        return origin
+
+    async def purge(self) -> int:
+        """Удаляет связки старше срока хранения"""
+        async with async_session() as session:
+            deleted = await UserService(session).purge_relays(datetime.utcnow() - self.retention)
+            await session.commit()
+        return deleted
+
+    async def start(self, interval: float = 3600.0):
+        if self._purger is None or self._purger.done():
+            self._purger = asyncio.create_task(self._purge_loop(interval))
+
+    async def stop(self):
+        if self._purger is not None:
+            self._purger.cancel()
+            await asyncio.gather(self._purger, return_exceptions=True)
+            self._purger = None
+
+    async def _purge_loop(self, interval: float):
+        while True:
+            try:
+                deleted = await self.purge()
+                if deleted:
+                    logger.info(f"Удалено устаревших связок поддержки: {deleted}")
+            except Exception as e:
+                logger.error(f"Ошибка очистки связок поддержки: {e}")
+            await asyncio.sleep(interval)
+
+
+relay_index = RelayIndex(
+    cache_size=int(os.getenv("RELAY_CACHE_SIZE", 10000)),
+    retention=timedelta(days=int(os.getenv("RELAY_RETENTION_DAYS", 30)))
+)
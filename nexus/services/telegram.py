@@ -1,34 +1,126 @@
 # /sd/tg/LeonidBot/services/telegram.py
-from db import async_session
-from logger import logger
-from models import User, Group, UserGroup, UserRole, LogSettings, LogLevel, GroupType
+from db import async_session, update_session, sender
+from logger import logger, LEVEL_PRIORITY
+from models import User, Group, UserGroup, UserRole, LogSettings, LogLevel, GroupType, SupportRelay
+from models.tg import TelegramProfile, TelegramChat, ChatMember, ChatType
+from sqlalchemy import BigInteger, update, delete, func, literal
+from sqlalchemy.dialects.postgresql import insert as pg_insert
 from sqlalchemy.future import select
 from sqlalchemy.exc import IntegrityError
-from typing import Optional, List, Tuple, Any
+from sqlalchemy.ext.asyncio import AsyncSession
+from services.cache import TTLCache, MISSING, after_commit, invalidation_bus
+from engines import use_primary
+from typing import Optional, List, Tuple, Any, NamedTuple
 from datetime import datetime, timedelta
+import asyncio
 import os
-from aiogram import Bot
+from sender import Priority
+
+
+# ------------------------------
+# Кэш настроек логирования
+# ------------------------------
+class LogSettingsSnapshot(NamedTuple):
+    """Неизменяемая копия строки log_settings (без привязки к сессии)"""
+    level: LogLevel
+    chat_id: Optional[int]
+
+    def encode(self) -> str:
+        return f"{self.level.name}:{self.chat_id or ''}"
+
+    @classmethod
+    def decode(cls, payload: str) -> "LogSettingsSnapshot":
+        level, _, chat_id = payload.partition(":")
+        return cls(LogLevel(level), int(chat_id) if chat_id else None)
+
+
+class LogSettingsCache:
+    """Настройки логирования на процесс: write-through при записи, обновление по TTL"""
+    CHANNEL = "nexus_log_settings"
+    KEY = "log_settings"
+
+    def __init__(self, ttl: float = 60.0):
+        self._cache = TTLCache(maxsize=1, ttl=ttl)
+        self._last: Optional[LogSettingsSnapshot] = None  # Отдаём, пока идёт фоновое обновление
+        self._loaded = False
+        self._refresh: Optional[asyncio.Task] = None
+        invalidation_bus.subscribe(self.CHANNEL, self._on_notify)
+
+    async def get(self) -> Optional[LogSettingsSnapshot]:
+        """Возвращает настройки без обращения к БД (кроме самого первого вызова)"""
+        snapshot = self._cache.get(self.KEY, MISSING)
+        if snapshot is not MISSING:
+            return snapshot
+        if not self._loaded:
+            return await self.reload()
+        if self._refresh is None or self._refresh.done():
+            self._refresh = asyncio.create_task(self.reload())
+        return self._last
+
+    def peek(self) -> Optional[LogSettingsSnapshot]:
+        """Последнее известное значение синхронно, без БД и без проверки TTL"""
+        return self._last
+
+    def set(self, snapshot: Optional[LogSettingsSnapshot]):
+        self._cache.set(self.KEY, snapshot)
+        self._last = snapshot
+        self._loaded = True
+
+    async def reload(self) -> Optional[LogSettingsSnapshot]:
+        """Перечитывает настройки из БД"""
+        # Своя сессия: обновление может пережить апдейт, который его запустил
+        async with async_session() as session:
+            settings = await UserService(session).get_log_settings()
+            snapshot = LogSettingsSnapshot(settings.level, settings.chat_id) if settings else None
+        self.set(snapshot)
+        return snapshot
+
+    def _on_notify(self, payload: str):
+        # Другой процесс уже прислал новое значение — БД не читаем
+        self.set(LogSettingsSnapshot.decode(payload) if payload else None)
+
+
+log_settings_cache = LogSettingsCache(ttl=float(os.getenv("LOG_SETTINGS_TTL", 60)))
+
+# ------------------------------
+# Кэш ролей: telegram_id -> (id профиля, роль)
+# ------------------------------
+ROLE_CACHE_CHANNEL = "nexus_profile_role"
+role_cache = TTLCache(
+    maxsize=int(os.getenv("ROLE_CACHE_SIZE", 10000)),
+    ttl=float(os.getenv("ROLE_CACHE_TTL", 300))
+)
+invalidation_bus.subscribe(ROLE_CACHE_CHANNEL, lambda payload: role_cache.invalidate(int(payload)))
+
+# ------------------------------
+# Кэш членства: (id профиля, id чата), уже записанные в chat_member
+# ------------------------------
+membership_cache = TTLCache(
+    maxsize=int(os.getenv("MEMBERSHIP_CACHE_SIZE", 100000)),
+    ttl=float(os.getenv("MEMBERSHIP_CACHE_TTL", 3600))
+)
 
 
 class UserService:
-    def __init__(self):
+    def __init__(self, session: Optional[AsyncSession] = None):
         self.admin_chat_id = None
-        self.session = None
+        self.session = session
+        self._owns_session = False
 
     async def __aenter__(self):
-        self.session = async_session()
+        # Сессия апдейта (DbSessionMiddleware) или собственная
+        if self.session is None:
+            self.session = update_session.get()
+        if self.session is None:
+            self.session = async_session()
+            self._owns_session = True
         return self
 
-    async def __aexit__(self, exc_type, exc_val, exc_tb):
-        if exc_type is None:
-            await self.session.commit()
-        else:
-            await self.session.rollback()
-        await self.session.close()
-
     # ==== USER METHODS ====
     async def get_or_create_user(self, telegram_id: int, **kwargs) -> Tuple[User, bool]:
         """Получает или создает пользователя с автоматическим заполнением данных"""
+        # Чтение перед записью — с основной БД: реплика может ещё не видеть строку, созданную другим процессом
+        use_primary(self.session)
         user = await self.get_user_by_telegram_id(telegram_id)
         if user:
             return user, False
@@ -69,13 +161,14 @@ class UserService:
                 kwargs["role"] = UserRole.single.value
 
             user = User(**kwargs)
-            self.session.add(user)
-            await self.session.flush()
+            # Savepoint: ошибка не откатывает остальную работу апдейта
+            async with self.session.begin_nested():
+                self.session.add(user)
+            await self._invalidate_profile(user.telegram_id)
             return user
 
         except IntegrityError as e:
             logger.error(f"IntegrityError при создании пользователя: {e}")
-            await self.session.rollback()
             return await self.get_user_by_telegram_id(kwargs["telegram_id"])
 
         except Exception as e:
@@ -84,6 +177,7 @@ class UserService:
 
     async def update_user_role(self, telegram_id: int, new_role: UserRole) -> bool:
         """Обновляет роль пользователя в БД"""
+        use_primary(self.session)
         user = await self.get_user_by_telegram_id(telegram_id)
         if not user:
             return False
@@ -91,14 +185,22 @@ class UserService:
         try:
             user.role = new_role.value
             await self.session.flush()
+            await self._invalidate_profile(telegram_id)
             return True
         except Exception as e:
             logger.error(f"Ошибка обновления роли пользователя: {e}")
             return False
 
+    async def _invalidate_profile(self, telegram_id: int):
+        """Сбрасывает закэшированную роль профиля во всех процессах после commit: до него параллельный
+        промах кэша перечитал бы старую роль и держал её весь TTL"""
+        after_commit(self.session, lambda: role_cache.invalidate(telegram_id))
+        await invalidation_bus.publish(self.session, ROLE_CACHE_CHANNEL, str(telegram_id))
+
     # ==== GROUP METHODS ====
     async def get_or_create_group(self, telegram_id: int, **kwargs) -> Tuple[Group, bool]:
         """Получает или создает группу с автоматическим заполнением данных"""
+        use_primary(self.session)
         group = await self.get_group_by_telegram_id(telegram_id)
         if group:
             return group, False
@@ -150,43 +252,224 @@ class UserService:
 
     async def add_user_to_group(self, user_id: int, group_id: int, is_moderator: bool = False) -> Tuple[bool, str]:
         """Добавляет пользователя в группу"""
-        if await self.is_user_in_group(user_id, group_id):
-            return False, "Вы уже состоите в этой группе"
-
+        member = pg_insert(UserGroup).values(
+            user_id=user_id,
+            group_id=group_id,
+            is_moderator=is_moderator
+        ).on_conflict_do_nothing().returning(UserGroup.group_id).cte("member")
         try:
-            user_group = UserGroup(
-                user_id=user_id,
-                group_id=group_id,
-                is_moderator=is_moderator
-            )
-            self.session.add(user_group)
-            await self.session.flush()
-
-            # Обновляем счетчик участников
-            result = await self.session.execute(
-                select(Group).where(Group.telegram_id == group_id)
-            )
-            group = result.scalar_one_or_none()
-            if group:
-                group.participants_count += 1
-                await self.session.flush()
-
-            return True, "Вы успешно добавлены в группу"
+            async with self.session.begin_nested():
+                joined = await self._apply_counter(member, Group, Group.telegram_id, group_id, +1)
         except Exception as e:
             logger.error(f"Ошибка добавления в группу: {e}")
-            await self.session.rollback()
             return False, f"Ошибка при добавлении в группу: {str(e)}"
+        if not joined:
+            return False, "Вы уже состоите в этой группе"
+        return True, "Вы успешно добавлены в группу"
+
+    async def remove_user_from_group(self, user_id: int, group_id: int) -> bool:
+        """Удаляет пользователя из группы; True, если он в ней состоял"""
+        member = (
+            delete(UserGroup)
+            .where(UserGroup.user_id == user_id, UserGroup.group_id == group_id)
+            .returning(UserGroup.group_id)
+            .cte("member")
+        )
+        return await self._apply_counter(member, Group, Group.telegram_id, group_id, -1)
+
+    async def _apply_counter(self, member, model, key, value: int, delta: int) -> bool:
+        """Членство и счётчик одним запросом: счётчик меняется, только если строка членства вставлена/удалена"""
+        counter = (
+            update(model)
+            .where(key == value, key.in_(select(*member.c)))
+            .values(participants_count=model.participants_count + delta)
+            .returning(key)
+            .cte("counter")
+        )
+        stmt = select(select(func.count()).select_from(member).scalar_subquery()).add_cte(member, counter)
+        return (await self.session.execute(stmt)).scalar() > 0
+
+    async def get_group_members_page(
+            self, group_id: int, cursor: Optional[int] = None, limit: int = 50, backward: bool = False
+    ) -> List[Tuple[int, str]]:
+        """Страница участников группы по ключу user_id: [(user_id, имя)] по возрастанию id"""
+        return await self._members_page(
+            select(UserGroup.user_id, func.coalesce(User.full_display_name, User.first_name))
+            .join(User, User.telegram_id == UserGroup.user_id)
+            .where(UserGroup.group_id == group_id),
+            UserGroup.user_id, cursor, limit, backward
+        )
 
-    async def get_group_members(self, group_id: int) -> List[User]:
-        """Получает участников группы через БД"""
+    async def get_chat_members_page(
+            self, chat_id: int, cursor: Optional[int] = None, limit: int = 50, backward: bool = False
+    ) -> List[Tuple[int, str]]:
+        """Страница участников Telegram-чата по ключу profile_id"""
+        return await self._members_page(
+            select(ChatMember.profile_id, TelegramProfile.first_name)
+            .join(TelegramProfile, TelegramProfile.id == ChatMember.profile_id)
+            .where(ChatMember.chat_id == chat_id),
+            ChatMember.profile_id, cursor, limit, backward
+        )
+
+    async def _members_page(self, stmt, key, cursor: Optional[int], limit: int, backward: bool):
+        # Keyset вместо OFFSET: стоимость страницы не зависит от её номера
+        if cursor is not None:
+            stmt = stmt.where(key < cursor if backward else key > cursor)
+        stmt = stmt.order_by(key.desc() if backward else key).limit(limit)
         try:
-            result = await self.session.execute(
-                select(User).join(UserGroup).where(UserGroup.group_id == group_id)
-            )
-            return result.scalars().all()
+            rows = [tuple(row) for row in (await self.session.execute(stmt)).all()]
         except Exception as e:
-            logger.error(f"Ошибка получения участников группы: {e}")
+            logger.error(f"Ошибка получения участников: {e}")
             return []
+        return rows[::-1] if backward else rows
+
+    async def stream_group_members(self, group_id: int, batch_size: int = 1000):
+        """Все участники группы пачками через серверный курсор, без загрузки ORM-объектов"""
+        result = await self.session.stream(
+            select(UserGroup.user_id, func.coalesce(User.full_display_name, User.first_name))
+            .join(User, User.telegram_id == UserGroup.user_id)
+            .where(UserGroup.group_id == group_id)
+            .order_by(UserGroup.user_id)
+            .execution_options(yield_per=batch_size)
+        )
+        async for partition in result.partitions():
+            yield [tuple(row) for row in partition]
+
+    # ==== CHAT METHODS ====
+    async def ensure_chat_membership(self, user, chat) -> Optional[bool]:
+        """Профиль, чат и членство одним запросом; True, если участник добавлен впервые.
+        Профиль создаётся при привязке к учётной записи (user_id → ab_user), здесь он только обновляется;
+        без профиля записывается лишь чат, а результат — None"""
+        key = (user.id, chat.id)
+        if membership_cache.get(key):
+            return False
+
+        profile = (
+            update(TelegramProfile)
+            .where(TelegramProfile.id == user.id)
+            .values(
+                username=user.username,
+                first_name=user.first_name,
+                last_name=user.last_name,
+                language_code=user.language_code,
+                is_premium=bool(user.is_premium)
+            )
+            .returning(TelegramProfile.id)
+            .cte("profile")
+        )
+        profile_count = select(func.count()).select_from(profile).scalar_subquery()
+
+        # Новый чат сразу создаётся с участником (если профиль есть): UPDATE ниже его не видит
+        new_chat = pg_insert(TelegramChat).values(
+            id=chat.id,
+            title=chat.title or f"{user.first_name} чат",
+            type=ChatType(chat.type),
+            owner_id=select(profile.c.id).scalar_subquery(),
+            participants_count=profile_count
+        ).on_conflict_do_nothing(
+            index_elements=[TelegramChat.id]
+        ).returning(TelegramChat.id).cte("new_chat")
+
+        member = pg_insert(ChatMember).from_select(
+            ["profile_id", "chat_id"],
+            select(profile.c.id, literal(chat.id, BigInteger))
+        ).on_conflict_do_nothing().returning(ChatMember.chat_id).cte("member")
+
+        counter = (
+            update(TelegramChat)
+            .where(TelegramChat.id == chat.id, TelegramChat.id.in_(select(member.c.chat_id)))
+            .values(participants_count=TelegramChat.participants_count + 1)
+            .returning(TelegramChat.id)
+            .cte("counter")
+        )
+
+        stmt = (
+            select(select(func.count()).select_from(member).scalar_subquery(), profile_count)
+            .add_cte(profile, new_chat, member, counter)
+        )
+        added, profiles = (await self.session.execute(stmt)).one()
+        if not profiles:
+            return None
+        # Профиль записан — как и любая запись профиля, сбрасывает кэш ролей
+        await self._invalidate_profile(user.id)
+        # В кэш — только после commit: откатившийся апдейт не должен оставить "участника" без строки
+        after_commit(self.session, lambda: membership_cache.set(key, True))
+        return added > 0
+
+    async def remove_chat_membership(self, user_id: int, chat_id: int) -> bool:
+        """Удаляет участника чата; True, если он в нём состоял"""
+        membership_cache.invalidate((user_id, chat_id))
+        member = (
+            delete(ChatMember)
+            .where(ChatMember.profile_id == user_id, ChatMember.chat_id == chat_id)
+            .returning(ChatMember.chat_id)
+            .cte("member")
+        )
+        return await self._apply_counter(member, TelegramChat, TelegramChat.id, chat_id, -1)
+
+    # ==== COUNTER RECONCILIATION ====
+    async def reconcile_group_counts(self, after: Optional[int] = None, limit: int = 500) -> Tuple[Optional[int], int]:
+        """Пересчитывает participants_count пачки групп по user_group"""
+        return await self._reconcile_counts(Group, Group.telegram_id, UserGroup.group_id, after, limit)
+
+    async def reconcile_chat_counts(self, after: Optional[int] = None, limit: int = 500) -> Tuple[Optional[int], int]:
+        """Пересчитывает participants_count пачки чатов по chat_member"""
+        return await self._reconcile_counts(TelegramChat, TelegramChat.id, ChatMember.chat_id, after, limit)
+
+    async def _reconcile_counts(self, model, key, member_key, after: Optional[int], limit: int):
+        # Возвращает (последний ключ пачки или None в конце, число исправленных строк)
+        use_primary(self.session)
+        # Сначала блокируем пачку: _apply_counter, который уже держит строку, успеет закоммитить, и подсчёт
+        # следующим запросом (новый снимок READ COMMITTED) увидит его участника, а не затрёт его +1
+        ids_stmt = select(key).order_by(key).limit(limit).with_for_update()
+        if after is not None:
+            ids_stmt = ids_stmt.where(key > after)
+        ids = (await self.session.execute(ids_stmt)).scalars().all()
+        if not ids:
+            return None, 0
+        actual = (
+            select(func.count())
+            .select_from(member_key.table)
+            .where(member_key == key)
+            .correlate(model)
+            .scalar_subquery()
+        )
+        result = await self.session.execute(
+            update(model)
+            .where(key.in_(ids), model.participants_count.is_distinct_from(actual))
+            .values(participants_count=actual)
+            .execution_options(synchronize_session=False)
+        )
+        return ids[-1], result.rowcount
+
+    # ==== SUPPORT RELAY METHODS ====
+    async def save_relay(self, relay_chat_id: int, relay_msg_id: int, origin_chat_id: int, origin_msg_id: int):
+        """Запоминает, какому сообщению пользователя соответствует пересланное"""
+        self.session.add(SupportRelay(
+            relay_chat_id=relay_chat_id,
+            relay_msg_id=relay_msg_id,
+            origin_chat_id=origin_chat_id,
+            origin_msg_id=origin_msg_id
+        ))
+        await self.session.flush()
+
+    async def get_relay_origin(self, relay_chat_id: int, relay_msg_id: int) -> Optional[Tuple[int, int]]:
+        """Возвращает (chat_id, message_id) исходного сообщения"""
+        result = await self.session.execute(
+            select(SupportRelay.origin_chat_id, SupportRelay.origin_msg_id).where(
+                SupportRelay.relay_chat_id == relay_chat_id,
+                SupportRelay.relay_msg_id == relay_msg_id
+            )
+        )
+        row = result.first()
+        return (row.origin_chat_id, row.origin_msg_id) if row else None
+
+    async def purge_relays(self, older_than: datetime) -> int:
+        """Удаляет связки старше срока хранения"""
+        result = await self.session.execute(
+            delete(SupportRelay).where(SupportRelay.created_at < older_than)
+        )
+        return result.rowcount
 
     # ==== LOGGING METHODS ====
     async def get_log_settings(self) -> Optional[LogSettings]:
@@ -202,12 +485,15 @@ class UserService:
 
     async def update_log_level(self, level: LogLevel, chat_id: int = None) -> bool:
         """Обновляет уровень логирования в БД"""
+        # Иначе отстающая реплика вернёт None, и повторный INSERT id=1 упадёт на первичном ключе
+        use_primary(self.session)
         try:
             settings = await self.get_log_settings()
             if settings:
                 settings.level = level
                 settings.updated_at = datetime.utcnow()
                 await self.session.flush()
+                await self._publish_log_settings(settings)
                 return True
             # Если настроек нет - создаем новые
             settings = LogSettings(
@@ -218,26 +504,33 @@ class UserService:
             )
             self.session.add(settings)
             await self.session.flush()
+            await self._publish_log_settings(settings)
             logger.setLevel(level.name)
             return True
         except Exception as e:
             logger.error(f"Ошибка обновления уровня логирования: {e}")
             return False
 
+    async def _publish_log_settings(self, settings: LogSettings):
+        """Обновляет кэш настроек после commit и оповещает другие процессы (NOTIFY тоже уходит при commit)"""
+        snapshot = LogSettingsSnapshot(settings.level, settings.chat_id)
+        after_commit(self.session, lambda: log_settings_cache.set(snapshot))
+        await invalidation_bus.publish(self.session, LogSettingsCache.CHANNEL, snapshot.encode())
+
     async def send_log_to_telegram(self, level: LogLevel, message: str):
         """Отправляет лог в Telegram с учетом уровня логирования"""
         try:
-            settings = await self.get_log_settings()
+            settings = await log_settings_cache.get()
             if not settings:
                 return False
             # Проверяем уровень логирования
-            if level.value < settings.level.value:
+            if LEVEL_PRIORITY[level] < LEVEL_PRIORITY[settings.level]:
                 return False
-            # Отправляем сообщение
-            bot = Bot(token=os.getenv("BOT_TOKEN"))
-            await bot.send_message(
-                chat_id=settings.chat_id,
-                text=f"[{level.name}] {message}",
+            # Отправляем сообщение через общую очередь (один Bot и одна HTTP-сессия)
+            await sender.send_message(
+                settings.chat_id,
+                f"[{level.name}] {message}",
+                priority=Priority.LOG,
                 parse_mode="MarkdownV2"
             )
             return True
@@ -246,6 +539,11 @@ class UserService:
             return False
 
     async def __aexit__(self, exc_type, exc_val, exc_tb):
+        if not self._owns_session:
+            # Коммитит владелец сессии — один раз на апдейт
+            if exc_type is None:
+                await self.session.flush()
+            return
         try:
             if exc_type is None:
                 await self.session.commit()
@@ -0,0 +1,149 @@
+# /sd/nexus/supervisor.py
+import logging
+import os
+import signal
+import subprocess
+import sys
+import time
+from typing import List, Optional
+
+logger = logging.getLogger("nexus.supervisor")
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+
+class Child:
+    """Дочерний процесс: запуск, мягкая остановка, перезапуск"""
+
+    def __init__(self, name: str, argv: List[str], reload_signal: Optional[int] = None):
+        self.name = name
+        self.argv = argv
+        self.reload_signal = reload_signal  # Сигнал, по которому процесс сам обновляет воркеров
+        self.process: Optional[subprocess.Popen] = None
+        self.started_at = 0.0
+        self.backoff = 1.0
+        self.restart_at = 0.0
+
+    @property
+    def alive(self) -> bool:
+        return self.process is not None and self.process.poll() is None
+
+    def start(self):
+        self.process = subprocess.Popen(self.argv, cwd=ROOT)
+        self.started_at = time.monotonic()
+        logger.info(f"{self.name}: запущен (pid {self.process.pid})")
+
+    def stop(self, timeout: float):
+        """SIGTERM и ожидание; по истечении timeout — SIGKILL"""
+        if self.alive:
+            self.process.send_signal(signal.SIGTERM)
+        self.wait(timeout)
+
+    def wait(self, timeout: float):
+        if self.process is None or self.process.returncode is not None:
+            return
+        try:
+            self.process.wait(timeout)
+        except subprocess.TimeoutExpired:
+            logger.warning(f"{self.name}: не завершился за {timeout} с, SIGKILL")
+            self.process.kill()
+            self.process.wait()
+        logger.info(f"{self.name}: остановлен (код {self.process.returncode})")
+
+    def reload(self, timeout: float):
+        if self.reload_signal is not None and self.alive:
+            self.process.send_signal(self.reload_signal)
+            logger.info(f"{self.name}: плавное обновление воркеров")
+        else:
+            self.stop(timeout)
+            self.start()
+
+
+class ProcessSupervisor:
+    """Веб и бот в отдельных процессах: перезапуск упавших, SIGTERM — мягкая остановка, SIGHUP — поочерёдный перезапуск"""
+
+    def __init__(self, children: List[Child], graceful_timeout: float = 30.0, max_backoff: float = 30.0):
+        self.children = children
+        self.graceful_timeout = graceful_timeout
+        self.max_backoff = max_backoff
+        self._stopping = False
+        self._reload = False
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self._on_stop)
+        signal.signal(signal.SIGINT, self._on_stop)
+        signal.signal(signal.SIGHUP, self._on_reload)
+        for child in self.children:
+            child.start()
+        try:
+            while not self._stopping:
+                time.sleep(0.5)
+                if self._reload:
+                    self._reload = False
+                    self.rolling_restart()
+                self._check_children()
+        finally:
+            self.drain()
+
+    def rolling_restart(self):
+        """По одному процессу: остальные продолжают обслуживать"""
+        logger.info("Поочерёдный перезапуск процессов")
+        for child in self.children:
+            if self._stopping:
+                return
+            child.reload(self.graceful_timeout)
+
+    def drain(self):
+        """Останавливает всех параллельно и ждёт не дольше graceful_timeout"""
+        logger.info("Остановка: ожидание завершения текущих запросов и апдейтов")
+        for child in self.children:
+            if child.alive:
+                child.process.send_signal(signal.SIGTERM)
+        deadline = time.monotonic() + self.graceful_timeout
+        for child in self.children:
+            child.wait(max(0.0, deadline - time.monotonic()))
+
+    def _check_children(self):
+        now = time.monotonic()
+        for child in self.children:
+            if child.alive or child.process is None:
+                continue
+            if child.restart_at == 0.0:
+                # Падение сразу после старта — увеличиваем паузу, чтобы не перезапускать в цикле
+                quick = now - child.started_at < 10
+                child.backoff = min(self.max_backoff, child.backoff * 2) if quick else 1.0
+                child.restart_at = now + child.backoff
+                logger.error(
+                    f"{child.name}: завершился с кодом {child.process.returncode}, "
+                    f"перезапуск через {child.backoff:.0f} с"
+                )
+            elif now >= child.restart_at:
+                child.restart_at = 0.0
+                child.start()
+
+    def _on_stop(self, signum, frame):
+        self._stopping = True
+
+    def _on_reload(self, signum, frame):
+        self._reload = True
+
+
+def build_supervisor(
+        web_workers: int,
+        web_bind: str = "0.0.0.0:8000",
+        bot_workers: int = 1,
+        graceful_timeout: float = 30.0
+) -> ProcessSupervisor:
+    children = []
+    if web_workers:
+        # gunicorn сам обновляет воркеров по SIGHUP: новые стартуют до остановки старых
+        children.append(Child("web", [
+            sys.executable, "-m", "gunicorn",
+            "--workers", str(web_workers),
+            "--bind", web_bind,
+            "--graceful-timeout", str(int(graceful_timeout)),
+            "wsgi:app",  # Не web.app:app: wsgi.py подключает профилирование запросов
+        ], reload_signal=signal.SIGHUP))
+    # Бот — один процесс long polling (при bot_workers > 1 он раздаёт апдейты своим воркерам)
+    children.append(Child("bot", [sys.executable, "main.py", "--bot", "--workers", str(bot_workers)]))
+    return ProcessSupervisor(children, graceful_timeout=graceful_timeout)
@@ -0,0 +1,6 @@
+# /sd/nexus/wsgi.py
+# Точка входа веба для gunicorn (supervisor.py) и main.py --flask: приложение с профилированием запросов
+from web.app import app
+from profiler import sql_profiler
+
+sql_profiler.init_flask(app)